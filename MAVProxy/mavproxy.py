@@ -14,11 +14,11 @@ import json
 import os
 import platform
 import select
+import selectors
 import serial
 import shlex
 import signal
 import socket
-import struct
 import sys
 import threading
 import time
@@ -35,11 +35,13 @@ except NameError:
 from pymavlink import mavutil
 
 from MAVProxy.modules.lib import textconsole
+from MAVProxy.modules.lib import mp_batch
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import rline
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_substitute
 from MAVProxy.modules.lib import multiproc
+from MAVProxy.modules.lib import tlog_writer
 from MAVProxy.modules.mavproxy_link import preferred_ports
 
 # adding all this allows pyinstaller to build a working windows executable
@@ -161,6 +163,9 @@ class MPStatus(object):
             f.write('\n')
             f.write('MAV Errors: %u\n' % self.mav_error)
             f.write(str(self.gps)+'\n')
+            for q in [mpstate.logqueue, mpstate.logqueue_raw]:
+                if q is not None:
+                    f.write('Log %s\n' % q.status_string())
         for m in sorted(self.msgs.keys()):
             if pattern is not None:
                 if not fnmatch.fnmatch(str(m).upper(), pattern.upper()):
@@ -228,6 +233,83 @@ class MAVFunctions(object):
         self.input_handler = None
 
 
+class MPFDRegistry(object):
+    '''persistent registry of file descriptors for the selectors main loop
+
+    each registered fd maps directly to a (fn, arg) handler. The
+    owner of a link or output calls invalidate() after adding or
+    removing it so the registry is brought up to date on the next pass
+    of the main loop
+    '''
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.handlers = {}
+        self.changed = True
+        self.last_sync = 0
+
+    def invalidate(self):
+        '''mark the registry as needing a sync with the current links'''
+        self.changed = True
+
+    def register(self, fd, fn, arg, owner=None):
+        '''register a file descriptor with a handler. owner is an
+        object whose identity is tied to the fd, so a reopened port
+        which reuses the same fd number gets re-registered'''
+        old = self.handlers.get(fd, None)
+        if old is not None:
+            if old == (fn, arg, owner):
+                return
+            self.unregister(fd)
+        try:
+            self.selector.register(fd, selectors.EVENT_READ, (fn, arg))
+        except (ValueError, OSError, KeyError):
+            return
+        self.handlers[fd] = (fn, arg, owner)
+
+    def unregister(self, fd):
+        '''remove a file descriptor from the registry'''
+        if self.handlers.pop(fd, None) is None:
+            return
+        try:
+            self.selector.unregister(fd)
+        except (ValueError, OSError, KeyError):
+            pass
+
+    def unregister_arg(self, arg):
+        '''remove all file descriptors whose handler is called with arg'''
+        for (fd, (fn, a, owner)) in list(self.handlers.items()):
+            if a is arg:
+                self.unregister(fd)
+
+    def sync(self, wanted):
+        '''make the registry match wanted, a dict of fd -> (fn, arg, owner)'''
+        for fd in list(self.handlers.keys()):
+            if fd not in wanted:
+                self.unregister(fd)
+        for fd in wanted:
+            (fn, arg, owner) = wanted[fd]
+            self.register(fd, fn, arg, owner=owner)
+        self.changed = False
+        self.last_sync = time.time()
+
+    def select(self, timeout):
+        '''wait for up to timeout seconds, returning list of (fn, arg) for ready fds'''
+        if len(self.handlers) == 0:
+            time.sleep(timeout)
+            return []
+        try:
+            events = self.selector.select(timeout)
+        except (OSError, ValueError):
+            # a fd was closed underneath us, resync on next pass
+            self.changed = True
+            return []
+        return [key.data for (key, mask) in events]
+
+    def close(self):
+        self.selector.close()
+        self.handlers = {}
+
+
 class MPState(object):
     '''holds state of mavproxy'''
     def __init__(self):
@@ -261,6 +343,12 @@ class MPState(object):
             MPSetting('baudrate', int, opts.baudrate, 'baudrate for new links', range=(0, 10000000), increment=1),
             MPSetting('rtscts', bool, opts.rtscts, 'enable flow control'),
             MPSetting('select_timeout', float, 0.01, 'select timeout'),
+            MPSetting('mainloop', str, 'select', 'main loop backend', choice=['select', 'selectors']),
+            MPSetting('out_batch', bool, False, 'batch writes to outputs'),
+            MPSetting('out_batch_latency', float, 0, 'max output batch latency (ms)', range=(0, 1000), increment=1),
+            MPSetting('out_batch_size', int, 1400, 'max output batch size (bytes)', range=(280, 65000), increment=1),
+            MPSetting('rtcm_rate', int, 0, 'max RTCM injection rate per link (bytes/s)', range=(0, 1000000), increment=100),
+            MPSetting('rtcm_max_age', float, 5, 'max age of queued RTCM data (s)', range=(0, 60), increment=0.5),
 
             MPSetting('altreadout', int, 10, 'Altitude Readout',
                       range=(0, 100), increment=1, tab='Announcements'),
@@ -270,11 +358,17 @@ class MPState(object):
             MPSetting('script_fatal', bool, False, 'fatal error on bad script', tab='Debug'),
             MPSetting('compdebug', int, 0, 'Computation Debug Mask', range=(0, 3), tab='Debug'),
             MPSetting('flushlogs', bool, False, 'Flush logs on every packet'),
+            MPSetting('log_rotate_size', int, 0, 'Rotate telemetry log after this many MB', range=(0, 100000), increment=1),
+            MPSetting('log_rotate_time', int, 0, 'Rotate telemetry log after this many mins', range=(0, 100000), increment=1),
+            MPSetting('log_compress', str, 'none', 'Telemetry log compression', choice=['none', 'gzip', 'zstd']),
             MPSetting('requireexit', bool, False, 'Require exit command'),
             MPSetting('wpupdates', bool, True, 'Announce waypoint updates'),
             MPSetting('wpterrainadjust', bool, True, 'Adjust alt of moved wp using terrain'),
             MPSetting('wp_use_mission_int', bool, True, 'use MISSION_ITEM_INT messages'),
             MPSetting('wp_use_waypoint_set_current', bool, False, 'use deprecated WAYPOINT_SET_CURRENT message'),
+            MPSetting('wp_request_window', int, 10, 'mission items to request at once', range=(1, 100)),
+            MPSetting('wp_cache', bool, True, 'cache mission items by vehicle identity'),
+            MPSetting('wp_partial_upload', bool, True, 'only upload changed mission items'),
 
             MPSetting('basealt', int, 0, 'Base Altitude', range=(0, 30000), increment=1, tab='Altitude'),
             MPSetting('wpalt', int, 100, 'Default WP Altitude', range=(0, 10000), increment=1),
@@ -300,6 +394,7 @@ class MPState(object):
             MPSetting('fwdpos', bool, False, 'Forward GLOBAL_POSITION_INT on all links'),
             MPSetting('checkdelay', bool, True, 'check for link delay'),
             MPSetting('param_ftp', bool, True, 'try ftp for parameter download'),
+            MPSetting('param_cache', bool, True, 'cache parameters by vehicle identity'),
             MPSetting('param_docs', bool, True, 'show help for parameters'),
 
             MPSetting('vehicle_name', str, '', 'Vehicle Name', tab='Vehicle'),
@@ -328,6 +423,7 @@ class MPState(object):
         # mavlink outputs
         self.mav_outputs = []
         self.sysid_outputs = {}
+        self.output_batch = mp_batch.BatchWriter(self.settings)
 
         # Mapping of all detected sysid's to links
         # Key is link id, value is all detected sysid's/compid's in that link
@@ -340,9 +436,13 @@ class MPState(object):
         self.mav_param_by_sysid = {}
         self.mav_param_by_sysid[(self.settings.target_system, self.settings.target_component)] = mavparm.MAVParmDict()
         self.modules = []
+        # incremented whenever modules are loaded or unloaded, or change
+        # the message types they subscribe to
+        self.module_generation = 0
         self.public_modules = {}
         self.functions = MAVFunctions()
         self.select_extra = {}
+        self.fd_registry = MPFDRegistry()
         self.continue_mode = False
         self.aliases = {}
         import platform
@@ -388,6 +488,7 @@ class MPState(object):
                 module = m.init(mpstate, **kwargs)
                 if isinstance(module, mp_module.MPModule):
                     mpstate.modules.append((module, m))
+                    mpstate.module_generation += 1
                     if not quiet:
                         if kwargs:
                             print("Loaded module %s with kwargs = %s" % (modname, kwargs))
@@ -418,8 +519,10 @@ class MPState(object):
                     if t.is_alive():
                         print("unload on module %s did not complete" % m.name)
                         mpstate.modules.remove((m, pm))
+                        mpstate.module_generation += 1
                         return False
                 mpstate.modules.remove((m, pm))
+                mpstate.module_generation += 1
                 if modname in mpstate.public_modules:
                     del mpstate.public_modules[modname]
                 print("Unloaded module %s" % modname)
@@ -849,7 +952,7 @@ def process_master(m):
         return
 
     if mpstate.logqueue_raw:
-        mpstate.logqueue_raw.put(bytearray(s))
+        mpstate.logqueue_raw.put(s)
 
     if mpstate.status.setup_mode:
         if mpstate.system == 'Windows':
@@ -878,6 +981,7 @@ def process_master(m):
                 if opts.show_errors:
                     mpstate.console.writeln("MAV error: %s" % msg)
                 mpstate.status.mav_error += 1
+        mpstate.output_batch.flush()
 
 
 def process_mavlink(slave):
@@ -914,15 +1018,16 @@ def process_mavlink(slave):
                 # repack the message if this is a signed link and not already signed
                 m.pack(output.mav)
 
-            output.write(m.get_msgbuf())
+            mpstate.output_batch.write(output, m.get_msgbuf())
             if mpstate.logqueue:
                 usec = int(time.time() * 1.0e6)
-                mpstate.logqueue.put(bytearray(struct.pack('>Q', usec) + m.get_msgbuf()))
+                mpstate.logqueue.put_msg(usec, m.get_msgbuf())
             if mpstate.status.watch:
                 for msg_type in mpstate.status.watch:
                     if fnmatch.fnmatch(m.get_type().upper(), msg_type.upper()):
                         mpstate.console.writeln('> ' + str(m))
                         break
+        mpstate.output_batch.flush()
     mpstate.status.counters['Slave'] += 1
 
 
@@ -939,20 +1044,6 @@ def mkdir_p(dir):
     os.mkdir(dir)
 
 
-def log_writer():
-    '''log writing thread'''
-    while not mpstate.status.exit:
-        mpstate.logfile_raw.write(bytearray(mpstate.logqueue_raw.get()))
-        timeout = time.time() + 10
-        while not mpstate.logqueue_raw.empty() and time.time() < timeout:
-            mpstate.logfile_raw.write(mpstate.logqueue_raw.get())
-        while not mpstate.logqueue.empty() and time.time() < timeout:
-            mpstate.logfile.write(mpstate.logqueue.get())
-        if mpstate.settings.flushlogs or time.time() >= timeout:
-            mpstate.logfile.flush()
-            mpstate.logfile_raw.flush()
-
-
 # If state_basedir is NOT set then paths for logs and aircraft
 # directories are relative to mavproxy's cwd
 def log_paths():
@@ -1003,26 +1094,22 @@ def open_telemetry_logs(logpath_telem, logpath_telem_raw):
         mode = 'wb'
 
     try:
-        mpstate.logfile = open(logpath_telem, mode=mode)
-        mpstate.logfile_raw = open(logpath_telem_raw, mode=mode)
+        # the writers do all disk IO and compression in their own
+        # threads to prevent delays during disk writes (important as
+        # delays can be long if camera app is running)
+        mpstate.logqueue.start(logpath_telem, mode=mode)
+        mpstate.logqueue_raw.start(logpath_telem_raw, mode=mode)
         print("Log Directory: %s" % mpstate.status.logdir)
         print("Telemetry log: %s" % logpath_telem)
 
         # make sure there's enough free disk space for the logfile (>200Mb)
         # statvfs doesn't work in Windows
         if platform.system() != 'Windows':
-            stat = os.statvfs(logpath_telem)
+            stat = os.statvfs(os.path.dirname(logpath_telem) or '.')
             if stat.f_bfree*stat.f_bsize < 209715200:
                 print("ERROR: Not enough free disk space for logfile")
                 mpstate.status.exit = True
                 return
-
-        # use a separate thread for writing to the logfile to prevent
-        # delays during disk writes (important as delays can be long if camera
-        # app is running)
-        t = threading.Thread(target=log_writer, name='log_writer')
-        t.daemon = True
-        t.start()
     except Exception as e:
         print("ERROR: opening log file for writing: %s" % e)
         mpstate.status.exit = True
@@ -1095,6 +1182,8 @@ def periodic_tasks():
 
     mpstate.status.update_bytecounters()
 
+    mpstate.output_batch.flush()
+
     # call optional module idle tasks. These are called at several hundred Hz
     for (m, pm) in mpstate.modules:
         if hasattr(m, 'idle_task'):
@@ -1111,52 +1200,84 @@ def periodic_tasks():
             mpstate.unload_module(m.name)
 
 
-def main_loop():
-    '''main processing loop'''
-
+def main_loop_housekeeping():
+    '''work done on each pass of the main loop, independent of backend'''
     global screensaver_cookie
 
-    if not mpstate.status.setup_mode and not opts.nowait:
-        for master in mpstate.mav_master:
-            if master.linknum != 0:
-                break
-            print("Waiting for heartbeat from %s" % master.address)
-            send_heartbeat(master)
-            master.wait_heartbeat(timeout=0.1)
-        set_stream_rates()
+    # enable or disable screensaver:
+    if (mpstate.settings.inhibit_screensaver_when_armed and
+            screensaver_interface is not None):
+        if mpstate.status.armed and screensaver_cookie is None:
+            # now we can inhibit the screensaver
+            screensaver_cookie = screensaver_interface.Inhibit("MAVProxy",
+                                                               "Vehicle is armed")
+        elif not mpstate.status.armed and screensaver_cookie is not None:
+            # we can also restore it
+            screensaver_interface.UnInhibit(screensaver_cookie)
+            screensaver_cookie = None
+
+    while not mpstate.input_queue.empty():
+        line = mpstate.input_queue.get()
+        mpstate.input_count += 1
+        cmds = line.split(';')
+        if len(cmds) == 1 and cmds[0] == "":
+            mpstate.empty_input_count += 1
+        for c in cmds:
+            process_stdin(c)
+
+    for master in mpstate.mav_master:
+        if master.fd is None:
+            try:
+                if master.port.inWaiting() > 0:
+                    process_master(master)
+            except serial.SerialException:
+                pass
+
 
+def process_select_extra(fd):
+    '''call a read function registered by a module in select_extra'''
+    if fd not in mpstate.select_extra:
+        return
+    try:
+        # call the registered read function
+        (fn, args) = mpstate.select_extra[fd]
+        fn(args)
+    except Exception as msg:
+        if mpstate.settings.moddebug == 1:
+            print(msg)
+        # on an exception, remove it from the select list
+        mpstate.select_extra.pop(fd)
+        mpstate.fd_registry.invalidate()
+
+
+def fd_registry_wanted():
+    '''return dict of fd -> (fn, arg, owner) for all links and outputs'''
+    wanted = {}
+    for master in mpstate.mav_master:
+        if master.fd is not None and not master.portdead:
+            wanted[master.fd] = (process_master, master, getattr(master, 'port', None))
+    for m in mpstate.mav_outputs:
+        if m.fd is not None:
+            wanted[m.fd] = (process_mavlink, m, getattr(m, 'port', None))
+    for sysid in mpstate.sysid_outputs:
+        m = mpstate.sysid_outputs[sysid]
+        if m.fd is not None:
+            wanted[m.fd] = (process_mavlink, m, getattr(m, 'port', None))
+    for fd in mpstate.select_extra:
+        if fd is not None and fd not in wanted:
+            wanted[fd] = (process_select_extra, fd, mpstate.select_extra[fd][0])
+    return wanted
+
+
+def main_loop_select():
+    '''main processing loop using select() on a list rebuilt each pass'''
     while True:
         if mpstate is None or mpstate.status.exit:
             return
+        if mpstate.settings.mainloop == 'selectors':
+            return
 
-        # enable or disable screensaver:
-        if (mpstate.settings.inhibit_screensaver_when_armed and
-                screensaver_interface is not None):
-            if mpstate.status.armed and screensaver_cookie is None:
-                # now we can inhibit the screensaver
-                screensaver_cookie = screensaver_interface.Inhibit("MAVProxy",
-                                                                   "Vehicle is armed")
-            elif not mpstate.status.armed and screensaver_cookie is not None:
-                # we can also restore it
-                screensaver_interface.UnInhibit(screensaver_cookie)
-                screensaver_cookie = None
-
-        while not mpstate.input_queue.empty():
-            line = mpstate.input_queue.get()
-            mpstate.input_count += 1
-            cmds = line.split(';')
-            if len(cmds) == 1 and cmds[0] == "":
-                mpstate.empty_input_count += 1
-            for c in cmds:
-                process_stdin(c)
-
-        for master in mpstate.mav_master:
-            if master.fd is None:
-                try:
-                    if master.port.inWaiting() > 0:
-                        process_master(master)
-                except serial.SerialException:
-                    pass
+        main_loop_housekeeping()
 
         periodic_tasks()
 
@@ -1212,16 +1333,64 @@ def main_loop():
 
             # this allow modules to register their own file descriptors
             # for the main select loop
-            if fd in mpstate.select_extra:
-                try:
-                    # call the registered read function
-                    (fn, args) = mpstate.select_extra[fd]
-                    fn(args)
-                except Exception as msg:
-                    if mpstate.settings.moddebug == 1:
-                        print(msg)
-                    # on an exception, remove it from the select list
-                    mpstate.select_extra.pop(fd)
+            process_select_extra(fd)
+
+
+def main_loop_selectors():
+    '''main processing loop using a persistent selectors registry.
+
+    periodic tasks run on a timer of select_timeout seconds rather than
+    on every pass, and the select timeout is the time left until they
+    are next due, so a busy link does not cause busy polling'''
+    registry = mpstate.fd_registry
+    registry.invalidate()
+    next_periodic = 0
+    while True:
+        if mpstate is None or mpstate.status.exit:
+            return
+        if mpstate.settings.mainloop != 'selectors':
+            registry.sync({})
+            return
+
+        now = time.time()
+        if now >= next_periodic:
+            next_periodic = now + mpstate.settings.select_timeout
+            main_loop_housekeeping()
+            periodic_tasks()
+            # links can change fd on reconnect, so resync at 1Hz even
+            # if nobody told us about a change
+            if registry.changed or now - registry.last_sync > 1:
+                registry.sync(fd_registry_wanted())
+
+        timeout = max(0, next_periodic - time.time())
+        for (fn, arg) in registry.select(timeout):
+            if mpstate is None:
+                return
+            fn(arg)
+            if fn is process_master and arg.portdead:
+                # a dead port stays readable, which would have us spin
+                # until the next sync
+                registry.unregister_arg(arg)
+
+
+def main_loop():
+    '''main processing loop'''
+    if not mpstate.status.setup_mode and not opts.nowait:
+        for master in mpstate.mav_master:
+            if master.linknum != 0:
+                break
+            print("Waiting for heartbeat from %s" % master.address)
+            send_heartbeat(master)
+            master.wait_heartbeat(timeout=0.1)
+        set_stream_rates()
+
+    # each backend returns when the mainloop setting changes, allowing
+    # them to be compared at runtime
+    while mpstate is not None and not mpstate.status.exit:
+        if mpstate.settings.mainloop == 'selectors':
+            main_loop_selectors()
+        else:
+            main_loop_select()
 
 
 def input_loop():
@@ -1421,8 +1590,8 @@ if __name__ == '__main__':
     # queues for logging
 
     if not opts.no_state:
-        mpstate.logqueue = multiproc.Queue()
-        mpstate.logqueue_raw = multiproc.Queue()
+        mpstate.logqueue = tlog_writer.TLogWriter(mpstate.settings)
+        mpstate.logqueue_raw = tlog_writer.TLogWriter(mpstate.settings)
     else:
         mpstate.logqueue = None
         mpstate.logqueue_raw = None
@@ -1633,4 +1802,8 @@ if __name__ == '__main__':
             print("Unloading module %s" % m.name)
             m.unload()
 
+    for q in [mpstate.logqueue, mpstate.logqueue_raw]:
+        if q is not None:
+            q.close()
+
     sys.exit(1)
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+'''
+columnar access to dataflash logs
+
+message types are extracted once from a DFReader_binary into NumPy
+structured arrays, one per type, by gathering the raw records using the
+per-type offset table pymavlink builds when the log is loaded. Simple
+graph expressions such as ATT.Roll or degrees(NKF1[0].VN)*2 can then
+be evaluated as array operations rather than once per message
+
+AP_FLAKE8_CLEAN
+'''
+
+import ast
+import operator
+
+import numpy as np
+
+from pymavlink import DFReader
+
+# functions which may appear in a vectorised expression
+array_functions = {
+    'abs': np.abs,
+    'sqrt': np.sqrt,
+    'sin': np.sin,
+    'cos': np.cos,
+    'tan': np.tan,
+    'asin': np.arcsin,
+    'acos': np.arccos,
+    'atan': np.arctan,
+    'atan2': np.arctan2,
+    'degrees': np.degrees,
+    'radians': np.radians,
+    'exp': np.exp,
+    'log': np.log,
+    'log10': np.log10,
+    'floor': np.floor,
+    'ceil': np.ceil,
+    'fabs': np.fabs,
+}
+
+binary_ops = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.Pow: operator.pow,
+    ast.Mod: operator.mod,
+}
+
+unary_ops = {
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+}
+
+
+class ColumnarType(object):
+    '''all messages of one type as a structured array'''
+    def __init__(self, fmt, records, timestamps):
+        self.fmt = fmt
+        self.records = records
+        self.timestamps = timestamps
+        self.instance_masks = {}
+
+    def column(self, field):
+        '''return a field as a float array with the format multiplier applied,
+        or None if it is not numeric'''
+        i = self.fmt.colhash.get(field, None)
+        if i is None:
+            return None
+        if self.records.dtype.fields[field][0].kind not in 'iuf':
+            return None
+        v = self.records[field].astype(np.float64)
+        mul = self.fmt.msg_mults[i]
+        if mul is not None:
+            if mul > 0.0 and mul < 1.0:
+                # divide as DFMessage does for accuracy
+                v /= 1 / mul
+            else:
+                v *= mul
+        return v
+
+    def instance_mask(self, instance):
+        '''return a boolean mask selecting one instance'''
+        if instance in self.instance_masks:
+            return self.instance_masks[instance]
+        field = self.fmt.instance_field
+        if field is None:
+            return None
+        col = self.records[field]
+        if col.dtype.kind == 'S':
+            mask = col == instance.encode('utf-8')
+        else:
+            try:
+                mask = col == int(instance)
+            except ValueError:
+                return None
+        self.instance_masks[instance] = mask
+        return mask
+
+
+class ColumnarLog(object):
+    '''lazily extracted per-type arrays for a DFReader_binary log'''
+    def __init__(self, mlog):
+        self.mlog = mlog
+        self.types = {}
+
+    @staticmethod
+    def supported(mlog):
+        '''return True if a log can be accessed by column'''
+        return (isinstance(mlog, DFReader.DFReader_binary) and
+                isinstance(mlog.clock, DFReader.DFReaderClock_usec))
+
+    def get(self, name):
+        '''return the ColumnarType for a message name, or None'''
+        if name in self.types:
+            return self.types[name]
+        ctype = self.extract(name)
+        self.types[name] = ctype
+        return ctype
+
+    def extract(self, name):
+        '''gather all records of a type into a structured array'''
+        mlog = self.mlog
+        mtype = mlog.name_to_id.get(name, None)
+        if mtype is None:
+            return None
+        fmt = mlog.formats[mtype]
+        if len(fmt.columns) == 0 or fmt.columns[0] != 'TimeUS' or 'a' in fmt.format:
+            return None
+        names = []
+        formats = []
+        for i in range(len(fmt.columns)):
+            s = DFReader.FORMAT_TO_STRUCT[fmt.format[i]][0]
+            names.append(fmt.columns[i])
+            formats.append('<' + s if s[-1] != 's' else 'S' + s[:-1])
+        try:
+            dtype = np.dtype({'names': names, 'formats': formats})
+        except (TypeError, ValueError):
+            return None
+        if dtype.itemsize + 3 > fmt.len:
+            return None
+        offsets = np.asarray(mlog.offsets[mtype], dtype=np.int64)
+        # ignore a truncated record at the end of the log
+        offsets = offsets[offsets + fmt.len <= mlog.data_len]
+        data = np.frombuffer(mlog.data_map, dtype=np.uint8)
+        idx = offsets[:, None] + np.arange(3, 3 + dtype.itemsize, dtype=np.int64)
+        raw = np.ascontiguousarray(data[idx])
+        records = raw.view(dtype).reshape(len(offsets))
+        timestamps = mlog.clock.timebase + records['TimeUS'] * 1.0e-6
+        return ColumnarType(fmt, records, timestamps)
+
+
+class ColumnarExpression(object):
+    '''a graph expression which only uses fields of one message type,
+    compiled for evaluation on arrays'''
+    def __init__(self, expression):
+        self.expression = expression
+        self.mtype = None
+        self.instance = None
+        self.tree = None
+        self.invalid = None
+        try:
+            tree = ast.parse(expression, mode='eval')
+            if self.check(tree.body):
+                self.tree = tree.body
+        except (SyntaxError, ValueError):
+            pass
+
+    def valid(self):
+        return self.tree is not None
+
+    def check_type(self, mtype, instance):
+        '''check all fields come from the same type and instance'''
+        if self.mtype is None:
+            self.mtype = mtype
+            self.instance = instance
+            return True
+        return self.mtype == mtype and self.instance == instance
+
+    def check(self, node):
+        '''return True if node can be evaluated on arrays'''
+        if isinstance(node, ast.Constant):
+            return isinstance(node.value, (int, float)) and not isinstance(node.value, bool)
+        if isinstance(node, ast.BinOp):
+            return type(node.op) in binary_ops and self.check(node.left) and self.check(node.right)
+        if isinstance(node, ast.UnaryOp):
+            return type(node.op) in unary_ops and self.check(node.operand)
+        if isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in array_functions or node.keywords:
+                return False
+            return all(self.check(a) for a in node.args)
+        if isinstance(node, ast.Attribute):
+            v = node.value
+            if isinstance(v, ast.Name):
+                return self.check_type(v.id, None)
+            if isinstance(v, ast.Subscript) and isinstance(v.value, ast.Name):
+                inst = v.slice
+                if isinstance(inst, ast.Constant):
+                    return self.check_type(v.value.id, str(inst.value))
+                if isinstance(inst, ast.Name):
+                    return self.check_type(v.value.id, inst.id)
+            return False
+        return False
+
+    def evaluate(self, clog):
+        '''evaluate on a ColumnarLog, returning (timestamps, values) or None'''
+        ctype = clog.get(self.mtype)
+        if ctype is None:
+            return None
+        mask = None
+        if self.instance is not None:
+            mask = ctype.instance_mask(self.instance)
+            if mask is None:
+                return None
+        # rows where evaluating one message would raise ZeroDivisionError
+        self.invalid = None
+        try:
+            with np.errstate(all='ignore'):
+                v = self.eval_node(self.tree, ctype)
+        except (KeyError, TypeError, ValueError):
+            return None
+        t = ctype.timestamps
+        v = np.broadcast_to(v, t.shape)
+        if self.invalid is not None:
+            valid = ~np.broadcast_to(self.invalid, t.shape)
+            if mask is None:
+                mask = valid
+            else:
+                mask = mask & valid
+        if v.dtype.kind == 'f':
+            # domain errors such as sqrt(-1) raise ValueError when
+            # evaluating one message, so those rows are dropped too
+            if mask is None:
+                mask = np.isfinite(v)
+            else:
+                mask = mask & np.isfinite(v)
+        if mask is not None:
+            t = t[mask]
+            v = v[mask]
+        return (t, v)
+
+    def add_invalid(self, rows):
+        '''note rows which have no value'''
+        if self.invalid is None:
+            self.invalid = rows
+        else:
+            self.invalid = np.logical_or(self.invalid, rows)
+
+    def eval_node(self, node, ctype):
+        if isinstance(node, ast.Constant):
+            return node.value
+        if isinstance(node, ast.BinOp):
+            left = self.eval_node(node.left, ctype)
+            right = self.eval_node(node.right, ctype)
+            if isinstance(node.op, (ast.Div, ast.Mod)):
+                self.add_invalid(np.equal(right, 0))
+            elif isinstance(node.op, ast.Pow):
+                self.add_invalid(np.logical_and(np.equal(left, 0), np.less(right, 0)))
+            return binary_ops[type(node.op)](left, right)
+        if isinstance(node, ast.UnaryOp):
+            return unary_ops[type(node.op)](self.eval_node(node.operand, ctype))
+        if isinstance(node, ast.Call):
+            args = [self.eval_node(a, ctype) for a in node.args]
+            return array_functions[node.func.id](*args)
+        v = ctype.column(node.attr)
+        if v is None:
+            raise KeyError(node.attr)
+        return v
+
+
+def columnar_log(mlog):
+    '''return the ColumnarLog for a log, creating it on first use'''
+    clog = getattr(mlog, '_columnar', None)
+    if clog is None:
+        clog = ColumnarLog(mlog)
+        mlog._columnar = clog
+    return clog
@@ -5,6 +5,7 @@
 '''
 
 import ast
+import bisect
 import sys, struct, time, os, datetime, platform
 import math, re
 import matplotlib
@@ -18,11 +19,19 @@ from math import *
 from pymavlink.mavextra import *
 import matplotlib.pyplot as plt
 from pymavlink import mavutil
+from pymavlink import DFReader
 import threading
 import numpy as np
+from MAVProxy.modules.lib import columnar
+from MAVProxy.modules.lib import mp_expression
+from MAVProxy.modules.lib import multiproc
+from MAVProxy.modules.lib.multiproc_util import MPDataLogChildTask
 
 MAVGRAPH_DEBUG = 'MAVGRAPH_DEBUG' in os.environ
 
+# smallest part of a log worth processing in its own process
+MIN_SHARD_SIZE = 8*1024*1024
+
 colors = [ 'red', 'green', 'blue', 'orange', 'olive', 'black', 'grey', 'yellow', 'brown', 'darkcyan',
            'cornflowerblue', 'darkmagenta', 'deeppink', 'darkred']
 
@@ -125,6 +134,7 @@ class MavGraph(object):
         else:
             self.text_types = frozenset([unicode, str])
         self.max_message_rate = 0
+        self.max_processes = 1
 
     def set_max_message_rate(self, rate_hz):
         '''set maximum rate we will graph any message'''
@@ -436,7 +446,7 @@ class MavGraph(object):
         '''add some data'''
         mtype = msg.get_type()
         for i in range(0, len(self.fields)):
-            if mtype not in self.field_types[i]:
+            if mtype not in self.field_types[i] or self.columnar_done[i]:
                 continue
             f = self.fields[i]
             has_instance = False
@@ -479,7 +489,7 @@ class MavGraph(object):
                         print(ex)
             if v is None:
                 try:
-                    v = mavutil.evaluate_expression(f, vars)
+                    v = mp_expression.evaluate_expression(f, vars)
                 except Exception as ex:
                     if MAVGRAPH_DEBUG:
                         print(ex)
@@ -488,16 +498,45 @@ class MavGraph(object):
             if self.xaxis is None:
                 xv = t
             else:
-                xv = mavutil.evaluate_expression(self.xaxis, vars)
+                xv = mp_expression.evaluate_expression(self.xaxis, vars)
                 if xv is None:
                     continue
             self.y[i].append(v)
             self.x[i].append(xv)
 
-    def process_mav(self, mlog, flightmode_selections):
-        '''process one file'''
+    def process_columnar(self, mlog, flightmode_selections, all_false):
+        '''evaluate fields which only use one message type as array
+        operations, marking them in columnar_done'''
+        clog = columnar.columnar_log(mlog)
+        for i in range(self.num_fields):
+            expr = columnar.ColumnarExpression(self.fields[i])
+            if not expr.valid():
+                continue
+            r = expr.evaluate(clog)
+            if r is None:
+                continue
+            (t, v) = r
+            if not all_false and len(flightmode_selections) > 0:
+                mask = np.zeros(len(t), dtype=bool)
+                for (selected, (mode, t0, t1)) in zip(flightmode_selections, self.flightmode_list):
+                    if selected:
+                        mask |= (t >= t0) & (t < t1)
+                t = t[mask]
+                v = v[mask]
+            if len(t) > 0:
+                timestamp_to_days(t[0], self.timeshift)
+                if tday_base is None:
+                    continue
+                tdays = tday_base + (t - tday_basetime) * (1.0 / (60*60*24))
+                self.x[i].extend(tdays.tolist())
+                self.y[i].extend(v.tolist())
+            self.columnar_done[i] = True
+
+    def process_mav(self, mlog, flightmode_selections, jobs=None):
+        '''process one file. If jobs is a list and the log can be split,
+        MavGraphShard tasks for the per-message work are added to it
+        rather than processing the messages here'''
         self.vars = {}
-        idx = 0
         all_false = True
         for s in flightmode_selections:
             if s:
@@ -543,19 +582,57 @@ class MavGraph(object):
         except Exception:
             pass
 
-        all_messages = {}
+        # fields using a single message type can be evaluated by column
+        # when there is no per-message state involved
+        self.columnar_done = [False] * self.num_fields
+        if (not self.condition and self.xaxis is None and self.max_message_rate <= 0 and
+                columnar.ColumnarLog.supported(mlog)):
+            self.process_columnar(mlog, flightmode_selections, all_false)
+        msg_types = set()
+        for i in range(self.num_fields):
+            if not self.columnar_done[i]:
+                msg_types = msg_types.union(self.field_types[i])
+        if len(msg_types) == 0:
+            return
+
+        if jobs is not None and (all_false or len(flightmode_selections) == 0):
+            shards = self.shard_ranges(mlog)
+            if shards is None:
+                # keep files in order when mixed with split logs
+                self.run_jobs(jobs)
+                del jobs[:]
+            elif len(shards) > 1 or len(self.mav_list) > 1:
+                if tday_base is None:
+                    # all shards must share the same time base
+                    mlog.rewind()
+                    msg = mlog.recv_match(type=msg_types)
+                    mlog.rewind()
+                    if msg is not None:
+                        timestamp_to_days(msg._timestamp, self.timeshift)
+                state = self.shard_state()
+                for shard in shards:
+                    jobs.append(MavGraphShard(mlog=mlog, graph_state=state, msg_types=msg_types, shard=shard,
+                                              tday_base=tday_base, tday_basetime=tday_basetime))
+                return
+
+        self.process_messages(mlog, flightmode_selections, msg_types, {}, all_false)
 
+    def process_messages(self, mlog, flightmode_selections, msg_types, all_messages, all_false, recv=None):
+        '''process messages from the current position of a log'''
+        if recv is None:
+            recv = mlog.recv_match
+        idx = 0
         while True:
-            msg = mlog.recv_match(type=self.msg_types)
+            msg = recv(type=msg_types)
             if msg is None:
                 break
             mtype = msg.get_type()
             if not mtype in all_messages or not isinstance(all_messages[mtype],dict):
                 all_messages[mtype] = msg
-            if mtype not in self.msg_types:
+            if mtype not in msg_types:
                 continue
             if self.condition:
-                if not mavutil.evaluate_condition(self.condition, all_messages):
+                if not mp_expression.evaluate_condition(self.condition, all_messages):
                     continue
             tdays = timestamp_to_days(msg._timestamp, self.timeshift)
 
@@ -567,6 +644,68 @@ class MavGraph(object):
                 elif (idx < len(flightmode_selections) and flightmode_selections[idx]):
                     self.add_data(tdays, msg, all_messages)
 
+    def shard_state(self):
+        '''return the attributes a MavGraphShard needs to process messages.
+        The graph itself holds the logs and plot state, which can't be
+        passed to a spawned process'''
+        names = ['fields', 'field_types', 'instance_types', 'columnar_done', 'simple_field',
+                 'condition', 'xaxis', 'timeshift', 'max_message_rate', 'num_fields']
+        return dict([(name, getattr(self, name)) for name in names])
+
+    def set_max_processes(self, nproc):
+        '''set the number of processes used to extract data, 0 for one
+        per CPU'''
+        if nproc <= 0:
+            nproc = os.cpu_count() or 1
+        self.max_processes = nproc
+
+    def shard_ranges(self, mlog):
+        '''return the byte ranges to split a log into for parallel
+        processing, or None if it can't be split'''
+        if (self.max_processes <= 1 or os.name == 'nt' or
+                getattr(mlog, 'data_map', None) is None or not hasattr(mlog, 'offsets')):
+            return None
+        data_len = mlog.data_len
+        nshards = min(self.max_processes, data_len // MIN_SHARD_SIZE)
+        if nshards <= 1:
+            return [(0, data_len)]
+        step = data_len // nshards
+        ret = []
+        for i in range(nshards):
+            start = i * step
+            end = start + step
+            if i == nshards - 1:
+                end = data_len
+            ret.append((start, end))
+        return ret
+
+    def run_jobs(self, jobs):
+        '''run MavGraphShard tasks with at most max_processes at once,
+        merging the results in order'''
+        running = []
+        for job in jobs:
+            if len(running) >= self.max_processes:
+                self.merge_job(running.pop(0))
+            job.start()
+            running.append(job)
+        while len(running) > 0:
+            self.merge_job(running.pop(0))
+
+    def merge_job(self, job):
+        '''wait for a shard to complete and add its data'''
+        try:
+            (x, y) = job.result_recv.recv()
+        except (EOFError, OSError):
+            print("Graph processing failed for part of log")
+            x = y = None
+        job.close()
+        job.result_recv.close()
+        if x is None:
+            return
+        for i in range(len(x)):
+            self.x[i].extend(x[i])
+            self.y[i].extend(y[i])
+
     def xlim_change_check(self, idx):
         '''handle xlim change requests from queue'''
         try:
@@ -625,9 +764,14 @@ class MavGraph(object):
 
         timeshift = self.timeshift
 
+        jobs = None
+        if self.max_processes > 1:
+            jobs = []
         for fi in range(0, len(self.mav_list)):
             mlog = self.mav_list[fi]
-            self.process_mav(mlog, flightmode_selections)
+            self.process_mav(mlog, flightmode_selections, jobs=jobs)
+        if jobs:
+            self.run_jobs(jobs)
 
 
     def show(self, lenmavlist, block=True, xlim_pipe=None, output=None):
@@ -690,6 +834,123 @@ class MavGraph(object):
         else:
             plt.savefig(output, bbox_inches='tight', dpi=200)
 
+class MavGraphShard(MPDataLogChildTask):
+    '''extract the data for a MavGraph from a byte range of a log in a
+    child process'''
+
+    def __init__(self, *args, **kwargs):
+        '''
+        Parameters
+        ----------
+        mlog : DFReader / mavmmaplog
+            A dataflash or telemetry log
+        graph_state : dict
+            Attributes of the MavGraph being processed, from shard_state
+        msg_types : set
+            Message types needed by fields not already processed
+        shard : tuple
+            Start and end byte offsets
+        tday_base, tday_basetime : float
+            The time base shared by all shards
+        '''
+        super(MavGraphShard, self).__init__(*args, **kwargs)
+        self.graph_state = kwargs['graph_state']
+        self.msg_types = kwargs['msg_types']
+        self.shard = kwargs['shard']
+        self.tday_base = kwargs['tday_base']
+        self.tday_basetime = kwargs['tday_basetime']
+        self.result_recv, self.result_send = multiproc.Pipe(duplex=False)
+
+    def start(self):
+        super(MavGraphShard, self).start()
+        self.result_send.close()
+
+    def seek(self):
+        '''limit the log to messages in the shard, returning the last
+        message of each type before the shard'''
+        mlog = self.mlog
+        (start, end) = self.shard
+        mlog.rewind()
+        types = set(self.msg_types)
+        if isinstance(mlog, DFReader.DFReader):
+            types.update(['MODE', 'MSG', 'PARM', 'STAT', 'ORGN', 'VER'])
+        else:
+            types.update(['HEARTBEAT', 'PARAM_VALUE'])
+        if isinstance(mlog.counts, dict):
+            counts = dict(mlog.counts)
+        else:
+            counts = list(mlog.counts)
+        type_nums = []
+        indexes = []
+        previous = {}
+        for t in types:
+            if t not in mlog.name_to_id:
+                continue
+            mtype = mlog.name_to_id[t]
+            offsets = mlog.offsets[mtype]
+            i0 = bisect.bisect_left(offsets, start)
+            counts[mtype] = bisect.bisect_left(offsets, end)
+            type_nums.append(mtype)
+            indexes.append(i0)
+            if i0 > 0 and t in self.msg_types:
+                # seed expression state with the message before the shard
+                if isinstance(mlog, DFReader.DFReader):
+                    mlog.offset = offsets[i0-1]
+                    m = mlog._parse_next()
+                else:
+                    mlog.f.seek(offsets[i0-1])
+                    m = mlog.recv_msg()
+                if m is not None:
+                    previous[t] = m
+        # this is our own copy of the log, so the counts can be cut short
+        mlog.counts = counts
+        self.all_types = set([mlog.id_to_name[mtype] for mtype in type_nums])
+        mlog.type_nums = type_nums
+        mlog.indexes = indexes
+        return previous
+
+    def recv_match(self, type=None):
+        '''recv_match limited to the shard. mavmmaplog carries on reading
+        past the last indexed message, so all indexed types are requested
+        and we stop when the indexes run out'''
+        mlog = self.mlog
+        while True:
+            remaining = False
+            for i in range(len(mlog.type_nums)):
+                if mlog.indexes[i] < mlog.counts[mlog.type_nums[i]]:
+                    remaining = True
+                    break
+            if not remaining:
+                return None
+            m = mlog.recv_match(type=self.all_types)
+            if m is None or m.get_type() in type:
+                return m
+
+    # @override
+    def child_task(self):
+        '''process the shard and send back the data'''
+        global tday_base, tday_basetime
+        # a spawned process doesn't inherit the time base
+        tday_base = self.tday_base
+        tday_basetime = self.tday_basetime
+        g = MavGraph()
+        g.__dict__.update(self.graph_state)
+        g.x = [[] for i in range(len(g.fields))]
+        g.y = [[] for i in range(len(g.fields))]
+        try:
+            reset_state_data()
+        except Exception:
+            pass
+        if not isinstance(self.mlog, DFReader.DFReader):
+            # tlogs are read through the file object, whose offset is
+            # shared with the parent and the other shards
+            self.mlog.f = open(self.mlog.filename, 'rb')
+        all_messages = self.seek()
+        g.process_messages(self.mlog, [], self.msg_types, all_messages, True, recv=self.recv_match)
+        self.result_send.send((g.x, g.y))
+        self.result_send.close()
+
+
 if __name__ == "__main__":
     from argparse import ArgumentParser
     parser = ArgumentParser(description=__doc__)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+'''
+a set of integers stored as sorted, non-overlapping half open ranges
+
+used to track which parts of a file have been received during a
+download, so that memory and the cost of finding the missing parts
+depend on the number of gaps rather than on the size of the file
+
+AP_FLAKE8_CLEAN
+'''
+
+import bisect
+import json
+import os
+
+
+class IntervalSet(object):
+    '''sorted non-overlapping [start, end) ranges'''
+    def __init__(self, ranges=None):
+        self.starts = []
+        self.ends = []
+        if ranges is not None:
+            for (start, end) in ranges:
+                self.add(start, end)
+
+    def add(self, start, end):
+        '''add the range [start, end)'''
+        if end <= start:
+            return
+        # first range which ends at or after start, so may be merged
+        i = bisect.bisect_left(self.ends, start)
+        # first range which starts after end, so can't be merged
+        j = bisect.bisect_right(self.starts, end)
+        if i < j:
+            start = min(start, self.starts[i])
+            end = max(end, self.ends[j-1])
+        self.starts[i:j] = [start]
+        self.ends[i:j] = [end]
+
+    def remove(self, start, end):
+        '''remove the range [start, end)'''
+        if end <= start:
+            return
+        # ranges which overlap [start, end)
+        i = bisect.bisect_right(self.ends, start)
+        j = bisect.bisect_left(self.starts, end)
+        if i >= j:
+            return
+        starts = []
+        ends = []
+        if self.starts[i] < start:
+            starts.append(self.starts[i])
+            ends.append(start)
+        if self.ends[j-1] > end:
+            starts.append(end)
+            ends.append(self.ends[j-1])
+        self.starts[i:j] = starts
+        self.ends[i:j] = ends
+
+    def overlaps(self, start, end):
+        '''return True if any of [start, end) is in the set'''
+        i = bisect.bisect_right(self.ends, start)
+        return i < len(self.starts) and self.starts[i] < end
+
+    def contains(self, start, end):
+        '''return True if all of [start, end) is in the set'''
+        i = bisect.bisect_right(self.starts, start) - 1
+        return i >= 0 and self.ends[i] >= end
+
+    def total(self):
+        '''total length of all ranges'''
+        return sum(self.ends) - sum(self.starts)
+
+    def highest(self):
+        '''end of the last range, or 0 if empty'''
+        if len(self.ends) == 0:
+            return 0
+        return self.ends[-1]
+
+    def count(self):
+        '''number of ranges'''
+        return len(self.starts)
+
+    def ranges(self):
+        '''return the ranges as a list of (start, end)'''
+        return list(zip(self.starts, self.ends))
+
+    def gaps(self, end=None, max_gaps=None):
+        '''return up to max_gaps missing ranges below end, which defaults to
+        the end of the last range'''
+        if end is None:
+            end = self.highest()
+        ret = []
+        pos = 0
+        for i in range(len(self.starts)):
+            if self.starts[i] >= end:
+                break
+            if self.starts[i] > pos:
+                ret.append((pos, self.starts[i]))
+                if max_gaps is not None and len(ret) >= max_gaps:
+                    return ret
+            pos = self.ends[i]
+        if pos < end:
+            ret.append((pos, end))
+        if max_gaps is not None:
+            ret = ret[:max_gaps]
+        return ret
+
+    def missing(self, end=None):
+        '''total length of the gaps below end'''
+        return sum(e - s for (s, e) in self.gaps(end))
+
+    def __len__(self):
+        return self.total()
+
+    def save(self, filename, extra=None):
+        '''save the ranges along with extra information as json, replacing
+        the file atomically'''
+        d = {}
+        if extra is not None:
+            d.update(extra)
+        d['ranges'] = self.ranges()
+        tmp = filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(d, f)
+        os.replace(tmp, filename)
+
+    @staticmethod
+    def load(filename):
+        '''load ranges saved with save(), returning (IntervalSet, extra) or
+        (None, None) if the file is missing or invalid'''
+        try:
+            with open(filename, 'r') as f:
+                d = json.load(f)
+            iset = IntervalSet(d.pop('ranges'))
+        except (OSError, ValueError, KeyError, TypeError):
+            return (None, None)
+        return (iset, d)
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+'''
+persistent per-message-type index for dataflash and telemetry logs
+
+pymavlink builds an in-memory table of file offsets for each message
+type when a log is opened, which means parsing the whole file on every
+load. The readers here save that table, plus a sparse table of
+timestamps, next to the log (e.g. log.bin.idx) and restore it on the
+next load, only parsing the handful of messages needed to rebuild the
+formats. The timestamp table allows seek_time() to start a
+recv_match() for a set of types part way through the log
+
+AP_FLAKE8_CLEAN
+'''
+
+import array
+import bisect
+import json
+import os
+import struct
+
+from pymavlink import mavutil
+from pymavlink import DFReader
+
+INDEX_MAGIC = b'MAVIDX1\n'
+INDEX_VERSION = 1
+
+# one timestamp is kept for every TIME_STRIDE messages of a type
+TIME_STRIDE = 256
+
+
+def index_path(filename):
+    '''return path of the index file for a log'''
+    return filename + '.idx'
+
+
+class LogIndex(object):
+    '''offset and timestamp index for one log file'''
+    def __init__(self, filename, kind):
+        self.filename = filename
+        self.path = index_path(filename)
+        self.kind = kind
+        self.loaded = False
+        self.offsets = {}
+        self.samples = {}
+        self.extra = {}
+
+    def file_id(self):
+        '''return size and modification time used to validate the index'''
+        st = os.stat(self.filename)
+        return (st.st_size, st.st_mtime_ns)
+
+    def load(self):
+        '''load the index from disk, returning True if it is valid for the log'''
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return False
+        try:
+            if not data.startswith(INDEX_MAGIC):
+                return False
+            ofs = len(INDEX_MAGIC)
+            (hlen,) = struct.unpack_from('<I', data, ofs)
+            ofs += 4
+            header = json.loads(data[ofs:ofs+hlen].decode('utf-8'))
+            ofs += hlen
+            (size, mtime_ns) = self.file_id()
+            if (header['version'] != INDEX_VERSION or header['kind'] != self.kind or
+                    header['size'] != size or header['mtime_ns'] != mtime_ns):
+                return False
+            code = header['offset_code']
+            itemsize = array.array(code).itemsize
+            for (mtype, count, nsamples) in header['types']:
+                a = array.array(code)
+                a.frombytes(data[ofs:ofs+count*itemsize])
+                ofs += count * itemsize
+                s = array.array('Q')
+                s.frombytes(data[ofs:ofs+nsamples*8])
+                ofs += nsamples * 8
+                self.offsets[mtype] = a
+                self.samples[mtype] = s
+            self.extra = header.get('extra', {})
+        except Exception as ex:
+            print("Bad log index %s: %s" % (self.path, ex))
+            self.offsets = {}
+            self.samples = {}
+            return False
+        self.loaded = True
+        return True
+
+    def save(self):
+        '''write the index next to the log'''
+        (size, mtime_ns) = self.file_id()
+        if size < 2**32:
+            code = 'I'
+        else:
+            code = 'Q'
+        types = []
+        blobs = []
+        for mtype in sorted(self.offsets.keys()):
+            offsets = self.offsets[mtype]
+            if not isinstance(offsets, array.array) or offsets.typecode != code:
+                offsets = array.array(code, offsets)
+            samples = self.samples.get(mtype, array.array('Q'))
+            types.append((mtype, len(offsets), len(samples)))
+            blobs.append(offsets.tobytes())
+            blobs.append(samples.tobytes())
+        header = {
+            'version': INDEX_VERSION,
+            'kind': self.kind,
+            'size': size,
+            'mtime_ns': mtime_ns,
+            'offset_code': code,
+            'types': types,
+            'extra': self.extra,
+        }
+        hdata = json.dumps(header).encode('utf-8')
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(INDEX_MAGIC)
+                f.write(struct.pack('<I', len(hdata)))
+                f.write(hdata)
+                for b in blobs:
+                    f.write(b)
+            os.replace(tmp, self.path)
+        except (IOError, OSError) as ex:
+            print("Unable to save log index %s: %s" % (self.path, ex))
+
+    def start_index(self, mtype, tstamp):
+        '''return the index of the first message of mtype that could have
+        a raw timestamp >= tstamp'''
+        samples = self.samples.get(mtype, None)
+        if samples is None or len(samples) == 0:
+            return 0
+        i = bisect.bisect_left(samples, tstamp)
+        # start a sample early, as the samples are only approximately
+        # in timestamp order and messages between samples may be older
+        return max(0, i - 2) * TIME_STRIDE
+
+
+def seek_types(mlog, type_nums, start_indexes):
+    '''set up the reader so the next recv_match() using these types
+    starts at the given per-type message indexes'''
+    mlog.type_nums = type_nums
+    mlog.indexes = start_indexes
+
+
+class DFReader_indexed(DFReader.DFReader_binary):
+    '''a binary dataflash reader which keeps a persistent index'''
+    def __init__(self, filename, zero_time_base=False, progress_callback=None):
+        self.log_index = LogIndex(filename, 'df')
+        DFReader.DFReader_binary.__init__(self, filename, zero_time_base=zero_time_base,
+                                          progress_callback=progress_callback)
+        if not self.log_index.loaded:
+            self.save_index()
+
+    def init_arrays(self, progress_callback=None):
+        if self.log_index.load() and self.restore_index():
+            return
+        DFReader.DFReader_binary.init_arrays(self, progress_callback=progress_callback)
+
+    def init_arrays_fast(self, progress_callback=None):
+        if self.log_index.load() and self.restore_index():
+            return
+        DFReader.DFReader_binary.init_arrays_fast(self, progress_callback=progress_callback)
+
+    def parse_at(self, ofs):
+        self.offset = ofs
+        self.remaining = self.data_len - ofs
+        return self._parse_next()
+
+    def restore_index(self):
+        '''rebuild reader state from the loaded index'''
+        idx = self.log_index
+        offsets = [[] for i in range(256)]
+        for (mtype, a) in idx.offsets.items():
+            offsets[int(mtype)] = a
+        self.name_to_id = {}
+        self.id_to_name = {}
+        self.offsets = offsets
+        self.counts = [len(offsets[i]) for i in range(256)]
+        self._count = sum(self.counts)
+
+        # FMT messages first to rebuild formats
+        for ofs in offsets[0x80]:
+            self.parse_at(ofs)
+        for (mtype, fmt) in self.formats.items():
+            self.name_to_id[fmt.name] = mtype
+            self.id_to_name[mtype] = fmt.name
+
+        # then units and multipliers, needed by FMTU
+        if 'UNIT' in self.name_to_id:
+            for ofs in offsets[self.name_to_id['UNIT']]:
+                m = self.parse_at(ofs)
+                if m is not None:
+                    self.unit_lookup[chr(m.Id)] = m.Label
+        if 'MULT' in self.name_to_id:
+            for ofs in offsets[self.name_to_id['MULT']]:
+                m = self.parse_at(ofs)
+                if m is not None:
+                    self.mult_lookup[chr(m.Id)] = float("%.7g" % m.Mult)
+        if 'FMTU' in self.name_to_id:
+            for ofs in offsets[self.name_to_id['FMTU']]:
+                self.parse_at(ofs)
+
+        # the first message of each type and of each instance
+        for ofs in idx.extra.get('parse', []):
+            self.parse_at(ofs)
+        self.offset = 0
+        return True
+
+    def save_index(self):
+        '''save the index built by pymavlink'''
+        idx = self.log_index
+        idx.offsets = {}
+        idx.samples = {}
+        parse = []
+        for mtype in range(256):
+            offsets = self.offsets[mtype]
+            if len(offsets) == 0:
+                continue
+            idx.offsets[mtype] = offsets
+            if mtype == 0x80:
+                continue
+            fmt = self.formats.get(mtype, None)
+            if fmt is None:
+                continue
+            parse.append(offsets[0])
+            if fmt.instance_field is not None:
+                n = len(offsets)
+                if fmt.instance_len == 1:
+                    n = min(n, 100)
+                seen = set()
+                for i in range(n):
+                    ofs = offsets[i]
+                    idata = self.data_map[ofs+3+fmt.instance_ofs:ofs+3+fmt.instance_ofs+fmt.instance_len]
+                    if idata not in seen:
+                        seen.add(idata)
+                        if i != 0:
+                            parse.append(ofs)
+            if 'TimeUS' in fmt.colhash:
+                col = fmt.colhash['TimeUS']
+                if DFReader.FORMAT_TO_STRUCT[fmt.format[col]][0] != 'Q':
+                    continue
+                tofs = 3 + sum(struct.calcsize(DFReader.FORMAT_TO_STRUCT[c][0]) for c in fmt.format[:col])
+                samples = array.array('Q')
+                for i in range(0, len(offsets), TIME_STRIDE):
+                    samples.append(struct.unpack_from('<Q', self.data_map, offsets[i]+tofs)[0])
+                idx.samples[mtype] = samples
+        idx.extra = {'parse': sorted(parse)}
+        idx.save()
+
+    def seek_time(self, types, tstart):
+        '''position the reader so recv_match(type=types) starts near tstart'''
+        self.rewind()
+        type_nums = []
+        start_indexes = []
+        tset = set(types)
+        tset.update(set(['MODE', 'MSG', 'PARM', 'STAT', 'ORGN', 'VER']))
+        for t in tset:
+            if t not in self.name_to_id:
+                continue
+            mtype = self.name_to_id[t]
+            start = 0
+            samples = self.log_index.samples.get(mtype, None)
+            if t in types and samples is not None and len(samples) > 0:
+                # map wallclock time to TimeUS using the first message
+                m = self.parse_at(self.offsets[mtype][0])
+                if m is not None:
+                    base = m._timestamp - m.TimeUS * 1.0e-6
+                    start = self.log_index.start_index(mtype, int((tstart - base) * 1.0e6))
+            type_nums.append(mtype)
+            start_indexes.append(min(start, self.counts[mtype]))
+        self.rewind()
+        seek_types(self, type_nums, start_indexes)
+
+
+class mavmmaplog_indexed(mavutil.mavmmaplog):
+    '''a telemetry log reader which keeps a persistent index'''
+    def __init__(self, filename, progress_callback=None):
+        self.log_index = LogIndex(filename, 'tlog')
+        mavutil.mavmmaplog.__init__(self, filename, progress_callback=progress_callback)
+        if self.data_map is not None and not self.log_index.loaded:
+            self.save_index()
+
+    def init_arrays(self, progress_callback=None):
+        if self.log_index.load() and self.restore_index():
+            return
+        mavutil.mavmmaplog.init_arrays(self, progress_callback=progress_callback)
+
+    def restore_index(self):
+        '''rebuild reader state from the loaded index'''
+        idx = self.log_index
+        mavlink_map = mavutil.mavlink.mavlink_map
+        self.offsets = {}
+        self.counts = {}
+        self._count = 0
+        self.name_to_id = {}
+        self.id_to_name = {}
+        self.instance_offsets = {}
+        self.instance_lengths = {}
+        self.type_nums = None
+        for (mtype, a) in idx.offsets.items():
+            mtype = int(mtype)
+            if mtype not in mavlink_map:
+                # index was built with a different dialect
+                return False
+            self.offsets[mtype] = a
+            self.counts[mtype] = len(a)
+            msg = mavlink_map[mtype]
+            self.name_to_id[msg.msgname] = mtype
+            self.id_to_name[mtype] = msg.msgname
+            self.f.seek(a[0])
+            m = self.recv_msg()
+            if m is None:
+                return False
+            mavutil.add_message(self.messages, msg.msgname, m)
+        for iname in idx.extra.get('instances', []):
+            mname = iname.split('[')[0]
+            if mname in self.messages:
+                self.messages[iname] = self.messages[mname]
+        self._count = sum(self.counts.values())
+        self.offset = 0
+        self._rewind()
+        return True
+
+    def save_index(self):
+        '''save the index built by pymavlink'''
+        idx = self.log_index
+        idx.offsets = {}
+        idx.samples = {}
+        for (mtype, offsets) in self.offsets.items():
+            idx.offsets[mtype] = offsets
+            samples = array.array('Q')
+            for i in range(0, len(offsets), TIME_STRIDE):
+                samples.append(struct.unpack_from('>Q', self.data_map, offsets[i])[0])
+            idx.samples[mtype] = samples
+        instances = [k for k in self.messages.keys() if k.find('[') != -1 and k.split('[')[0] in self.name_to_id]
+        idx.extra = {'instances': instances}
+        idx.save()
+
+    def seek_time(self, types, tstart):
+        '''position the reader so recv_match(type=types) starts near tstart'''
+        self._rewind()
+        type_nums = []
+        start_indexes = []
+        tset = set(types)
+        tset.update(set(['HEARTBEAT', 'PARAM_VALUE']))
+        for t in tset:
+            if t not in self.name_to_id:
+                continue
+            mtype = self.name_to_id[t]
+            start = 0
+            if t in types:
+                start = self.log_index.start_index(mtype, int(tstart * 1.0e6))
+            type_nums.append(mtype)
+            start_indexes.append(min(start, self.counts[mtype]))
+        seek_types(self, type_nums, start_indexes)
+
+
+def open_log(filename, progress_callback=None):
+    '''open a log for reading, using an indexed reader where possible'''
+    lname = filename.lower()
+    if lname.endswith('.bin') or lname.endswith('.px4log'):
+        m = DFReader_indexed(filename, progress_callback=progress_callback)
+    elif lname.endswith('.tlog') and os.path.getsize(filename) > 0:
+        m = mavmmaplog_indexed(filename, progress_callback=progress_callback)
+    else:
+        return mavutil.mavlink_connection(filename, notimestamps=False,
+                                          zero_time_base=False,
+                                          progress_callback=progress_callback)
+    # as mavlink_connection does, for the mavextra functions
+    mavutil.mavfile_global = m
+    return m
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+'''
+on-disk cache of mission, fence and rally items
+
+items are stored per vehicle and mission type in the same layout as the
+@MISSION files used for MAVLink FTP transfers, a 10 byte header followed
+by packed MISSION_ITEM_INT messages. An entry records the number of
+items and a CRC of the vehicle's copy of the items, and is only trusted
+when the CRC the vehicle calculates over its @MISSION file matches
+
+AP_FLAKE8_CLEAN
+'''
+
+import binascii
+import json
+import os
+import struct
+import time
+
+from pymavlink import mavutil
+from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib.param_cache import ftp_crc32
+
+MISSION_MAGIC = 0x763d
+HEADER_LEN = 10
+
+
+def pack_items(mission_type, items):
+    '''pack a list of MISSION_ITEM_INT messages in @MISSION file format'''
+    mavmsg = mavutil.mavlink.MAVLink_mission_item_int_message
+    buf = bytearray(struct.pack("<HHHHH", MISSION_MAGIC, mission_type, 0, 0, len(items)))
+    for w in items:
+        tlist = []
+        for field in mavmsg.ordered_fieldnames:
+            tlist.append(getattr(w, field))
+        buf += mavmsg.unpacker.pack(*tlist)
+    return bytes(buf)
+
+
+def unpack_items(data, mission_type):
+    '''unpack data in @MISSION file format into a list of MISSION_ITEM_INT
+    messages. Returns (items, error) where error is None on success'''
+    if len(data) < HEADER_LEN:
+        return (None, "short data")
+    magic, dtype, options, start, num_items = struct.unpack("<HHHHH", data[0:HEADER_LEN])
+    if magic != MISSION_MAGIC:
+        return (None, "bad magic 0x%x expected 0x%x" % (magic, MISSION_MAGIC))
+    if dtype != mission_type:
+        return (None, "bad data type %u" % dtype)
+    mavmsg = mavutil.mavlink.MAVLink_mission_item_int_message
+    item_size = mavmsg.unpacker.size
+    items = []
+    for ofs in range(HEADER_LEN, len(data) - item_size + 1, item_size):
+        t = mavmsg.unpacker.unpack(data[ofs:ofs+item_size])
+        tlist = list(t)
+        for i in range(0, len(tlist)):
+            tlist[i] = t[mavmsg.orders[i]]
+        items.append(mavmsg(*tlist))
+    return (items, None)
+
+
+def item_key(w):
+    '''return the packed content of a MISSION_ITEM_INT, ignoring the
+    fields which are not stored by the vehicle, for comparing items'''
+    mavmsg = mavutil.mavlink.MAVLink_mission_item_int_message
+    tlist = []
+    for field in mavmsg.ordered_fieldnames:
+        if field in ['target_system', 'target_component', 'current']:
+            tlist.append(0)
+        else:
+            tlist.append(getattr(w, field))
+    return mavmsg.unpacker.pack(*tlist)
+
+
+def items_crc(mission_type, items):
+    '''CRC of items packed in @MISSION file format using their comparison
+    keys. This is used when the CRC of the vehicle's file is not known,
+    and may not match it exactly'''
+    header = struct.pack("<HHHHH", MISSION_MAGIC, mission_type, 0, 0, len(items))
+    return ftp_crc32(header + b''.join(item_key(w) for w in items))
+
+
+class MissionCache(object):
+    '''item cache files, one per vehicle and mission type'''
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = mp_util.dot_mavproxy("missioncache")
+        self.directory = directory
+
+    def filename(self, key, mission_type):
+        return os.path.join(self.directory, "%s_type%u.json" % (key, mission_type))
+
+    def load(self, key, mission_type):
+        '''return (items, crc) for a vehicle, or None'''
+        try:
+            with open(self.filename(key, mission_type), 'r') as f:
+                entry = json.load(f)
+            data = binascii.unhexlify(entry['data'])
+            crc = entry['crc']
+            count = entry['count']
+        except (OSError, ValueError, KeyError, TypeError, binascii.Error):
+            return None
+        (items, error) = unpack_items(data, mission_type)
+        if error is not None or len(items) != count:
+            return None
+        return (items, crc)
+
+    def save(self, key, mission_type, items, crc):
+        '''save the items held on a vehicle along with the CRC of the
+        vehicle's @MISSION file'''
+        entry = {
+            'key': key,
+            'time': time.time(),
+            'count': len(items),
+            'crc': crc,
+            'data': binascii.hexlify(pack_items(mission_type, items)).decode('ascii'),
+        }
+        try:
+            mp_util.mkdir_p(self.directory)
+            tmp = self.filename(key, mission_type) + ".tmp"
+            with open(tmp, 'w') as f:
+                json.dump(entry, f)
+            os.replace(tmp, self.filename(key, mission_type))
+        except OSError as ex:
+            print("Failed to save mission cache: %s" % ex)
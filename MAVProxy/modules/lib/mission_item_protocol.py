@@ -14,8 +14,10 @@ import sys
 import time
 
 from pymavlink import mavutil
+from MAVProxy.modules.lib import mission_cache
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib import param_cache
 if mp_util.has_wxpython:
     from MAVProxy.modules.lib.mp_menu import MPMenuCallFileDialog
     from MAVProxy.modules.lib.mp_menu import MPMenuItem
@@ -29,6 +31,17 @@ except ImportError:
     from io import BytesIO as SIO
 
 
+# items between changes which are resent rather than starting another
+# partial write
+PARTIAL_MERGE_GAP = 4
+
+# seconds to wait for MISSION_ACK after sending the last item of an upload
+UPLOAD_ACK_TIMEOUT = 3
+
+# times a full upload is restarted if it is not acknowledged
+UPLOAD_RETRIES = 2
+
+
 class MissionItemProtocolModule(mp_module.MPModule):
     def __init__(self, mpstate, name, description, **args):
         super(MissionItemProtocolModule, self).__init__(mpstate, name, description, **args)
@@ -49,8 +62,22 @@ class MissionItemProtocolModule(mp_module.MPModule):
         self.undo_type = None
         self.undo_wp_idx = -1
         self.upload_start = None
+        self.upload_end = None
+        self.upload_ranges = []
+        self.upload_sent = None
+        self.upload_all = False
+        self.upload_ack_time = None
+        self.upload_retries = 0
+        # checking the vehicle CRC after a lost MISSION_ACK
+        self.upload_verify = False
         self.last_get_home = time.time()
         self.ftp_count = None
+        # per-sysid item keys as we believe they are held on the vehicle
+        self.vehicle_items_by_sysid = {}
+        self.cache = mission_cache.MissionCache()
+        self.cache_state = None
+        self.cache_time = None
+        self.cache_entry = None
 
         if self.continue_mode and self.logdir is not None:
             waytxt = os.path.join(mpstate.status.logdir, self.save_filename())
@@ -194,7 +221,7 @@ on'''
         ret = []
         tnow = time.time()
         next_seq = self.wploader.count()
-        for i in range(5):
+        for i in range(self.settings.wp_request_window):
             seq = next_seq+i
             if seq+1 > self.wploader.expected_count:
                 continue
@@ -254,6 +281,7 @@ on'''
             if self.wp_op is None:
                 if self.wploader.expected_count != m.count:
                     self.console.writeln("Mission is stale")
+                    self.vehicle_items_by_sysid.pop(self.target_system, None)
             else:
                 self.wploader.clear()
                 self.console.writeln("Requesting %u %s t=%s now=%s" % (
@@ -286,18 +314,14 @@ on'''
                 # print("m.seq=%u expected_count=%u" % (m.seq, self.wploader.expected_count))
                 self.send_wp_requests()
                 return
-            if self.wp_op == 'list':
-                self.show_and_save(m.get_srcSystem())
-                self.loading_waypoints = False
-            elif self.wp_op == "save":
-                self.save_waypoints(self.wp_save_filename)
-            self.wp_op = None
-            self.wp_requested = {}
-            self.wp_received = {}
+            self.download_done(m.get_srcSystem())
 
         elif mtype in frozenset(["MISSION_REQUEST", "MISSION_REQUEST_INT"]):
             self.process_waypoint_request(m, self.master)
 
+        elif mtype == 'MISSION_ACK':
+            self.process_mission_ack(m)
+
     def idle_task(self):
         '''handle missing waypoints'''
         if self.wp_period.trigger():
@@ -308,6 +332,16 @@ on'''
                 wps = self.missing_wps_to_request()
                 print("re-requesting %s %s" % (self.itemstype(), str(wps)))
                 self.send_wp_requests(wps)
+            if self.cache_state == 'crc' and time.time() - self.cache_time > 3:
+                # no CRC from the vehicle, download as usual
+                ftp = self.module('ftp')
+                if ftp is not None and ftp.crc_callback == self.cache_crc_callback:
+                    ftp.crc_cancel()
+                self.cache_state = None
+                self.request_list_send()
+            if (self.upload_ack_time is not None and
+                    time.time() - self.upload_ack_time > UPLOAD_ACK_TIMEOUT):
+                self.upload_ack_lost()
 
         self.idle_task_add_menu_items()
 
@@ -445,9 +479,44 @@ on'''
         # update the user on our progress:
         self.mpstate.console.set_status(self.itemtype(), '%s %u/%u' % (self.itemtype(), m.seq, self.wploader.count()-1))
 
-        # see if the transfer is complete:
-        if m.seq == self.wploader.count() - 1:
-            self.loading_waypoints = False
+        # the transfer is complete once the vehicle acknowledges the
+        # last item; it may still re-request it if it was lost
+        upload_end = self.upload_end
+        if upload_end is None:
+            upload_end = self.wploader.count() - 1
+        if m.seq == upload_end:
+            self.upload_ack_time = time.time()
+
+    def process_mission_ack(self, m):
+        '''process a MISSION_ACK for an upload in progress'''
+        if getattr(m, 'mission_type', 0) != self.mav_mission_type():
+            return
+        if (m.target_system != self.settings.source_system or
+                m.target_component != self.settings.source_component):
+            return
+        if not self.loading_waypoints:
+            return
+        if m.type != mavutil.mavlink.MAV_MISSION_ACCEPTED:
+            self.upload_error("result %u" % m.type)
+            return
+        self.upload_ack_time = None
+        if len(self.upload_ranges) > 0:
+            self.send_next_range()
+            return
+        self.upload_finished()
+
+    def upload_finished(self):
+        '''the vehicle has accepted all items of an upload'''
+        self.loading_waypoints = False
+        self.upload_verify = False
+        self.upload_end = None
+        if self.upload_sent is not None:
+            print("Sent %u changed of %u %s in %.2fs" % (
+                self.upload_sent,
+                self.wploader.count(),
+                self.itemstype(),
+                time.time() - self.upload_start))
+        else:
             print("Loaded %u %s in %.2fs" % (
                 self.wploader.count(),
                 self.itemstype(),
@@ -455,21 +524,139 @@ on'''
             self.console.writeln(
                 "Sent all %u %s" %
                 (self.wploader.count(), self.itemstype()))
+        self.upload_done()
+
+    def upload_ack_lost(self):
+        '''no acknowledgement of the last item sent. After the last range
+        of a partial upload the vehicle may hold the items with only the
+        MISSION_ACK lost, so compare its CRC before sending everything'''
+        self.upload_ack_time = None
+        ftp = self.module('ftp')
+        if (self.upload_sent is None or len(self.upload_ranges) > 0 or
+                ftp is None or not ftp.is_idle()):
+            self.upload_error("no acknowledgement")
+            return
+        self.upload_verify = True
+        ftp.cmd_crc([self.mission_ftp_name()], callback=self.upload_crc_callback)
+
+    def upload_crc_callback(self, crc):
+        '''callback with the CRC of the vehicle's items after a lost
+        MISSION_ACK'''
+        if not self.upload_verify or not self.loading_waypoints:
+            return
+        self.upload_verify = False
+        if crc is not None and crc == mission_cache.items_crc(self.mav_mission_type(), self.items_int()):
+            self.upload_finished()
+            return
+        self.upload_error("no acknowledgement")
+
+    def upload_error(self, reason):
+        '''an upload was rejected or not acknowledged. A partial upload
+        falls back to sending all items, a full upload is retried'''
+        self.upload_ack_time = None
+        self.upload_verify = False
+        # we no longer know what the vehicle holds
+        self.vehicle_items_by_sysid.pop(self.target_system, None)
+        if self.upload_sent is None and self.upload_retries >= UPLOAD_RETRIES:
+            print("Failed to send %s: %s" % (self.itemstype(), reason))
+            self.loading_waypoints = False
+            self.upload_all = False
+            self.upload_end = None
+            return
+        if self.upload_sent is None:
+            self.upload_retries += 1
+        print("Sending all %s: %s" % (self.itemstype(), reason))
+        self.upload_all = True
+        self.send_count()
 
     def send_all_waypoints(self):
         return self.send_all_items()
 
     def send_all_items(self):
-        '''send all waypoints to vehicle'''
+        '''send all waypoints to vehicle. If we know what the vehicle
+        holds and the count is unchanged then only changed items are sent'''
+        ranges = self.changed_ranges()
+        if ranges is not None and len(ranges) == 0:
+            print("%s unchanged" % self.itemstype())
+            return
+        self.upload_start = time.time()
+        self.upload_all = True
+        self.upload_retries = 0
+        self.upload_verify = False
+        if ranges is not None:
+            self.loading_waypoints = True
+            self.loading_waypoint_lasttime = time.time()
+            self.upload_ranges = ranges
+            self.upload_sent = 0
+            self.send_next_range()
+            return
+        self.send_count()
+
+    def send_count(self):
+        '''start an upload of all items'''
         self.loading_waypoints = True
         self.loading_waypoint_lasttime = time.time()
-        self.upload_start = time.time()
+        self.upload_ranges = []
+        self.upload_sent = None
+        self.upload_end = None
+        self.upload_ack_time = None
         self.master.mav.mission_count_send(
             self.target_system,
             self.target_component,
             self.wploader.count(),
             mission_type=self.mav_mission_type())
 
+    def send_next_range(self):
+        '''start a partial write of the next range of changed items'''
+        (start, end) = self.upload_ranges.pop(0)
+        self.upload_end = end
+        self.upload_ack_time = None
+        self.upload_sent += end - start + 1
+        self.loading_waypoint_lasttime = time.time()
+        self.master.mav.mission_write_partial_list_send(
+            self.target_system,
+            self.target_component,
+            start,
+            end,
+            self.mav_mission_type())
+
+    def item_keys(self):
+        '''return the comparison keys of the held items'''
+        return [mission_cache.item_key(self.wp_to_mission_item_int(self.wploader.wp(i)))
+                for i in range(self.wploader.count())]
+
+    def changed_ranges(self):
+        '''return the inclusive (start, end) ranges of items which differ
+        from those on the vehicle, or None if all items should be sent'''
+        if not self.settings.wp_partial_upload:
+            return None
+        old = self.vehicle_items_by_sysid.get(self.target_system, None)
+        keys = self.item_keys()
+        if old is None or len(old) != len(keys) or len(keys) == 0:
+            return None
+        ranges = []
+        for i in range(len(keys)):
+            if keys[i] == old[i]:
+                continue
+            if len(ranges) > 0 and i - ranges[-1][1] <= PARTIAL_MERGE_GAP:
+                # cheaper to resend a few unchanged items than to
+                # start another partial write
+                ranges[-1] = (ranges[-1][0], i)
+            else:
+                ranges.append((i, i))
+        cost = sum(end - start + 1 for (start, end) in ranges) + PARTIAL_MERGE_GAP * len(ranges)
+        if cost >= len(keys):
+            return None
+        return ranges
+
+    def upload_done(self):
+        '''an upload has been accepted by the vehicle'''
+        if not self.upload_all:
+            return
+        self.upload_all = False
+        self.vehicle_items_by_sysid[self.target_system] = self.item_keys()
+        self.cache_save()
+
     def load_waypoints(self, filename):
         '''load waypoints from a file'''
         self.wploader.target_system = self.target_system
@@ -512,6 +699,15 @@ on'''
         else:
             start = wpnum
             end = wpnum
+        # the held items no longer reflect the vehicle
+        self.vehicle_items_by_sysid.pop(self.target_system, None)
+        self.upload_all = False
+        self.upload_ranges = []
+        self.upload_sent = None
+        self.upload_end = end
+        self.upload_ack_time = None
+        self.upload_retries = 0
+        self.upload_verify = False
         self.master.mav.mission_write_partial_list_send(
             self.target_system,
             self.target_component,
@@ -588,6 +784,16 @@ on'''
         self.loading_waypoints = True
         self.loading_waypoint_lasttime = time.time()
         self.upload_start = time.time()
+        self.upload_all = False
+        self.upload_ranges = []
+        self.upload_sent = None
+        self.upload_end = idx
+        self.upload_ack_time = None
+        self.upload_retries = 0
+        self.upload_verify = False
+        keys = self.vehicle_items_by_sysid.get(self.target_system, None)
+        if keys is not None and len(keys) == self.wploader.count():
+            keys[idx] = mission_cache.item_key(self.wp_to_mission_item_int(self.wploader.wp(idx)))
         self.master.mav.mission_write_partial_list_send(
             self.target_system,
             self.target_component,
@@ -848,10 +1054,11 @@ on'''
             self.wploader.expected_count = 0
         self.wploader.expected_count = 0
         self.loading_waypoint_lasttime = time.time()
+        self.vehicle_items_by_sysid.pop(self.target_system, None)
 
     def cmd_list(self, args):
         self.wp_op = "list"
-        self.request_list_send()
+        self.request_items()
 
     def cmd_load(self, args):
         if len(args) != 1:
@@ -865,7 +1072,7 @@ on'''
             return
         self.wp_save_filename = args[0]
         self.wp_op = "save"
-        self.request_list_send()
+        self.request_items()
 
     def cmd_savecsv(self, args):
         if len(args) != 1:
@@ -994,7 +1201,7 @@ on'''
         """Download wpts from vehicle (this operation is public to support other modules)"""
         if self.wp_op is None:  # If we were already doing a list or save, just restart the fetch without changing the operation  # noqa
             self.wp_op = "fetch"
-        self.request_list_send()
+        self.request_items()
 
     def request_list_send(self):
         self.master.mav.mission_request_list_send(
@@ -1002,6 +1209,92 @@ on'''
             self.target_component,
             mission_type=self.mav_mission_type())
 
+    def vehicle_key(self):
+        '''return the cache key for the target vehicle'''
+        version = None
+        param = self.module('param')
+        if param is not None:
+            pstate = param.pstate.get(param.get_sysid(), None)
+            version = getattr(pstate, 'autopilot_version', None)
+        component = self.target_component
+        if component == 0:
+            component = 1
+        return param_cache.vehicle_key((self.target_system, component), version)
+
+    def request_items(self):
+        '''fetch items from the vehicle. If we have cached items then the
+        vehicle is first asked for the CRC of its items with ftp, and the
+        download is skipped if they match'''
+        if self.cache_state == 'crc':
+            # already validating the cache
+            return
+        ftp = self.module('ftp')
+        if self.settings.wp_cache and ftp is not None and ftp.is_idle():
+            self.cache_entry = self.cache.load(self.vehicle_key(), self.mav_mission_type())
+            if self.cache_entry is not None:
+                self.cache_state = 'crc'
+                self.cache_time = time.time()
+                ftp.cmd_crc([self.mission_ftp_name()], callback=self.cache_crc_callback)
+                return
+        self.request_list_send()
+
+    def cache_crc_callback(self, crc):
+        '''callback with the CRC of the vehicle's items from ftp'''
+        if self.cache_state != 'crc':
+            return
+        self.cache_state = None
+        (items, cache_crc) = self.cache_entry
+        self.cache_entry = None
+        if crc is None:
+            self.request_list_send()
+            return
+        if crc != cache_crc:
+            ftp = self.module('ftp')
+            if ftp is None or not ftp.is_idle():
+                self.request_list_send()
+                return
+            # the vehicle supports ftp for these items, which is much
+            # faster than requesting them one at a time
+            self.wp_ftp_download([])
+            return
+        self.set_items(items)
+        print("Loaded %u %s from cache" % (len(items), self.itemstype()))
+        self.download_done(self.target_system, crc)
+
+    def cache_save(self, crc=None):
+        '''save the items held on the vehicle to the cache. crc is the CRC
+        of the vehicle's @MISSION file, if known'''
+        if not self.settings.wp_cache:
+            return
+        items = self.items_int()
+        if crc is None:
+            crc = mission_cache.items_crc(self.mav_mission_type(), items)
+        self.cache.save(self.vehicle_key(), self.mav_mission_type(), items, crc)
+
+    def items_int(self):
+        '''return the held items as a list of MISSION_ITEM_INT'''
+        return [self.wp_to_mission_item_int(self.wploader.wp(i)) for i in range(self.wploader.count())]
+
+    def set_items(self, items):
+        '''replace the held items with a list of MISSION_ITEM_INT'''
+        self.wploader.clear()
+        for w in items:
+            self.wploader.add(self.wp_from_mission_item_int(w))
+        self.wploader.expected_count = len(items)
+
+    def download_done(self, source_system, crc=None):
+        '''all items have been received from the vehicle'''
+        self.vehicle_items_by_sysid[self.target_system] = self.item_keys()
+        self.cache_save(crc)
+        if self.wp_op == 'list':
+            self.show_and_save(source_system)
+            self.loading_waypoints = False
+        elif self.wp_op == "save":
+            self.save_waypoints(self.wp_save_filename)
+        self.wp_op = None
+        self.wp_requested = {}
+        self.wp_received = {}
+
     def wp_ftp_download(self, args):
         '''Download items from vehicle with ftp'''
         ftp = self.mpstate.module('ftp')
@@ -1031,35 +1324,20 @@ on'''
         '''callback from ftp fetch of mission items'''
         if fh is None:
             print("mission: failed ftp download")
+            if self.wp_op is not None:
+                self.request_list_send()
             return
-        magic = 0x763d
         data = fh.read()
-        magic2, dtype, options, start, num_items = struct.unpack("<HHHHH", data[0:10])
-        if magic != magic2:
-            print("%s: bad magic 0x%x expected 0x%x" % (self.itemtype(), magic2, magic))
+        (items, error) = mission_cache.unpack_items(data, self.mav_mission_type())
+        if error is not None:
+            print("%s: %s" % (self.itemtype(), error))
+            if self.wp_op is not None:
+                self.request_list_send()
             return
-        if dtype != self.mav_mission_type():
-            print("%s: bad data type %u" % (self.itemtype(), dtype))
-            return
-
-        self.wploader.clear()
-
-        data = data[10:]
-        mavmsg = mavutil.mavlink.MAVLink_mission_item_int_message
-        item_size = mavmsg.unpacker.size
-        while len(data) >= item_size:
-            mdata = data[:item_size]
-            data = data[item_size:]
-            msg = mavmsg.unpacker.unpack(mdata)
-            tlist = list(msg)
-            t = tlist[:]
-            for i in range(0, len(tlist)):
-                tlist[i] = t[mavmsg.orders[i]]
-            t = tuple(tlist)
-            w = mavmsg(*t)
-            w = self.wp_from_mission_item_int(w)
-            self.wploader.add(w)
-        self.show_and_save(self.target_system)
+        self.set_items(items)
+        if self.wp_op is None:
+            self.wp_op = 'list'
+        self.download_done(self.target_system, param_cache.ftp_crc32(data))
 
     def show_and_save(self, source_system):
         '''display waypoints and save'''
@@ -1095,21 +1373,11 @@ on'''
         print("Loaded %u %s from %s" % (self.wploader.count(), self.itemstype(), filename))
         print("Sending %s with ftp" % self.itemstype())
 
-        fh = SIO()
-        fh.write(struct.pack("<HHHHH", 0x763d, self.mav_mission_type(), 0, 0, self.wploader.count()))
-        mavmsg = mavutil.mavlink.MAVLink_mission_item_int_message
-        for i in range(self.wploader.count()):
-            w = self.wploader.wp(i)
-            w = self.wp_to_mission_item_int(w)
-            tlist = []
-            for field in mavmsg.ordered_fieldnames:
-                tlist.append(getattr(w, field))
-            tlist = tuple(tlist)
-            buf = mavmsg.unpacker.pack(*tlist)
-            fh.write(buf)
-        fh.seek(0)
+        items = [self.wp_to_mission_item_int(self.wploader.wp(i)) for i in range(self.wploader.count())]
+        fh = SIO(mission_cache.pack_items(self.mav_mission_type(), items))
 
         self.upload_start = time.time()
+        self.upload_all = True
 
         ftp.cmd_put([self.mission_ftp_name(), self.mission_ftp_name()],
                     fh=fh, callback=self.ftp_upload_callback, progress_callback=self.ftp_upload_progress)
@@ -1131,3 +1399,4 @@ on'''
             item_size = mavmsg.unpacker.size
             print("Sent %s of length %u in %.2fs" %
                   (self.itemtype(), (dlen - 10) // item_size, time.time() - self.upload_start))
+            self.upload_done()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+'''
+batched writes to MAVLink connections
+
+buffers written during one parse_buffer() batch are gathered per
+connection and flushed with a single write() of up to max_size bytes,
+so a relay fanning out to many outputs does one syscall per output per
+batch rather than one per message per output
+
+writes made directly to a connection, such as conn.mav.send(), first
+flush anything pending for it so that packets are never reordered
+
+AP_FLAKE8_CLEAN
+'''
+
+import time
+
+
+class BatchQueue(object):
+    '''pending buffers for one connection'''
+    def __init__(self, start_time):
+        self.start_time = start_time
+        self.bufs = []
+        self.nbytes = 0
+
+
+class BatchWriter(object):
+    '''gather buffers written to MAVLink connections and flush them in
+    as few writes as possible
+
+    settings must provide:
+      out_batch           enable batching
+      out_batch_latency   max time in ms a buffer may be held
+      out_batch_size      max bytes per write (max datagram size for UDP)
+
+    per-connection counters are kept as attributes on the connection:
+    batch_msgs, batch_writes and batch_errors
+    '''
+    def __init__(self, settings):
+        self.settings = settings
+        self.pending = {}
+
+    def write(self, conn, buf):
+        '''write buf to conn, possibly delaying it to batch with later writes'''
+        conn.batch_msgs = getattr(conn, 'batch_msgs', 0) + 1
+        if not self.settings.out_batch:
+            conn.batch_writes = getattr(conn, 'batch_writes', 0) + 1
+            conn.write(buf)
+            return
+        q = self.pending.get(conn, None)
+        if q is None:
+            if getattr(conn, 'batch_raw_write', None) is None:
+                self.hook(conn)
+            q = BatchQueue(time.time())
+            self.pending[conn] = q
+        elif q.nbytes + len(buf) > self.settings.out_batch_size:
+            self.write_queue(conn, q)
+            q.start_time = time.time()
+        q.bufs.append(buf)
+        q.nbytes += len(buf)
+
+    def hook(self, conn):
+        '''make direct writes to conn flush its pending buffers first'''
+        raw_write = conn.write
+
+        def write(buf):
+            q = self.pending.pop(conn, None)
+            if q is not None:
+                self.write_queue(conn, q)
+            raw_write(buf)
+        conn.batch_raw_write = raw_write
+        conn.write = write
+
+    def write_queue(self, conn, q):
+        '''write out all buffers in q with one write'''
+        if len(q.bufs) == 0:
+            return
+        if len(q.bufs) == 1:
+            buf = q.bufs[0]
+        else:
+            buf = b''.join(q.bufs)
+        q.bufs = []
+        q.nbytes = 0
+        conn.batch_writes = getattr(conn, 'batch_writes', 0) + 1
+        try:
+            conn.batch_raw_write(buf)
+        except (OSError, ValueError) as ex:
+            # such as ECONNREFUSED from a UDP output with no listener
+            conn.batch_errors = getattr(conn, 'batch_errors', 0) + 1
+            if conn.batch_errors == 1 or conn.batch_errors % 100 == 0:
+                print("Write to %s failed (%u errors): %s" % (
+                    getattr(conn, 'address', 'output'), conn.batch_errors, str(ex)))
+
+    def flush(self, force=False):
+        '''flush all queues which have reached the latency limit. With a
+        latency of zero everything is flushed'''
+        if len(self.pending) == 0:
+            return
+        if force or self.settings.out_batch_latency <= 0 or not self.settings.out_batch:
+            cutoff = None
+        else:
+            cutoff = time.time() - self.settings.out_batch_latency * 0.001
+        for conn in list(self.pending.keys()):
+            q = self.pending[conn]
+            if cutoff is not None and q.start_time > cutoff:
+                continue
+            self.pending.pop(conn)
+            self.write_queue(conn, q)
+
+    def discard(self, conn):
+        '''drop any pending data for a connection which is being closed'''
+        self.pending.pop(conn, None)
+
+    @staticmethod
+    def stats_string(conn):
+        '''return a string describing batching on a connection'''
+        msgs = getattr(conn, 'batch_msgs', 0)
+        writes = getattr(conn, 'batch_writes', 0)
+        errors = getattr(conn, 'batch_errors', 0)
+        if writes == 0:
+            return "msgs=0 writes=0"
+        return "msgs=%u writes=%u batch=%.1f errors=%u" % (msgs, writes, msgs / float(writes), errors)
@@ -23,17 +23,19 @@ TERRAIN_SERVICES = {
 class ElevationModel():
     '''Elevation Model. Only SRTM for now'''
 
-    def __init__(self, database='SRTM3', offline=0, debug=False, cachedir=None):
+    def __init__(self, database='SRTM3', offline=0, debug=False, cachedir=None, cache_mb=256):
         '''Use offline=1 to disable any downloading of tiles, regardless of whether the
-        tile exists'''
+        tile exists. cache_mb limits the memory used by loaded tiles'''
         if database is not None and database.lower() == 'srtm':
             # compatibility with the old naming
             database = "SRTM3"
         self.database = database
         if self.database in ['SRTM1', 'SRTM3']:
-            self.downloader = srtm.SRTMDownloader(offline=offline, debug=debug, directory=self.database, cachedir=cachedir)
+            self.downloader = srtm.SRTMDownloader(offline=offline, debug=debug, directory=self.database, cachedir=cachedir,
+                                                  cache_mb=cache_mb)
             self.downloader.loadFileList()
-            self.tileDict = dict()
+            # least recently used tiles are dropped when over cache_mb
+            self.tileDict = self.downloader.tile_cache
         elif self.database == 'geoscience':
             '''Use the Geoscience Australia database instead - watch for the correct database path'''
             from MAVProxy.modules.mavproxy_map import GAreader
@@ -48,28 +50,64 @@ class ElevationModel():
         if latitude is None or longitude is None:
             return None
         if self.database in ['SRTM1', 'SRTM3']:
-            TileID = (numpy.floor(latitude), numpy.floor(longitude))
-            if TileID in self.tileDict:
-                alt = self.tileDict[TileID].getAltitudeFromLatLon(latitude, longitude)
-            else:
-                tile = self.downloader.getTile(numpy.floor(latitude), numpy.floor(longitude))
-                if tile == 0:
-                    if timeout > 0:
-                        t0 = time.time()
-                        while time.time() < t0+timeout and tile == 0:
-                            tile = self.downloader.getTile(numpy.floor(latitude), numpy.floor(longitude))
-                            if tile == 0:
-                                time.sleep(0.1)
-                if tile == 0:
-                    return None
-                self.tileDict[TileID] = tile
-                alt = tile.getAltitudeFromLatLon(latitude, longitude)
+            TileID = (int(numpy.floor(latitude)), int(numpy.floor(longitude)))
+            tile = self.GetTile(TileID, timeout)
+            if tile is None:
+                return None
+            alt = tile.getAltitudeFromLatLon(latitude, longitude)
         elif self.database == 'geoscience':
              alt = self.mappy.getAltitudeAtPoint(latitude, longitude)
         else:
             return None
         return alt
 
+    def GetTile(self, TileID, timeout=0):
+        '''Returns the SRTM tile for a (lat, lon) integer pair, or None if not available'''
+        tile = self.tileDict.get(TileID)
+        if tile is not None:
+            return tile
+        tile = self.downloader.getTile(TileID[0], TileID[1])
+        if tile == 0:
+            if timeout > 0:
+                t0 = time.time()
+                while time.time() < t0+timeout and tile == 0:
+                    tile = self.downloader.getTile(TileID[0], TileID[1])
+                    if tile == 0:
+                        time.sleep(0.1)
+        if tile == 0:
+            return None
+        self.tileDict.put(TileID, tile)
+        return tile
+
+    def GetElevationArray(self, latitudes, longitudes, timeout=0):
+        '''Returns the altitudes (m ASL) of arrays of lat/long pairs as a float
+        array of the same shape, with NaN where unknown. Points are grouped by
+        tile and interpolated together'''
+        lats = numpy.asarray(latitudes, dtype=numpy.float64)
+        lons = numpy.asarray(longitudes, dtype=numpy.float64)
+        shape = lats.shape
+        lats = lats.ravel()
+        lons = lons.ravel()
+        alt = numpy.full(lats.shape, numpy.nan)
+        if self.database in ['SRTM1', 'SRTM3']:
+            tile_lat = numpy.floor(lats).astype(numpy.int64)
+            tile_lon = numpy.floor(lons).astype(numpy.int64)
+            keys = numpy.stack((tile_lat, tile_lon), axis=1)
+            (tiles, inverse) = numpy.unique(keys, axis=0, return_inverse=True)
+            inverse = inverse.ravel()
+            for i in range(len(tiles)):
+                tile = self.GetTile((int(tiles[i][0]), int(tiles[i][1])), timeout)
+                if tile is None:
+                    continue
+                idx = numpy.nonzero(inverse == i)[0]
+                alt[idx] = tile.getAltitudeFromLatLonArray(lats[idx], lons[idx])
+        elif self.database == 'geoscience':
+            for i in range(len(lats)):
+                v = self.mappy.getAltitudeAtPoint(lats[i], lons[i])
+                if v is not None:
+                    alt[i] = v
+        return alt.reshape(shape)
+
 
 if __name__ == "__main__":
 
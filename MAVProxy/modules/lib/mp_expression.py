@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+'''
+compiled evaluation of graph and console expressions
+
+expressions such as ATTITUDE.roll*57.3 or degrees(NKF1[0].VN){GPS.Status>=3}
+are parsed once and compiled to a function of the message dictionary,
+rather than being parsed by eval() on every message. Message names become
+direct dictionary lookups and TYPE[instance] references look up the
+instance message directly. The result matches
+mavutil.evaluate_expression(), including returning None when a message
+is missing or an instance has not been seen
+
+AP_FLAKE8_CLEAN
+'''
+
+import ast
+import builtins
+
+from pymavlink import mavexpression
+
+# expressions are usually re-used for the life of a graph or console
+# entry, so a simple bounded cache is enough
+MAX_CACHE = 1000
+
+# exceptions which mean "no value yet" rather than a bad expression
+missing_exceptions = (NameError, KeyError, IndexError, ZeroDivisionError)
+
+
+def lookup_instance(msgs, mtype, instance):
+    '''return the message for one instance of a multi-instance type'''
+    m = msgs.get('%s[%s]' % (mtype, str(instance)), None)
+    if m is not None:
+        return m
+    return msgs[mtype][instance]
+
+
+expression_globals = dict(mavexpression.__dict__)
+expression_globals['_lookup_instance'] = lookup_instance
+
+
+def is_global(name):
+    '''return True if a name is a function or constant, which a message of
+    the same name overrides unless it is called'''
+    return name in expression_globals or hasattr(builtins, name)
+
+
+class MessageLookups(ast.NodeTransformer):
+    '''rewrite message references to lookups in the _msgs argument'''
+    def visit_Call(self, node):
+        # functions are bound directly, a message can't be called
+        if isinstance(node.func, ast.Name) and is_global(node.func.id):
+            node.args = [self.visit(a) for a in node.args]
+            node.keywords = [self.visit(k) for k in node.keywords]
+            return node
+        return self.generic_visit(node)
+
+    def visit_Name(self, node):
+        if not isinstance(node.ctx, ast.Load):
+            return node
+        if is_global(node.id):
+            # as with eval(), a message of the same name takes priority
+            lookup = ast.Call(func=ast.Attribute(value=ast.Name(id='_msgs', ctx=ast.Load()),
+                                                 attr='get', ctx=ast.Load()),
+                              args=[ast.Constant(value=node.id), ast.Name(id=node.id, ctx=ast.Load())],
+                              keywords=[])
+        else:
+            lookup = ast.Subscript(value=ast.Name(id='_msgs', ctx=ast.Load()),
+                                   slice=ast.Constant(value=node.id),
+                                   ctx=ast.Load())
+        return ast.copy_location(lookup, node)
+
+    def visit_Subscript(self, node):
+        v = node.value
+        if (isinstance(v, ast.Name) and not is_global(v.id) and
+                isinstance(node.slice, ast.Constant) and isinstance(node.ctx, ast.Load)):
+            call = ast.Call(func=ast.Name(id='_lookup_instance', ctx=ast.Load()),
+                            args=[ast.Name(id='_msgs', ctx=ast.Load()),
+                                  ast.Constant(value=v.id),
+                                  node.slice],
+                            keywords=[])
+            return ast.copy_location(call, node)
+        return self.generic_visit(node)
+
+
+def compile_function(expression):
+    '''compile an expression to a function of the message dictionary.
+    Raises SyntaxError for a bad expression'''
+    tree = ast.parse(expression.strip(), mode='eval')
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Lambda, ast.ListComp, ast.SetComp, ast.DictComp,
+                             ast.GeneratorExp, ast.NamedExpr)):
+            # these introduce their own names, use plain eval
+            code = compile(tree, '<expression>', 'eval')
+            return lambda msgs: eval(code, expression_globals, msgs)
+    body = MessageLookups().visit(tree.body)
+    args = ast.arguments(posonlyargs=[], args=[ast.arg(arg='_msgs')], kwonlyargs=[],
+                         kw_defaults=[], defaults=[])
+    func = ast.Expression(body=ast.Lambda(args=args, body=body))
+    ast.fix_missing_locations(func)
+    return eval(compile(func, '<expression>', 'eval'), expression_globals)
+
+
+class CompiledExpression(object):
+    '''an expression with an optional {CONDITION} suffix, compiled once'''
+    def __init__(self, expression):
+        self.expression = expression
+        self.condition = None
+        self.function = None
+        self.error = None
+        if expression.endswith('}'):
+            startidx = expression.rfind('{')
+            if startidx == -1:
+                # never has a value
+                return
+            try:
+                self.condition = compile_function(expression[startidx+1:-1])
+            except SyntaxError:
+                return
+            expression = expression[:startidx]
+        try:
+            self.function = compile_function(expression)
+        except SyntaxError as ex:
+            self.error = ex
+
+    def evaluate(self, msgs, nocondition=False):
+        '''evaluate with a dictionary of messages, returning None if the
+        condition is false or a message is missing'''
+        if self.condition is not None:
+            try:
+                v = self.condition(msgs)
+            except Exception:
+                return None
+            if not nocondition and not v:
+                return None
+        if self.function is None:
+            if self.error is not None:
+                raise self.error
+            return None
+        try:
+            return self.function(msgs)
+        except missing_exceptions:
+            return None
+
+
+compiled_expressions = {}
+
+
+def compile_expression(expression):
+    '''return the CompiledExpression for a string, compiling it on first use'''
+    c = compiled_expressions.get(expression, None)
+    if c is None:
+        if len(compiled_expressions) >= MAX_CACHE:
+            compiled_expressions.clear()
+        c = CompiledExpression(expression)
+        compiled_expressions[expression] = c
+    return c
+
+
+def evaluate_expression(expression, msgs, nocondition=False):
+    '''evaluate an expression, a compiled replacement for
+    mavutil.evaluate_expression'''
+    return compile_expression(expression).evaluate(msgs, nocondition)
+
+
+def evaluate_condition(condition, msgs):
+    '''evaluate a conditional (boolean) statement'''
+    if condition is None:
+        return True
+    v = evaluate_expression(condition, msgs)
+    if v is None:
+        return False
+    return v
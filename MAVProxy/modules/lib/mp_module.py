@@ -20,6 +20,8 @@ class MPModule(object):
         self.multi_instance = multi_instance
         self.multi_vehicle = multi_vehicle
         self.named_float_seq = 0
+        # set of message types passed to mavlink_packet, None for all
+        self.mavlink_packet_types = None
 
         if description is None:
             self.description = name + " handling"
@@ -157,6 +159,23 @@ class MPModule(object):
     def add_completion_function(self, name, callback):
         self.mpstate.completion_functions[name] = callback
 
+    def subscribe_mavlink_packets(self, mtypes):
+        '''only pass messages of the given types to mavlink_packet. Pass
+        None to receive all messages'''
+        if mtypes is not None:
+            mtypes = set(mtypes)
+        self.mavlink_packet_types = mtypes
+        self.mpstate.module_generation += 1
+
+    def wants_mavlink_packet(self, mtype):
+        '''return True if this module wants messages of type mtype'''
+        mtypes = getattr(self, 'mavlink_packet_types', None)
+        if mtypes is not None:
+            return mtype in mtypes
+        # modules that don't override mavlink_packet don't need any messages
+        return (getattr(type(self), 'mavlink_packet', None) is not MPModule.mavlink_packet or
+                'mavlink_packet' in self.__dict__)
+
     def flyto_frame_units(self):
         '''return a frame string and unit'''
         return "%s %s" % (self.settings.height_unit, self.settings.flytoframe)
@@ -11,6 +11,7 @@ import base64
 import time
 import errno
 import select
+import collections
 from MAVProxy.modules.lib import rtcm3
 import ssl
 from optparse import OptionParser
@@ -62,8 +63,9 @@ class NtripClient(object):
         self.socket_pending = None
         self.found_header = False
         self.sent_header = False
-        # RTCM3 parser
-        self.rtcm3 = rtcm3.RTCM3()
+        # RTCM3 framer, and frames read but not yet returned by read()
+        self.rtcm3 = rtcm3.RTCM3Framer()
+        self.frames = collections.deque()
         self.last_id = None
         self.dt_last_gga_sent = 0
         self.last_connect_attempt = time.time()
@@ -117,15 +119,26 @@ class NtripClient(object):
         return self.last_id
 
     def read(self):
+        '''return the next RTCM3 frame, or None'''
+        if len(self.frames) == 0:
+            self.frames.extend(self.read_frames())
+        if len(self.frames) == 0:
+            return None
+        pkt = self.frames.popleft()
+        self.last_id = rtcm3.packet_ID(pkt)
+        return pkt
+
+    def read_frames(self):
+        '''return a list of all RTCM3 frames available from the caster'''
         if self.socket is None:
             if self.socket_pending is None:
                 now = time.time()
                 # rate limit connection attempts
                 if now - self.last_connect_attempt < 1.0:
-                    return None
+                    return []
                 self.last_connect_attempt = now
             self.connect()
-            return None
+            return []
 
         if not self.found_header:
             if not self.sent_header:
@@ -138,17 +151,17 @@ class NtripClient(object):
                     self.socket.sendall(mps)
                 except ssl.SSLWantReadError:
                     self.sent_header = False
-                    return None
+                    return []
                 except Exception:
                     self.socket = None
-                    return None
+                    return []
             try:
                 casterResponse = self.socket.recv(4096)
             except ssl.SSLWantReadError:
-                    return None
+                    return []
             except IOError as e:
                 if e.errno == errno.EWOULDBLOCK:
-                    return None
+                    return []
                 self.socket = None
                 casterResponse = ''
             if sys.version_info.major >= 3:
@@ -175,30 +188,31 @@ class NtripClient(object):
             if is_ntrip_rev1 and not self.found_header:
                 self.found_header = True
 
-            return None
-        # normal data read
+            return []
+        # normal data read, taking everything the socket has available
+        frames = []
         while True:
             try:
-                data = self.socket.recv(1)
+                data = self.socket.recv(4096)
             except ssl.SSLWantReadError:
-                    return None
+                return frames
             except IOError as e:
                 if e.errno == errno.EWOULDBLOCK:
-                    return None
+                    return frames
                 self.socket.close()
                 self.socket = None
-                return None
+                return frames
             except Exception:
                 self.socket.close()
                 self.socket = None
-                return None
+                return frames
             if len(data) == 0:
                 self.socket.close()
                 self.socket = None
-                return None
-            if self.rtcm3.read(data):
-                self.last_id = self.rtcm3.get_packet_ID()
-                return self.rtcm3.get_packet()
+                return frames
+            frames.extend(self.rtcm3.read(data))
+            if len(data) < 4096:
+                return frames
 
     def connect(self):
         '''connect to NTRIP server'''
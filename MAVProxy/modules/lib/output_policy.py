@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+'''
+per-output forwarding policy for MAVLink outputs
+
+a policy can limit the rate of each message type, restrict the types
+forwarded with allow and deny lists of wildcards, and decimate the
+stream by only passing every Nth message of each type. Rate and
+decimation apply separately to each source system, so one vehicle on a
+shared output can't use up another's budget. Decisions for a message
+type are compiled on first use so the per-message check is a
+dictionary lookup and a couple of comparisons
+
+AP_FLAKE8_CLEAN
+'''
+
+import fnmatch
+
+
+class OutputPolicyRule(object):
+    '''compiled policy and state for one message type from one source system'''
+    def __init__(self, min_interval, decimate):
+        self.min_interval = min_interval
+        self.decimate = decimate
+        self.count = 0
+        self.next_send = 0
+
+
+class OutputPolicy(object):
+    '''forwarding policy for one output'''
+    def __init__(self):
+        self.rates = {}
+        self.allow = []
+        self.deny = []
+        self.decimate = 1
+        self.passed = 0
+        self.dropped = 0
+        self.rules = {}
+
+    def set_option(self, key, value):
+        '''set a policy option from a key=value argument, raising ValueError on bad input'''
+        if key == 'rate':
+            for r in value.split(','):
+                (mtype, hz) = r.split(':')
+                hz = float(hz)
+                if hz < 0:
+                    raise ValueError("bad rate %s" % r)
+                self.rates[mtype.upper()] = hz
+        elif key == 'allow':
+            self.allow = [a.upper() for a in value.split(',') if a]
+        elif key == 'deny':
+            self.deny = [d.upper() for d in value.split(',') if d]
+        elif key == 'decimate':
+            self.decimate = int(value)
+            if self.decimate < 1:
+                raise ValueError("decimate must be at least 1")
+        else:
+            raise ValueError("unknown output policy option %s" % key)
+        self.rules = {}
+
+    def parse(self, args):
+        '''parse a list of key=value policy arguments'''
+        for a in args:
+            if a.find('=') == -1:
+                raise ValueError("bad output policy argument %s" % a)
+            (key, value) = a.split('=', 1)
+            self.set_option(key.lower(), value)
+
+    def is_default(self):
+        '''return True if this policy passes everything'''
+        return len(self.rates) == 0 and len(self.allow) == 0 and len(self.deny) == 0 and self.decimate == 1
+
+    def compile(self, mtype):
+        '''build the rule for a message type, None if it is not forwarded'''
+        if self.allow and not any(fnmatch.fnmatch(mtype, a) for a in self.allow):
+            return None
+        if any(fnmatch.fnmatch(mtype, d) for d in self.deny):
+            return None
+        min_interval = 0
+        for (pattern, hz) in self.rates.items():
+            if fnmatch.fnmatch(mtype, pattern):
+                if hz == 0:
+                    return None
+                min_interval = 1.0 / hz
+                break
+        return OutputPolicyRule(min_interval, self.decimate)
+
+    def check(self, mtype, tnow, srcSystem=0):
+        '''return True if a message of type mtype from srcSystem should be
+        forwarded at time tnow'''
+        key = (srcSystem, mtype)
+        try:
+            rule = self.rules[key]
+        except KeyError:
+            rule = self.compile(mtype)
+            self.rules[key] = rule
+        if rule is None:
+            self.dropped += 1
+            return False
+        if rule.decimate > 1:
+            rule.count += 1
+            if rule.count < rule.decimate:
+                self.dropped += 1
+                return False
+            rule.count = 0
+        if rule.min_interval > 0:
+            if tnow < rule.next_send:
+                self.dropped += 1
+                return False
+            # schedule from the previous slot so jitter doesn't lower the
+            # rate, but don't allow a burst after a gap
+            rule.next_send += rule.min_interval
+            if rule.next_send <= tnow:
+                rule.next_send = tnow + rule.min_interval
+        self.passed += 1
+        return True
+
+    def __str__(self):
+        ret = []
+        if self.rates:
+            ret.append("rate=" + ",".join(["%s:%g" % (k, v) for (k, v) in self.rates.items()]))
+        if self.allow:
+            ret.append("allow=" + ",".join(self.allow))
+        if self.deny:
+            ret.append("deny=" + ",".join(self.deny))
+        if self.decimate != 1:
+            ret.append("decimate=%u" % self.decimate)
+        ret.append("passed=%u dropped=%u" % (self.passed, self.dropped))
+        return " ".join(ret)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+'''
+on-disk cache of vehicle parameters
+
+parameters are stored per vehicle, keyed by sysid, component and the
+board identity from AUTOPILOT_VERSION. A cache entry is only trusted
+once it has been validated against the vehicle, normally by comparing
+the CRC of @PARAM/param.pck from MAVLink FTP with the CRC of the file
+the cache was built from
+
+AP_FLAKE8_CLEAN
+'''
+
+import json
+import os
+import time
+import zlib
+
+from MAVProxy.modules.lib import mp_util
+
+
+def ftp_crc32(data):
+    '''CRC32 as calculated by the autopilot for OP_CalcFileCRC32, which
+    is the zlib polynomial with no initial or final inversion'''
+    return zlib.crc32(data, 0xFFFFFFFF) ^ 0xFFFFFFFF
+
+
+def vehicle_key(sysid, version):
+    '''return a cache key for a (sysid, compid) tuple and an
+    AUTOPILOT_VERSION message, which may be None'''
+    key = "sys%u_comp%u" % (sysid[0], sysid[1])
+    if version is None:
+        return key
+    if version.uid != 0:
+        return key + "_%016x" % version.uid
+    uid2 = bytes(bytearray(getattr(version, 'uid2', [])))
+    if any(uid2):
+        return key + "_" + uid2.hex()
+    return key + "_board%08x" % version.board_version
+
+
+class ParamCache(object):
+    '''parameter cache files, one per vehicle'''
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = mp_util.dot_mavproxy("paramcache")
+        self.directory = directory
+
+    def filename(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def load(self, key):
+        '''return the cache entry for a vehicle as a dict, or None'''
+        try:
+            with open(self.filename(key), 'r') as f:
+                entry = json.load(f)
+            if not isinstance(entry['params'], dict):
+                return None
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        return entry
+
+    def save(self, key, params, count, crc=None, defaults=None):
+        '''save parameters for a vehicle. params and defaults are
+        dictionaries of name to value, crc is the CRC of the param.pck
+        file they were decoded from, if any'''
+        entry = {
+            'key': key,
+            'time': time.time(),
+            'count': count,
+            'crc': crc,
+            'params': params,
+            'defaults': defaults,
+        }
+        try:
+            mp_util.mkdir_p(self.directory)
+            tmp = self.filename(key) + ".tmp"
+            with open(tmp, 'w') as f:
+                json.dump(entry, f)
+            os.replace(tmp, self.filename(key))
+        except OSError as ex:
+            print("Failed to save parameter cache: %s" % ex)
@@ -6,9 +6,142 @@ POLYCRC24 = 0x1864CFB
 
 import struct
 
+def _make_crc_table():
+    table = [0] * 256
+    for i in range(256):
+        table[i] = i<<16
+        for j in range(8):
+            table[i] <<= 1
+            if (table[i] & 0x1000000):
+                table[i] ^= POLYCRC24
+    return table
+
+crc_table = _make_crc_table()
+
+def crc24(data):
+    '''calculate 24 bit crc'''
+    crc = 0
+    table = crc_table
+    for b in data:
+        crc = ((crc<<8)&0xFFFFFF) ^ table[(crc>>16) ^ b]
+    return crc
+
+def packet_ID(pkt):
+    '''get message ID of an RTCM3 frame, or None'''
+    if pkt is None or len(pkt) < 8:
+        return None
+    id, = struct.unpack('>H', pkt[3:5])
+    return id >> 4
+
+class RTCM3Framer:
+    '''frame RTCM3 messages from a byte stream which arrives in chunks,
+    such as socket reads. Frames are found by searching for the preamble
+    rather than handling one byte at a time'''
+    def __init__(self, debug=False):
+        self.debug = debug
+        self.buf = bytearray()
+        self.frames = 0
+        self.crc_errors = 0
+        self.skipped = 0
+        # datagrams added to a partial frame by read_datagram
+        self.held = []
+
+    def reset(self):
+        '''discard any partial frame'''
+        self.buf = bytearray()
+        self.held = []
+
+    def pending(self):
+        '''number of bytes held waiting for the rest of a frame'''
+        return len(self.buf)
+
+    def read(self, data):
+        '''add a chunk of data, returning a list of all complete frames'''
+        buf = self.buf
+        buf.extend(data)
+        frames = []
+        ofs = 0
+        n = len(buf)
+        while True:
+            idx = buf.find(RTCMv3_PREAMBLE, ofs)
+            if idx == -1:
+                self.skipped += n - ofs
+                ofs = n
+                break
+            self.skipped += idx - ofs
+            ofs = idx
+            if n - ofs < 3:
+                break
+            pkt_len = ((buf[ofs+1] << 8) | buf[ofs+2]) & 0x3ff
+            if pkt_len == 0:
+                ofs += 1
+                self.skipped += 1
+                continue
+            frame_len = 3 + pkt_len + 3
+            if n - ofs < frame_len:
+                break
+            end = ofs + frame_len
+            crc = (buf[end-3] << 16) | (buf[end-2] << 8) | buf[end-1]
+            if crc24(memoryview(buf)[ofs:end-3]) != crc:
+                if self.debug:
+                    print("crc fail len=%u" % frame_len)
+                self.crc_errors += 1
+                # resync on the next preamble
+                ofs += 1
+                self.skipped += 1
+                continue
+            frames.append(bytes(buf[ofs:end]))
+            ofs = end
+        del buf[:ofs]
+        self.frames += len(frames)
+        return frames
+
+    def frame_start(self, data):
+        '''return True if data may start a frame, being the preamble
+        followed by six reserved zero bits'''
+        return len(data) > 0 and data[0] == RTCMv3_PREAMBLE and (len(data) < 2 or (data[1] & 0xFC) == 0)
+
+    def read_datagram(self, data):
+        '''add a datagram from a source which may send other protocols
+        too, such as SBP or UBX. Returns a list of the complete RTCM3
+        frames and the other datagrams, which are passed through
+        unchanged. RTCM3 frames may be split across datagrams'''
+        if len(self.buf) == 0:
+            if not self.frame_start(data):
+                return [bytes(data)]
+            self.held = []
+            return self.read(data)
+        joined = self.buf + data
+        if not self.frame_start(joined):
+            return self.resync(data)
+        if len(joined) >= 3:
+            frame_len = 3 + (((joined[1] << 8) | joined[2]) & 0x3ff) + 3
+            if len(joined) >= frame_len:
+                crc = (joined[frame_len-3] << 16) | (joined[frame_len-2] << 8) | joined[frame_len-1]
+                if crc24(memoryview(joined)[:frame_len-3]) != crc:
+                    self.crc_errors += 1
+                    return self.resync(data)
+                self.buf = bytearray()
+                self.held = []
+                self.frames += 1
+                return [bytes(joined[:frame_len])] + self.read(joined[frame_len:])
+        self.buf = joined
+        self.held.append(data)
+        return []
+
+    def resync(self, data):
+        '''the partial frame was not continued by the following data, so
+        drop it and handle the datagrams held behind it on their own'''
+        datagrams = self.held + [data]
+        self.skipped += len(self.buf) - sum([len(d) for d in self.held])
+        self.reset()
+        ret = []
+        for d in datagrams:
+            ret.extend(self.read_datagram(d))
+        return ret
+
 class RTCM3:
     def __init__(self, debug=False):
-        self.crc_table = None
         self.debug = debug
         self.reset()
 
@@ -18,11 +151,7 @@ class RTCM3:
 
     def get_packet_ID(self):
         '''get get of packet, or None'''
-        if self.parsed_pkt is None or len(self.parsed_pkt) < 8:
-            return None
-        id, = struct.unpack('>H', self.parsed_pkt[3:5])
-        id >>= 4
-        return id
+        return packet_ID(self.parsed_pkt)
 
     def reset(self):
         '''reset state'''
@@ -90,19 +219,7 @@ class RTCM3:
 
     def crc24(self, bytes):
         '''calculate 24 bit crc'''
-        if self.crc_table is None:
-            # initialise table
-            self.crc_table = [0] * 256
-            for i in range(256):
-                self.crc_table[i] = i<<16
-                for j in range(8):
-                    self.crc_table[i] <<= 1
-                    if (self.crc_table[i] & 0x1000000):
-                        self.crc_table[i] ^= POLYCRC24
-        crc = 0
-        for b in bytes:
-            crc = ((crc<<8)&0xFFFFFF) ^ self.crc_table[(crc>>16) ^ b]
-        return crc
+        return crc24(bytes)
 
 if __name__ == '__main__':
     from argparse import ArgumentParser
@@ -114,14 +231,14 @@ if __name__ == '__main__':
     parser.add_argument("--follow", action='store_true', help="continue reading on EOF")
     args = parser.parse_args()
 
-    rtcm3 = RTCM3(args.debug)
+    framer = RTCM3Framer(args.debug)
     f = open(args.filename, 'rb')
     while True:
-        b = f.read(1)
+        b = f.read(4096)
         if len(b) == 0:
             if args.follow:
                 time.sleep(0.1)
                 continue
             break
-        if rtcm3.read(b):
-            print("packet len %u ID %u" % (len(rtcm3.get_packet()), rtcm3.get_packet_ID()))
+        for pkt in framer.read(b):
+            print("packet len %u ID %u" % (len(pkt), packet_ID(pkt)))
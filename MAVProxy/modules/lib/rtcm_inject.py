@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+'''
+shared injection of RTCM corrections into the vehicle with GPS_RTCM_DATA
+
+the frames of one epoch are joined into a single byte stream and packed
+densely into GPS_RTCM_DATA sequences of up to 4 fragments of 180
+bytes. The vehicle reassembles each sequence and passes the bytes on to
+the GPS as a stream, so epochs larger than one sequence are split
+across consecutive sequences rather than dropped.
+
+each link has its own queue, sequence number and token bucket so that
+the rtcm_rate setting bounds the average bandwidth used on each link, and data
+which has waited longer than rtcm_max_age is dropped in favour of newer
+corrections
+
+AP_FLAKE8_CLEAN
+'''
+
+import random
+import time
+
+from collections import deque
+
+# maximum data in one GPS_RTCM_DATA message
+FRAG_LEN = 180
+# maximum fragments in one sequence
+MAX_FRAGS = 4
+SEQ_LEN = FRAG_LEN * MAX_FRAGS
+# approximate MAVLink2 framing around the used part of the payload
+MSG_OVERHEAD = 14
+
+
+def pack_sequence(data, seq):
+    '''return a list of (flags, length, data) messages for up to SEQ_LEN bytes
+    sent as one sequence'''
+    blen = len(data)
+    if blen <= FRAG_LEN:
+        flags = (seq & 0x1F) << 3
+        return [(flags, blen, bytearray(data.ljust(FRAG_LEN, b'\0')))]
+    ret = []
+    nfrags = (blen + FRAG_LEN - 1) // FRAG_LEN
+    for frag in range(nfrags):
+        chunk = data[frag*FRAG_LEN:(frag+1)*FRAG_LEN]
+        flags = 1 | (frag & 0x3) << 1 | (seq & 0x1F) << 3
+        ret.append((flags, len(chunk), bytearray(chunk.ljust(FRAG_LEN, b'\0'))))
+    if nfrags < MAX_FRAGS and blen % FRAG_LEN == 0:
+        # a terminal zero length fragment tells the vehicle the
+        # sequence is complete
+        flags = 1 | (nfrags & 0x3) << 1 | (seq & 0x1F) << 3
+        ret.append((flags, 0, bytearray(FRAG_LEN)))
+    return ret
+
+
+def sequence_cost(data):
+    '''approximate link bytes needed to send a sequence'''
+    nmsgs = len(pack_sequence(data, 0))
+    return len(data) + nmsgs * MSG_OVERHEAD
+
+
+class RTCMLinkQueue(object):
+    '''pending sequences for one link'''
+    def __init__(self, link):
+        self.link = link
+        self.queue = deque()
+        self.seq = 0
+        self.tokens = 0
+        self.last_update = time.time()
+
+    def refill(self, rate, now):
+        '''add tokens for the time since the last refill'''
+        dt = max(now - self.last_update, 0)
+        self.last_update = now
+        if rate <= 0:
+            return
+        # allow a burst of up to one second of data
+        self.tokens = min(self.tokens + rate * dt, rate)
+
+
+class RTCMInjector(object):
+    '''queue RTCM data for injection on one or more links'''
+    def __init__(self, mpstate):
+        self.mpstate = mpstate
+        self.links = {}
+        self.bytes_in = 0
+        self.bytes_sent = 0
+        self.msgs_sent = 0
+        self.epochs = 0
+        self.sequences = 0
+        self.dropped = 0
+        self.latency = 0
+        self.latency_max = 0
+        self.rate = 0
+        self.rate_total = 0
+        self.last_rate = time.time()
+
+    def get_queue(self, link):
+        '''get the queue for a link'''
+        key = getattr(link, 'linknum', id(link))
+        q = self.links.get(key, None)
+        if q is None or q.link is not link:
+            q = RTCMLinkQueue(link)
+            self.links[key] = q
+        return q
+
+    def inject(self, frames, links=None, sendmul=1, drop_pct=0):
+        '''queue one epoch of RTCM data, either bytes or a list of frames. By
+        default it is sent to the current master'''
+        if isinstance(frames, (bytes, bytearray)):
+            frames = [frames]
+        data = b''.join(bytes(f) for f in frames)
+        if len(data) == 0:
+            return
+        if links is None:
+            links = [self.mpstate.master()]
+        now = time.time()
+        self.bytes_in += len(data)
+        self.epochs += 1
+        for link in links:
+            q = self.get_queue(link)
+            for ofs in range(0, len(data), SEQ_LEN):
+                q.queue.append((now, data[ofs:ofs+SEQ_LEN], sendmul, drop_pct))
+        self.update()
+
+    def update(self):
+        '''send queued data within the bandwidth budget, called on idle'''
+        now = time.time()
+        rate = self.mpstate.settings.rtcm_rate
+        max_age = self.mpstate.settings.rtcm_max_age
+        for q in self.links.values():
+            q.refill(rate, now)
+            while len(q.queue) > 0:
+                (tinject, data, sendmul, drop_pct) = q.queue[0]
+                if max_age > 0 and now - tinject > max_age:
+                    q.queue.popleft()
+                    self.dropped += len(data)
+                    continue
+                cost = sequence_cost(data) * sendmul
+                if rate > 0:
+                    # a sequence may take the bucket negative so that
+                    # sequences larger than the budget still get sent
+                    if q.tokens < 0:
+                        break
+                    q.tokens -= cost
+                q.queue.popleft()
+                self.send_sequence(q, data, sendmul, drop_pct)
+                self.add_latency(now - tinject)
+        if now - self.last_rate > 1:
+            rate_now = self.rate_total / (now - self.last_rate)
+            self.rate = 0.9 * self.rate + 0.1 * rate_now
+            self.last_rate = now
+            self.rate_total = 0
+
+    def send_sequence(self, q, data, sendmul, drop_pct):
+        '''send one sequence on a link'''
+        for (flags, length, buf) in pack_sequence(data, q.seq):
+            for i in range(sendmul):
+                if drop_pct > 0 and random.random() * 100 < drop_pct:
+                    continue
+                q.link.mav.gps_rtcm_data_send(flags, length, buf)
+                self.msgs_sent += 1
+        q.seq += 1
+        self.sequences += 1
+        self.bytes_sent += len(data) * sendmul
+        self.rate_total += len(data) * sendmul
+
+    def add_latency(self, dt):
+        '''update queueing latency statistics'''
+        self.latency = 0.9 * self.latency + 0.1 * dt
+        self.latency_max = max(self.latency_max, dt)
+
+    def pending(self):
+        '''return number of bytes queued on all links'''
+        total = 0
+        for q in self.links.values():
+            total += sum(len(e[1]) for e in q.queue)
+        return total
+
+    def status_string(self):
+        '''return a summary of injection statistics'''
+        return ("rtcm: %u epochs %u bytes in, %u bytes in %u msgs/%u seqs sent, %.1f bytes/sec, "
+                "%u queued %u dropped, latency %.1fms (max %.1fms)" % (
+                    self.epochs, self.bytes_in, self.bytes_sent, self.msgs_sent, self.sequences,
+                    self.rate, self.pending(), self.dropped,
+                    self.latency * 1000, self.latency_max * 1000))
+
+
+def injector(mpstate):
+    '''return the RTCMInjector shared by all modules'''
+    inj = getattr(mpstate, 'rtcm_injector', None)
+    if inj is None:
+        inj = RTCMInjector(mpstate)
+        mpstate.rtcm_injector = inj
+    return inj
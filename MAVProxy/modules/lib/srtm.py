@@ -19,8 +19,9 @@ import pickle
 import os.path
 import os
 import zipfile
-import array
 import math
+import collections
+import numpy
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import multiproc
 
@@ -69,7 +70,8 @@ class SRTMDownloader():
                  cachedir=None,
                  offline=0,
                  debug=False,
-                 use_http=False):
+                 use_http=False,
+                 cache_mb=256):
 
         if cachedir is None:
             try:
@@ -105,6 +107,7 @@ class SRTMDownloader():
         self.filelist_file = os.path.join(self.cachedir, "filelist_python")
         self.min_filelist_len = 14500
         self.use_http = use_http
+        self.tile_cache = SRTMTileCache(cache_mb)
 
     def loadFileList(self):
         """Load a previously created file list or create a new one if none is
@@ -299,12 +302,16 @@ class SRTMDownloader():
         elif mypid in childTileDownload and childTileDownload[mypid].is_alive():
             '''print("Still Getting Tile")'''
             return 0
-        # TODO: Currently we create a new tile object each time.
-        # Caching is required for improved performance.
+        key = (int(lat), int(lon))
+        tile = self.tile_cache.get(key)
+        if tile is not None:
+            return tile
         try:
-            return SRTMTile(os.path.join(self.cachedir, filename), int(lat), int(lon))
+            tile = SRTMTile(os.path.join(self.cachedir, filename), int(lat), int(lon))
         except InvalidTileError:
             return 0
+        self.tile_cache.put(key, tile)
+        return tile
 
     def downloadTile(self, continent, filename):
         #Use HTTP
@@ -327,6 +334,31 @@ class SRTMDownloader():
             pass
 
 
+class SRTMTileCache:
+    """Least recently used cache of SRTM tiles, bounded by the memory
+        used by the tile data."""
+    def __init__(self, cache_mb):
+        self.max_bytes = cache_mb * 1024 * 1024
+        self.tiles = collections.OrderedDict()
+        self.nbytes = 0
+
+    def get(self, key):
+        tile = self.tiles.get(key, None)
+        if tile is not None:
+            self.tiles.move_to_end(key)
+        return tile
+
+    def put(self, key, tile):
+        if key in self.tiles:
+            self.nbytes -= self.tiles.pop(key).nbytes()
+        self.tiles[key] = tile
+        self.nbytes += tile.nbytes()
+        # always keep the newest tile, even if it is over budget
+        while self.nbytes > self.max_bytes and len(self.tiles) > 1:
+            (k, old) = self.tiles.popitem(last=False)
+            self.nbytes -= old.nbytes()
+
+
 class SRTMTile:
     """Base class for all SRTM tiles.
         Each SRTM tile is size x size pixels big and contains
@@ -334,26 +366,72 @@ class SRTMTile:
         This means there is a 1 pixel overlap between tiles. This makes it
         easier for as to interpolate the value, because for every point we
         only have to look at a single tile.
+
+        The decoded tile is kept next to the zip file as a .npy file,
+        which is memory mapped on later loads rather than unzipping and
+        byteswapping the tile again.
         """
     def __init__(self, f, lat, lon):
+        self.lat = lat
+        self.lon = lon
+        self.data = self.loadDecoded(f)
+        if self.data is None:
+            self.data = self.decode(f)
+            self.saveDecoded(f)
+        self.size = int(math.sqrt(len(self.data)))
+
+    @staticmethod
+    def decodedPath(f):
+        """Path of the decoded tile for a tile zip file"""
+        if f.endswith('.zip'):
+            f = f[:-4]
+        return f + '.npy'
+
+    def decode(self, f):
+        """Unzip a tile, returning the samples in native byte order"""
         try:
             zipf = zipfile.ZipFile(f, 'r')
         except Exception:
-            raise InvalidTileError(lat, lon)
+            raise InvalidTileError(self.lat, self.lon)
         names = zipf.namelist()
         if len(names) != 1:
-            raise InvalidTileError(lat, lon)
+            raise InvalidTileError(self.lat, self.lon)
         data = zipf.read(names[0])
-        self.size = int(math.sqrt(len(data)/2)) # 2 bytes per sample
+        size = int(math.sqrt(len(data)/2)) # 2 bytes per sample
         # Currently only SRTM1/3 is supported
-        if self.size not in (1201, 3601):
-            raise InvalidTileError(lat, lon)
-        self.data = array.array('h', data)
-        self.data.byteswap()
-        if len(self.data) != self.size * self.size:
-            raise InvalidTileError(lat, lon)
-        self.lat = lat
-        self.lon = lon
+        if size not in (1201, 3601):
+            raise InvalidTileError(self.lat, self.lon)
+        if len(data) != size * size * 2:
+            raise InvalidTileError(self.lat, self.lon)
+        return numpy.frombuffer(data, dtype='>i2').astype(numpy.int16)
+
+    def loadDecoded(self, f):
+        """Memory map a previously decoded tile, returning None if there
+            isn't an up to date one"""
+        path = self.decodedPath(f)
+        try:
+            if os.path.getmtime(path) < os.path.getmtime(f):
+                return None
+            data = numpy.load(path, mmap_mode='r')
+        except Exception:
+            return None
+        if data.dtype != numpy.int16 or data.ndim != 1 or len(data) not in (1201*1201, 3601*3601):
+            return None
+        return data
+
+    def saveDecoded(self, f):
+        """Save the decoded tile for memory mapping next time"""
+        path = self.decodedPath(f)
+        tmpname = path + '.tmp.npy'
+        try:
+            numpy.save(tmpname, self.data)
+            os.replace(tmpname, path)
+        except Exception:
+            pass
+
+    def nbytes(self):
+        """Memory used by the tile data"""
+        return self.data.nbytes
 
     @staticmethod
     def _avg(value1, value2, weight):
@@ -395,7 +473,7 @@ class SRTMTile:
         # Same as calcOffset, inlined for performance reasons
         offset = x + self.size * (self.size - y - 1)
         #print(offset)
-        value = self.data[offset]
+        value = int(self.data[offset])
         if value == -32768:
             return -1 # -32768 is a special value for areas with no data
         return value
@@ -430,15 +508,49 @@ class SRTMTile:
         #        value00, value10, value1, value01, value11, value2, value))
         return value
 
+    def getAltitudeFromLatLonArray(self, lat, lon):
+        """Get the altitudes of arrays of lat lon pairs inside this tile,
+            interpolating as getAltitudeFromLatLon does.
+        """
+        lat = numpy.asarray(lat, dtype=numpy.float64) - self.lat
+        lon = numpy.asarray(lon, dtype=numpy.float64) - self.lon
+        if numpy.any((lat < 0.0) | (lat >= 1.0) | (lon < 0.0) | (lon >= 1.0)):
+            raise WrongTileError(self.lat, self.lon, self.lat+lat.min(), self.lon+lon.min())
+        x = lon * (self.size - 1)
+        y = lat * (self.size - 1)
+        x_int = x.astype(numpy.int64)
+        x_frac = x - x_int
+        y_int = y.astype(numpy.int64)
+        y_frac = y - y_int
+        # offset of (x_int, y_int), see calcOffset
+        offset = x_int + self.size * (self.size - y_int - 1)
+        def pixels(ofs):
+            v = self.data[ofs].astype(numpy.float64)
+            v[v == -32768] = -1
+            return v
+        value00 = pixels(offset)
+        value10 = pixels(offset + 1)
+        value01 = pixels(offset - self.size)
+        value11 = pixels(offset - self.size + 1)
+        value1 = value10 * x_frac + value00 * (1 - x_frac)
+        value2 = value11 * x_frac + value01 * (1 - x_frac)
+        return value2 * y_frac + value1 * (1 - y_frac)
+
 class SRTMOceanTile(SRTMTile):
     '''a tile for areas of zero altitude'''
     def __init__(self, lat, lon):
         self.lat = lat
         self.lon = lon
 
+    def nbytes(self):
+        return 0
+
     def getAltitudeFromLatLon(self, lat, lon):
         return 0
 
+    def getAltitudeFromLatLonArray(self, lat, lon):
+        return numpy.zeros(numpy.shape(lat))
+
 
 class parseHTMLDirectoryListing(HTMLParser):
 
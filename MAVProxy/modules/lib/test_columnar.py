@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+'''
+tests for columnar, checking that expressions evaluated on columns give
+the same rows and values as evaluating them one message at a time
+
+AP_FLAKE8_CLEAN
+'''
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import numpy as np
+
+from pymavlink import DFReader
+
+from MAVProxy.modules.lib import columnar
+from MAVProxy.modules.lib import mp_expression
+
+FMT_TYPE = 128
+TST_TYPE = 200
+NUM_MSGS = 5000
+
+
+def df_message(mtype, payload):
+    return struct.pack('<BBB', 0xA3, 0x95, mtype) + payload
+
+
+def df_format(mtype, name, fmt, columns, length):
+    return df_message(FMT_TYPE, struct.pack('<BB4s16s64s', mtype, length, name.encode(),
+                                            fmt.encode(), columns.encode()))
+
+
+def write_log(filename):
+    '''write a log with a TST message holding a float V and an int C'''
+    with open(filename, 'wb') as f:
+        f.write(df_format(FMT_TYPE, 'FMT', 'BBnNZ', 'Type,Length,Name,Format,Columns', 89))
+        f.write(df_format(TST_TYPE, 'TST', 'Qfh', 'TimeUS,V,C', 17))
+        for i in range(NUM_MSGS):
+            f.write(df_message(TST_TYPE, struct.pack('<Qfh', 1000000 + i * 20000, i * 0.1, i % 7 - 3)))
+
+
+class ColumnarTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        filename = os.path.join(cls.tmpdir, 'test.bin')
+        write_log(filename)
+        cls.mlog = DFReader.DFReader_binary(filename)
+        cls.messages = []
+        while True:
+            m = cls.mlog.recv_match(type='TST')
+            if m is None:
+                break
+            cls.messages.append(m)
+        cls.mlog.rewind()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def per_message(self, expression):
+        '''evaluate one message at a time, dropping rows as the graph does'''
+        t = []
+        v = []
+        for m in self.messages:
+            try:
+                value = mp_expression.evaluate_expression(expression, {'TST': m})
+            except Exception:
+                value = None
+            if value is None:
+                continue
+            t.append(m._timestamp)
+            v.append(value)
+        return (np.array(t), np.array(v, dtype=np.float64))
+
+    def compare(self, expression):
+        expr = columnar.ColumnarExpression(expression)
+        self.assertTrue(expr.valid(), expression)
+        r = expr.evaluate(columnar.columnar_log(self.mlog))
+        self.assertIsNotNone(r, expression)
+        (t, v) = r
+        (t2, v2) = self.per_message(expression)
+        self.assertEqual(len(t), len(t2), expression)
+        np.testing.assert_allclose(t, t2)
+        np.testing.assert_allclose(v, v2, rtol=1e-6, atol=1e-9)
+
+    def test_supported(self):
+        self.assertTrue(columnar.ColumnarLog.supported(self.mlog))
+        self.assertEqual(len(self.messages), NUM_MSGS)
+
+    def test_simple(self):
+        self.compare('TST.V')
+        self.compare('TST.C')
+
+    def test_arithmetic(self):
+        self.compare('TST.V*2+TST.C')
+        self.compare('-TST.V')
+        self.compare('degrees(TST.V)')
+        self.compare('TST.C**2')
+
+    def test_zero_divisor(self):
+        '''rows which divide by zero are dropped'''
+        self.compare('TST.V/TST.C')
+        self.compare('TST.V%TST.C')
+
+    def test_domain_error(self):
+        '''rows outside a function's domain are dropped'''
+        self.compare('sqrt(TST.V-100)')
+        self.compare('log(TST.C)')
+        self.compare('asin(TST.C*0.5)')
+
+    def test_not_columnar(self):
+        '''expressions using several types or unknown functions are left
+        to the per-message path'''
+        for expression in ['TST.V+ATT.Roll', 'wrap_180(TST.V)', 'TST.V>1', '"a"']:
+            self.assertFalse(columnar.ColumnarExpression(expression).valid(), expression)
+        expr = columnar.ColumnarExpression('NONE.V')
+        self.assertIsNone(expr.evaluate(columnar.columnar_log(self.mlog)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+'''
+tests for interval_set
+
+AP_FLAKE8_CLEAN
+'''
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from MAVProxy.modules.lib.interval_set import IntervalSet
+
+
+class IntervalSetTest(unittest.TestCase):
+
+    def test_add_merge(self):
+        s = IntervalSet()
+        s.add(10, 20)
+        s.add(30, 40)
+        self.assertEqual(s.ranges(), [(10, 20), (30, 40)])
+        # touching ranges are merged
+        s.add(20, 25)
+        self.assertEqual(s.ranges(), [(10, 25), (30, 40)])
+        # a range covering several is merged with all of them
+        s.add(5, 35)
+        self.assertEqual(s.ranges(), [(5, 40)])
+        # empty ranges are ignored
+        s.add(50, 50)
+        self.assertEqual(s.ranges(), [(5, 40)])
+
+    def test_remove(self):
+        s = IntervalSet([(0, 100)])
+        s.remove(10, 20)
+        self.assertEqual(s.ranges(), [(0, 10), (20, 100)])
+        s.remove(5, 30)
+        self.assertEqual(s.ranges(), [(0, 5), (30, 100)])
+        s.remove(200, 300)
+        self.assertEqual(s.ranges(), [(0, 5), (30, 100)])
+        s.remove(0, 100)
+        self.assertEqual(s.ranges(), [])
+
+    def test_queries(self):
+        s = IntervalSet([(10, 20), (30, 40)])
+        self.assertTrue(s.overlaps(15, 16))
+        self.assertTrue(s.overlaps(0, 11))
+        self.assertFalse(s.overlaps(20, 30))
+        self.assertFalse(s.overlaps(40, 50))
+        self.assertTrue(s.contains(10, 20))
+        self.assertFalse(s.contains(15, 35))
+        self.assertEqual(s.total(), 20)
+        self.assertEqual(len(s), 20)
+        self.assertEqual(s.highest(), 40)
+        self.assertEqual(s.count(), 2)
+
+    def test_gaps(self):
+        s = IntervalSet([(10, 20), (30, 40)])
+        self.assertEqual(s.gaps(), [(0, 10), (20, 30)])
+        self.assertEqual(s.gaps(50), [(0, 10), (20, 30), (40, 50)])
+        self.assertEqual(s.gaps(50, max_gaps=2), [(0, 10), (20, 30)])
+        self.assertEqual(s.gaps(25), [(0, 10), (20, 25)])
+        self.assertEqual(s.missing(50), 30)
+
+    def test_random(self):
+        '''compare against a set of integers'''
+        rng = random.Random(2)
+        s = IntervalSet()
+        ref = set()
+        for i in range(2000):
+            start = rng.randint(0, 1000)
+            end = start + rng.randint(0, 50)
+            if rng.random() < 0.6:
+                s.add(start, end)
+                ref.update(range(start, end))
+            else:
+                s.remove(start, end)
+                ref.difference_update(range(start, end))
+            self.assertEqual(s.total(), len(ref))
+        expected = set()
+        for (start, end) in s.ranges():
+            expected.update(range(start, end))
+        self.assertEqual(expected, ref)
+        for (a, b) in zip(s.ranges(), s.ranges()[1:]):
+            # sorted, non-overlapping and not touching
+            self.assertLess(a[1], b[0])
+
+    def test_save_load(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'ranges.json')
+            s = IntervalSet([(0, 10), (20, 30)])
+            s.save(filename, extra={'size': 30})
+            (s2, extra) = IntervalSet.load(filename)
+            self.assertEqual(s2.ranges(), s.ranges())
+            self.assertEqual(extra, {'size': 30})
+            with open(filename, 'w') as f:
+                f.write('{bad')
+            self.assertEqual(IntervalSet.load(filename), (None, None))
+            self.assertEqual(IntervalSet.load(os.path.join(tmpdir, 'missing')), (None, None))
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+'''
+tests for mp_batch
+
+AP_FLAKE8_CLEAN
+'''
+
+import errno
+import unittest
+
+from MAVProxy.modules.lib.mp_batch import BatchWriter
+
+
+class Settings(object):
+    def __init__(self, latency=0, size=1400):
+        self.out_batch = True
+        self.out_batch_latency = latency
+        self.out_batch_size = size
+
+
+class Connection(object):
+    '''records each write as one element'''
+    def __init__(self, fail=False):
+        self.address = 'test'
+        self.writes = []
+        self.fail = fail
+
+    def write(self, buf):
+        if self.fail:
+            raise OSError(errno.ECONNREFUSED, "Connection refused")
+        self.writes.append(buf)
+
+
+class BatchWriterTest(unittest.TestCase):
+
+    def test_batch(self):
+        writer = BatchWriter(Settings())
+        conn = Connection()
+        for i in range(5):
+            writer.write(conn, b'%u' % i)
+        self.assertEqual(conn.writes, [])
+        writer.flush()
+        self.assertEqual(conn.writes, [b'01234'])
+        self.assertEqual((conn.batch_msgs, conn.batch_writes), (5, 1))
+
+    def test_size_limit(self):
+        writer = BatchWriter(Settings(size=4))
+        conn = Connection()
+        for i in range(5):
+            writer.write(conn, b'ab')
+        writer.flush()
+        self.assertEqual(conn.writes, [b'abab', b'abab', b'ab'])
+
+    def test_latency(self):
+        '''buffers are held until the latency has passed'''
+        writer = BatchWriter(Settings(latency=10000))
+        conn = Connection()
+        writer.write(conn, b'a')
+        writer.flush()
+        self.assertEqual(conn.writes, [])
+        writer.flush(force=True)
+        self.assertEqual(conn.writes, [b'a'])
+
+    def test_direct_write_order(self):
+        '''a direct write goes out after the pending batch'''
+        writer = BatchWriter(Settings(latency=10000))
+        conn = Connection()
+        writer.write(conn, b'a')
+        writer.write(conn, b'b')
+        conn.write(b'c')
+        writer.write(conn, b'd')
+        writer.flush(force=True)
+        self.assertEqual(conn.writes, [b'ab', b'c', b'd'])
+
+    def test_disabled(self):
+        settings = Settings()
+        settings.out_batch = False
+        writer = BatchWriter(settings)
+        conn = Connection()
+        writer.write(conn, b'a')
+        writer.write(conn, b'b')
+        self.assertEqual(conn.writes, [b'a', b'b'])
+
+    def test_write_error(self):
+        '''errors from a flush are counted rather than raised'''
+        writer = BatchWriter(Settings())
+        conn = Connection(fail=True)
+        writer.write(conn, b'a')
+        writer.flush()
+        writer.write(conn, b'b')
+        writer.flush()
+        self.assertEqual(conn.batch_errors, 2)
+        self.assertEqual(len(writer.pending), 0)
+
+    def test_discard(self):
+        writer = BatchWriter(Settings(latency=10000))
+        conn = Connection()
+        writer.write(conn, b'a')
+        writer.discard(conn)
+        writer.flush(force=True)
+        self.assertEqual(conn.writes, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+'''
+tests for output_policy
+
+AP_FLAKE8_CLEAN
+'''
+
+import unittest
+
+from MAVProxy.modules.lib.output_policy import OutputPolicy
+
+
+def make_policy(*args):
+    policy = OutputPolicy()
+    policy.parse(list(args))
+    return policy
+
+
+class OutputPolicyTest(unittest.TestCase):
+
+    def test_default(self):
+        policy = OutputPolicy()
+        self.assertTrue(policy.is_default())
+        self.assertTrue(all(policy.check('ATTITUDE', i * 0.01) for i in range(100)))
+
+    def test_rate(self):
+        '''a 2Hz limit on a 10Hz stream passes one message in five'''
+        policy = make_policy('rate=ATTITUDE:2')
+        passed = [i for i in range(100) if policy.check('ATTITUDE', i * 0.1)]
+        self.assertEqual(len(passed), 20)
+        self.assertEqual(passed[:3], [0, 5, 10])
+        # other types are not limited
+        self.assertTrue(all(policy.check('VFR_HUD', i * 0.1) for i in range(10)))
+
+    def test_rate_after_gap(self):
+        '''a gap in the stream does not allow a burst afterwards'''
+        policy = make_policy('rate=ATTITUDE:1')
+        self.assertTrue(policy.check('ATTITUDE', 0))
+        self.assertTrue(policy.check('ATTITUDE', 10))
+        self.assertFalse(policy.check('ATTITUDE', 10.1))
+        self.assertTrue(policy.check('ATTITUDE', 11))
+
+    def test_rate_zero(self):
+        policy = make_policy('rate=GPS_*:0')
+        self.assertFalse(policy.check('GPS_RAW_INT', 0))
+        self.assertTrue(policy.check('ATTITUDE', 0))
+
+    def test_allow_deny(self):
+        policy = make_policy('allow=ATTITUDE,GPS_*', 'deny=GPS_RTCM_DATA')
+        self.assertTrue(policy.check('ATTITUDE', 0))
+        self.assertTrue(policy.check('GPS_RAW_INT', 0))
+        self.assertFalse(policy.check('GPS_RTCM_DATA', 0))
+        self.assertFalse(policy.check('VFR_HUD', 0))
+        self.assertEqual(policy.passed, 2)
+        self.assertEqual(policy.dropped, 2)
+
+    def test_decimate(self):
+        policy = make_policy('decimate=3')
+        passed = [policy.check('ATTITUDE', 0) for i in range(9)]
+        self.assertEqual(passed.count(True), 3)
+
+    def test_per_vehicle(self):
+        '''each source system has its own rate budget'''
+        policy = make_policy('rate=ATTITUDE:1')
+        passed = [policy.check('ATTITUDE', i * 0.05, 1 + i % 2) for i in range(20)]
+        self.assertEqual(passed[:2], [True, True])
+        self.assertEqual(passed.count(True), 2)
+
+    def test_bad_options(self):
+        for args in [['rate=ATTITUDE'], ['rate=ATTITUDE:-1'], ['decimate=0'], ['bogus=1'], ['rate']]:
+            self.assertRaises(ValueError, make_policy, *args)
+
+
+if __name__ == '__main__':
+    unittest.main()
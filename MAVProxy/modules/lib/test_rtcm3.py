@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+'''
+tests for rtcm3
+
+AP_FLAKE8_CLEAN
+'''
+
+import random
+import unittest
+
+from MAVProxy.modules.lib import rtcm3
+
+
+def make_frame(msg_id, length):
+    '''build an RTCM3 frame with a valid CRC'''
+    body = bytearray([msg_id >> 4, (msg_id & 0xF) << 4])
+    body.extend(bytearray((i * 7) & 0xFF for i in range(length - 2)))
+    frame = bytearray([rtcm3.RTCMv3_PREAMBLE, length >> 8, length & 0xFF])
+    frame.extend(body)
+    crc = rtcm3.crc24(frame)
+    frame.extend(bytearray([crc >> 16, (crc >> 8) & 0xFF, crc & 0xFF]))
+    return bytes(frame)
+
+
+def parse_bytewise(data):
+    '''frames found by the byte at a time parser'''
+    parser = rtcm3.RTCM3()
+    ret = []
+    for i in range(len(data)):
+        if parser.read(data[i:i+1]):
+            ret.append(bytes(parser.get_packet()))
+    return ret
+
+
+class RTCM3FramerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.frames = [make_frame(1005 + i % 3, 20 + 13 * i) for i in range(30)]
+        self.stream = b''.join(self.frames)
+
+    def test_whole(self):
+        framer = rtcm3.RTCM3Framer()
+        self.assertEqual(framer.read(self.stream), self.frames)
+        self.assertEqual(framer.pending(), 0)
+        self.assertEqual(framer.frames, len(self.frames))
+
+    def test_chunks(self):
+        '''frames split across reads of any size are reassembled'''
+        rng = random.Random(1)
+        framer = rtcm3.RTCM3Framer()
+        frames = []
+        ofs = 0
+        while ofs < len(self.stream):
+            n = rng.randint(1, 300)
+            frames.extend(framer.read(self.stream[ofs:ofs+n]))
+            ofs += n
+        self.assertEqual(frames, self.frames)
+
+    def test_packet_id(self):
+        self.assertEqual(rtcm3.packet_ID(self.frames[0]), 1005)
+        self.assertEqual(rtcm3.packet_ID(self.frames[1]), 1006)
+        self.assertIsNone(rtcm3.packet_ID(b'\xd3\x00'))
+
+    def test_garbage(self):
+        '''bytes between frames are skipped'''
+        garbage = b'\x01\x02\xd3\x00\x00\xff'
+        data = garbage + self.frames[0] + garbage + self.frames[1]
+        framer = rtcm3.RTCM3Framer()
+        self.assertEqual(framer.read(data), self.frames[:2])
+        self.assertEqual(framer.skipped, 2 * len(garbage))
+
+    def test_crc_error(self):
+        '''a corrupt frame is dropped and the following frames are found'''
+        bad = bytearray(self.frames[1])
+        bad[10] ^= 0xFF
+        data = self.frames[0] + bytes(bad) + self.frames[2]
+        framer = rtcm3.RTCM3Framer()
+        self.assertEqual(framer.read(data), [self.frames[0], self.frames[2]])
+        self.assertEqual(framer.crc_errors, 1)
+
+    def test_same_as_bytewise(self):
+        '''the framer gives the same frames as the byte at a time parser'''
+        bad = bytearray(self.frames[3])
+        bad[-1] ^= 0x55
+        data = b'\x00\xd3' + self.stream[:200] + bytes(bad) + self.stream[200:]
+        framer = rtcm3.RTCM3Framer()
+        self.assertEqual(framer.read(data), parse_bytewise(data))
+
+
+class DatagramTest(unittest.TestCase):
+
+    def setUp(self):
+        self.frames = [make_frame(1005 + i % 3, 20 + 13 * i) for i in range(4)]
+        self.ubx = b'\xb5\x62\x01\x07' + bytes(range(40))
+
+    def test_split(self):
+        '''frames split across datagrams are reassembled'''
+        framer = rtcm3.RTCM3Framer()
+        data = b''.join(self.frames)
+        ret = []
+        for ofs in range(0, len(data), 30):
+            ret.extend(framer.read_datagram(data[ofs:ofs+30]))
+        self.assertEqual(ret, self.frames)
+        self.assertEqual(framer.pending(), 0)
+
+    def test_passthrough(self):
+        '''other protocols are passed through unchanged'''
+        framer = rtcm3.RTCM3Framer()
+        self.assertEqual(framer.read_datagram(self.ubx), [self.ubx])
+        self.assertEqual(framer.read_datagram(self.frames[0]), [self.frames[0]])
+        self.assertEqual(framer.read_datagram(self.ubx), [self.ubx])
+
+    def test_bad_preamble(self):
+        '''a partial frame followed by data which can't continue it is
+        dropped, and the data passed through'''
+        framer = rtcm3.RTCM3Framer()
+        self.assertEqual(framer.read_datagram(b'\xd3'), [])
+        self.assertEqual(framer.read_datagram(self.ubx), [self.ubx])
+        self.assertEqual(framer.pending(), 0)
+        self.assertEqual(framer.skipped, 1)
+
+    def test_interrupted(self):
+        '''a datagram arriving in the middle of a frame fails the CRC,
+        and the datagrams held behind the partial frame are handled again'''
+        framer = rtcm3.RTCM3Framer()
+        frame = self.frames[3]
+        self.assertEqual(framer.read_datagram(frame[:10]), [])
+        self.assertEqual(framer.read_datagram(self.ubx), [])
+        self.assertEqual(framer.read_datagram(self.frames[0]), [self.ubx, self.frames[0]])
+        self.assertEqual(framer.crc_errors, 1)
+        self.assertEqual(framer.skipped, 10)
+        self.assertEqual(framer.read_datagram(self.frames[1]), [self.frames[1]])
+
+
+if __name__ == '__main__':
+    unittest.main()
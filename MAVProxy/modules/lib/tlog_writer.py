@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+'''
+telemetry log writer
+
+records are packed into preallocated buffers on the calling thread
+and handed in batches to a background thread which does all file IO,
+optional gzip or zstd compression and size or time based rotation of
+the log. If the disk can't keep up, whole batches are dropped rather
+than letting the queue grow without bound
+
+AP_FLAKE8_CLEAN
+'''
+
+import gzip
+import os
+import queue
+import struct
+import threading
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class TLogWriter(object):
+    '''asynchronous, optionally compressed and rotating log writer
+
+    settings must provide:
+      flushlogs          flush the file for every record
+      log_rotate_size    rotate after this many MB, 0 to disable
+      log_rotate_time    rotate after this many minutes, 0 to disable
+      log_compress       none, gzip or zstd
+    '''
+    def __init__(self, settings, batch_size=64*1024, max_pending=64*1024*1024, flush_interval=0.5):
+        self.settings = settings
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.free = []
+        self.buf = bytearray(batch_size)
+        self.ofs = 0
+        self.nrecords = 0
+        self.pending_bytes = 0
+        self.path = None
+        self.mode = 'wb'
+        self.fh = None
+        self.compression = None
+        self.segment = 0
+        self.segment_bytes = 0
+        self.segment_start = 0
+        self.files = []
+        self.thread = None
+        self.error = None
+
+        # statistics
+        self.bytes_written = 0
+        self.records_written = 0
+        self.dropped = 0
+        self.rate = 0
+        self.rate_bytes = 0
+        self.rate_time = time.time()
+
+    def put_msg(self, usec, msgbuf):
+        '''add a tlog record: 64 bit big-endian timestamp then the message'''
+        if self.error is not None:
+            return
+        n = len(msgbuf) + 8
+        with self.lock:
+            if self.ofs + n > len(self.buf):
+                self.queue_buffer(n)
+            struct.pack_into('>Q', self.buf, self.ofs, usec)
+            self.buf[self.ofs+8:self.ofs+n] = msgbuf
+            self.ofs += n
+            self.nrecords += 1
+            if self.settings.flushlogs:
+                self.queue_buffer()
+
+    def put(self, data):
+        '''add pre-formatted data to the log'''
+        if self.error is not None:
+            return
+        n = len(data)
+        with self.lock:
+            if self.ofs + n > len(self.buf):
+                self.queue_buffer(n)
+            self.buf[self.ofs:self.ofs+n] = data
+            self.ofs += n
+            self.nrecords += 1
+            if self.settings.flushlogs:
+                self.queue_buffer()
+
+    def queue_buffer(self, need=0):
+        '''pass the current buffer to the writer thread. Must be called
+        with the lock held'''
+        if self.ofs > 0:
+            if self.pending_bytes + self.ofs > self.max_pending:
+                # the writer is not keeping up, drop this batch
+                self.dropped += self.nrecords
+            else:
+                self.queue.put((self.buf, self.ofs, self.nrecords))
+                self.pending_bytes += self.ofs
+                if len(self.free) > 0:
+                    self.buf = self.free.pop()
+                else:
+                    self.buf = bytearray(self.batch_size)
+        if need > len(self.buf):
+            self.buf = bytearray(need)
+        self.ofs = 0
+        self.nrecords = 0
+
+    def segment_path(self):
+        '''path of the current log segment, including any compression suffix'''
+        path = self.path
+        if self.segment > 1:
+            (base, ext) = os.path.splitext(path)
+            path = "%s.%u%s" % (base, self.segment, ext)
+        if self.compression == 'gzip':
+            path += '.gz'
+        elif self.compression == 'zstd':
+            path += '.zst'
+        return path
+
+    def open_segment(self):
+        '''open the next log segment'''
+        self.compression = self.settings.log_compress
+        if self.compression == 'zstd' and zstandard is None:
+            print("zstandard not installed, using gzip for logs")
+            self.compression = 'gzip'
+        self.segment += 1
+        path = self.segment_path()
+        if self.segment > 1:
+            # segments from an earlier run of an appended log are kept
+            while os.path.exists(path):
+                self.segment += 1
+                path = self.segment_path()
+        if self.compression == 'gzip':
+            self.fh = gzip.open(path, self.mode)
+        elif self.compression == 'zstd':
+            self.fh = zstandard.ZstdCompressor().stream_writer(open(path, self.mode))
+        else:
+            self.fh = open(path, self.mode)
+        self.segment_bytes = 0
+        self.segment_start = time.time()
+        self.files.append(path)
+
+    def close_segment(self):
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+
+    def check_rotate(self):
+        '''start a new segment if the current one is big or old enough'''
+        rotate_size = self.settings.log_rotate_size * 1024 * 1024
+        rotate_time = self.settings.log_rotate_time * 60
+        if ((rotate_size > 0 and self.segment_bytes >= rotate_size) or
+                (rotate_time > 0 and time.time() - self.segment_start >= rotate_time)):
+            self.close_segment()
+            # rotated segments are always new files
+            self.mode = 'wb'
+            self.open_segment()
+
+    def start(self, path, mode='wb'):
+        '''open the log and start the writer thread. Records added
+        before start are queued'''
+        self.path = path
+        self.mode = mode
+        self.open_segment()
+        self.thread = threading.Thread(target=self.writer_thread, name='log_writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write_batch(self, buf, length, nrecords):
+        with memoryview(buf) as mv:
+            self.fh.write(mv[:length])
+        self.bytes_written += length
+        self.segment_bytes += length
+        self.records_written += nrecords
+        with self.lock:
+            self.pending_bytes -= length
+            if len(buf) == self.batch_size and len(self.free) < 4:
+                self.free.append(buf)
+
+    def update_rate(self):
+        now = time.time()
+        dt = now - self.rate_time
+        if dt >= 1:
+            self.rate = (self.bytes_written - self.rate_bytes) / dt
+            self.rate_bytes = self.bytes_written
+            self.rate_time = now
+
+    def writer_thread(self):
+        '''log writing thread'''
+        try:
+            self.writer_loop()
+        except (IOError, OSError) as e:
+            # stop accepting records rather than losing them silently
+            self.error = e
+            print("ERROR: writing %s failed: %s" % (self.segment_path(), str(e)))
+            try:
+                self.close_segment()
+            except (IOError, OSError):
+                self.fh = None
+
+    def writer_loop(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                # push out partial batches so the log on disk stays current
+                with self.lock:
+                    self.queue_buffer()
+                if self.queue.empty():
+                    self.fh.flush()
+                    self.update_rate()
+                    self.check_rotate()
+                continue
+            if item is None:
+                break
+            self.write_batch(*item)
+            if self.queue.empty() or self.settings.flushlogs:
+                self.fh.flush()
+            self.update_rate()
+            self.check_rotate()
+        self.close_segment()
+
+    def close(self, timeout=5):
+        '''write out all pending records and close the log'''
+        with self.lock:
+            self.queue_buffer()
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join(timeout=timeout)
+        self.thread = None
+
+    def status_string(self):
+        '''return a string describing the writer state'''
+        ret = ("%s: queue=%ukB written=%uMB records=%u rate=%.1fkB/s dropped=%u segments=%u" %
+               (os.path.basename(self.path or 'log'),
+                self.pending_bytes // 1024,
+                self.bytes_written // (1024 * 1024),
+                self.records_written,
+                self.rate / 1024.0,
+                self.dropped,
+                len(self.files)))
+        if self.error is not None:
+            ret += " error=%s" % str(self.error)
+        return ret
@@ -6,7 +6,7 @@
 import threading
 import sys, time
 
-from MAVProxy.modules.lib.wxconsole_util import Value, Text
+from MAVProxy.modules.lib.wxconsole_util import Value, Text, Batch
 from MAVProxy.modules.lib import textconsole
 from MAVProxy.modules.lib import win_layout
 from MAVProxy.modules.lib import multiproc
@@ -16,10 +16,23 @@ class MessageConsole(textconsole.SimpleConsole):
     a message console for MAVProxy
     '''
     def __init__(self,
-                 title='MAVProxy: console'):
+                 title='MAVProxy: console',
+                 update_rate=10):
         textconsole.SimpleConsole.__init__(self)
         self.title = title
         self.menu_callback = None
+        # updates are held here and sent to the child at update_rate Hz
+        self.update_rate = update_rate
+        self.lock = threading.Lock()
+        # values the child has, values being sent and values to send
+        self.status_sent = {}
+        self.status_sending = {}
+        self.status_pending = {}
+        self.text_pending = []
+        self.menu_pending = None
+        self.layout_pending = None
+        self.send_lock = threading.Lock()
+        self.child_exited = False
         self.parent_pipe_recv,self.child_pipe_send = multiproc.Pipe(duplex=False)
         self.child_pipe_recv,self.parent_pipe_send = multiproc.Pipe(duplex=False)
         self.close_event = multiproc.Event()
@@ -31,6 +44,9 @@ class MessageConsole(textconsole.SimpleConsole):
         t = threading.Thread(target=self.watch_thread)
         t.daemon = True
         t.start()
+        t = threading.Thread(target=self.flush_thread)
+        t.daemon = True
+        t.start()
 
     def child_task(self):
         '''child process - this holds all the GUI elements'''
@@ -60,29 +76,98 @@ class MessageConsole(textconsole.SimpleConsole):
         except EOFError:
             pass
 
+    def flush_thread(self):
+        '''send pending updates to the child at the update rate'''
+        while not self.close_event.is_set():
+            time.sleep(1.0 / max(self.update_rate, 0.1))
+            if not self.is_alive():
+                with self.lock:
+                    self.child_exited = True
+                    self.status_pending = {}
+                    self.text_pending = []
+                    self.menu_pending = None
+                    self.layout_pending = None
+                break
+            self.flush()
+
+    def flush(self):
+        '''send pending updates to the child as one message'''
+        with self.lock:
+            status = self.status_pending
+            self.status_sending = dict([(name, (v.text, v.row, v.fg, v.bg)) for (name, v) in status.items()])
+            items = list(status.values())
+            items.extend(self.text_pending)
+            if self.menu_pending is not None:
+                items.append(self.menu_pending)
+            if self.layout_pending is not None:
+                items.append(self.layout_pending)
+            self.status_pending = {}
+            self.text_pending = []
+            self.menu_pending = None
+            self.layout_pending = None
+        if len(items) == 0:
+            return
+        with self.send_lock:
+            try:
+                self.parent_pipe_send.send(Batch(items))
+            except Exception:
+                # resend the status values next time unless they have
+                # been replaced
+                with self.lock:
+                    for (name, v) in status.items():
+                        if name not in self.status_pending:
+                            self.status_pending[name] = v
+                    self.status_sending = {}
+                return
+        with self.lock:
+            self.status_sent.update(self.status_sending)
+            self.status_sending = {}
+
     def set_layout(self, layout):
         '''set window layout'''
-        self.parent_pipe_send.send(layout)
+        with self.lock:
+            self.layout_pending = layout
         
     def write(self, text, fg='black', bg='white'):
         '''write to the console'''
-        try:
-            self.parent_pipe_send.send(Text(text, fg, bg))
-        except Exception:
-            pass
+        if not isinstance(text, str):
+            text = str(text)
+        with self.lock:
+            if self.child_exited:
+                return
+            if len(self.text_pending) > 0:
+                last = self.text_pending[-1]
+                if last.fg == fg and last.bg == bg:
+                    # join with the previous text of the same colours
+                    last.text += text
+                    return
+            self.text_pending.append(Text(text, fg, bg))
 
     def set_status(self, name, text='', row=0, fg='black', bg='white'):
-        '''set a status value'''
-        if self.is_alive():
-            self.parent_pipe_send.send(Value(name, text, row, fg, bg))
+        '''set a status value. Only changed values are sent'''
+        value = (text, row, fg, bg)
+        with self.lock:
+            if self.child_exited:
+                return
+            if name in self.status_sending:
+                current = self.status_sending[name]
+            else:
+                current = self.status_sent.get(name, None)
+            if current == value:
+                # back to the value the child has or is being sent
+                self.status_pending.pop(name, None)
+                return
+            self.status_pending[name] = Value(name, text, row, fg, bg)
 
     def set_menu(self, menu, callback):
-        if self.is_alive():
-            self.parent_pipe_send.send(menu)
+        with self.lock:
+            # only the latest menu matters
+            self.menu_pending = menu
             self.menu_callback = callback
 
     def close(self):
         '''close the console'''
+        self.flush()
         self.close_event.set()
         if self.is_alive():
             self.child.join(2)
@@ -3,7 +3,7 @@ import time
 import platform
 import socket
 from MAVProxy.modules.lib import mp_menu
-from MAVProxy.modules.lib.wxconsole_util import Value, Text
+from MAVProxy.modules.lib.wxconsole_util import Value, Text, Batch
 from MAVProxy.modules.lib.wx_loader import wx
 from MAVProxy.modules.lib import win_layout
 from MAVProxy.modules.lib import icon
@@ -112,55 +112,75 @@ class ConsoleFrame(wx.Frame):
             except Exception:
                 break
                 
-            if isinstance(obj, Value):
-                # request to set a status field
-                if not obj.name in self.values:
-                    # create a new status field
-                    value = wx.StaticText(self.panel, -1, obj.text)
-                    # possibly add more status rows
-                    for i in range(len(self.status), obj.row+1):
-                        self.status.append(wx.BoxSizer(wx.HORIZONTAL))
-                        self.vbox.Insert(len(self.status)-1, self.status[i], 0, flag=wx.ALIGN_LEFT | wx.TOP)
-                        self.vbox.Layout()
-                    self.status[obj.row].Add(value, border=5)
-                    self.status[obj.row].AddSpacer(20)
-                    self.values[obj.name] = value
-                value = self.values[obj.name]
-                value.SetForegroundColour(obj.fg)
-                value.SetBackgroundColour(obj.bg)
-                # workaround wx bug on windows
-                value._foregroundColour = obj.fg
-                value.SetLabel(obj.text)
-                if platform.system() == 'Windows':
-                    # more working around wx bugs in windows; without
-                    # these the display does not update on colour change
-                    value.Refresh()
-                    value.Update()
+            if isinstance(obj, Batch):
+                # a batch of updates from the parent, only lay out
+                # the panel once
+                relayout = False
+                for item in obj.items:
+                    if isinstance(item, Value):
+                        self.set_value(item)
+                        relayout = True
+                    else:
+                        self.handle_object(item)
+                if relayout:
+                    self.panel.Layout()
+            elif isinstance(obj, Value):
+                self.set_value(obj)
                 self.panel.Layout()
-            elif isinstance(obj, Text):
-                '''request to add text to the console'''
-                self.pending.append(obj)
-                for p in self.pending:
-                    # we're scrolled at the bottom
-                    oldstyle = self.control.GetDefaultStyle()
-                    style = wx.TextAttr()
-                    style.SetTextColour(p.fg)
-                    style.SetBackgroundColour(p.bg)
-                    self.control.SetDefaultStyle(style)
-                    self.control.AppendText(p.text)
-                    self.control.SetDefaultStyle(oldstyle)
-                self.pending = []
-            elif isinstance(obj, mp_menu.MPMenuTop):
-                if obj is not None:
-                    self.SetMenuBar(None)
-                    self.menu = obj
-                    self.SetMenuBar(self.menu.wx_menu())
-                    self.Bind(wx.EVT_MENU, self.on_menu)
-                self.Refresh()
-                self.Update()
-            elif isinstance(obj, win_layout.WinLayout):
-                win_layout.set_wx_window_layout(self, obj)
+            else:
+                self.handle_object(obj)
 
         self.timer.Stop()
         self.Destroy()
         return
+
+    def set_value(self, obj):
+        '''request to set a status field'''
+        if not obj.name in self.values:
+            # create a new status field
+            value = wx.StaticText(self.panel, -1, obj.text)
+            # possibly add more status rows
+            for i in range(len(self.status), obj.row+1):
+                self.status.append(wx.BoxSizer(wx.HORIZONTAL))
+                self.vbox.Insert(len(self.status)-1, self.status[i], 0, flag=wx.ALIGN_LEFT | wx.TOP)
+                self.vbox.Layout()
+            self.status[obj.row].Add(value, border=5)
+            self.status[obj.row].AddSpacer(20)
+            self.values[obj.name] = value
+        value = self.values[obj.name]
+        value.SetForegroundColour(obj.fg)
+        value.SetBackgroundColour(obj.bg)
+        # workaround wx bug on windows
+        value._foregroundColour = obj.fg
+        value.SetLabel(obj.text)
+        if platform.system() == 'Windows':
+            # more working around wx bugs in windows; without
+            # these the display does not update on colour change
+            value.Refresh()
+            value.Update()
+
+    def handle_object(self, obj):
+        '''handle text, menu and layout objects from the parent'''
+        if isinstance(obj, Text):
+            '''request to add text to the console'''
+            self.pending.append(obj)
+            for p in self.pending:
+                # we're scrolled at the bottom
+                oldstyle = self.control.GetDefaultStyle()
+                style = wx.TextAttr()
+                style.SetTextColour(p.fg)
+                style.SetBackgroundColour(p.bg)
+                self.control.SetDefaultStyle(style)
+                self.control.AppendText(p.text)
+                self.control.SetDefaultStyle(oldstyle)
+            self.pending = []
+        elif isinstance(obj, mp_menu.MPMenuTop):
+            if obj is not None:
+                self.SetMenuBar(None)
+                self.menu = obj
+                self.SetMenuBar(self.menu.wx_menu())
+                self.Bind(wx.EVT_MENU, self.on_menu)
+            self.Refresh()
+            self.Update()
+        elif isinstance(obj, win_layout.WinLayout):
+            win_layout.set_wx_window_layout(self, obj)
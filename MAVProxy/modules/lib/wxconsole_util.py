@@ -5,6 +5,11 @@ class Text():
         self.fg = fg
         self.bg = bg
 
+class Batch():
+    '''a batch of Value, Text and menu updates sent together'''
+    def __init__(self, items):
+        self.items = items
+
 class Value():
     '''a value for the status bar'''
     def __init__(self, name, text, row=0, fg='black', bg='white'):
@@ -12,6 +12,7 @@ from MAVProxy.modules.lib import textconsole
 from pymavlink import mavutil
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import mp_module
+from MAVProxy.modules.lib import mp_expression
 from MAVProxy.modules.lib import mp_settings
 from MAVProxy.modules.lib import wxsettings
 from MAVProxy.modules.lib.mp_menu import *
@@ -21,6 +22,7 @@ green = (0, 128, 0)
 class DisplayItem:
     def __init__(self, fmt, expression, row):
         self.expression = expression.strip('"\'')
+        self.compiled = mp_expression.compile_expression(self.expression)
         self.format = fmt.strip('"\'')
         re_caps = re.compile('[A-Z_][A-Z0-9_]+')
         self.msg_types = set(re.findall(re_caps, expression))
@@ -79,6 +81,7 @@ class ConsoleModule(mp_module.MPModule):
 
         self.console_settings = mp_settings.MPSettings([
             ('debug_level', int, 0),
+            ('update_rate', float, 10),
         ])
 
         self.vehicle_list = []
@@ -163,6 +166,8 @@ class ConsoleModule(mp_module.MPModule):
     def cmd_set(self, args):
         '''set console options'''
         self.console_settings.command(args)
+        if isinstance(self.mpstate.console, wxconsole.MessageConsole):
+            self.mpstate.console.update_rate = self.console_settings.update_rate
 
     def remove_menu(self, menu):
         '''add a new menu'''
@@ -784,7 +789,7 @@ class ConsoleModule(mp_module.MPModule):
             if type in self.user_added[id].msg_types:
                 d = self.user_added[id]
                 try:
-                    val = mavutil.evaluate_expression(d.expression, self.master.messages)
+                    val = d.compiled.evaluate(self.master.messages)
                     console_string = d.format % val
                 except Exception as ex:
                     console_string = "????"
@@ -16,6 +16,7 @@ except ImportError:
 
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_settings
+from MAVProxy.modules.lib.interval_set import IntervalSet
 
 # opcodes
 OP_None = 0
@@ -53,6 +54,14 @@ ERR_FileNotFound = 10
 HDR_Len = 12
 MAX_Payload = 239
 
+# bounds on the retransmit timeout for gap reads
+MIN_RTO = 0.05
+MAX_RTO = 5.0
+
+# CRC requests are resent if no reply arrives within CRC_TIMEOUT
+CRC_TIMEOUT = 1.0
+CRC_RETRIES = 2
+
 class FTP_OP:
     def __init__(self, seq, session, opcode, size, req_opcode, burst_complete, offset, payload):
         self.seq = seq
@@ -97,6 +106,7 @@ class WriteQueue:
 class FTPModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(FTPModule, self).__init__(mpstate, "ftp", public=True)
+        self.subscribe_mavlink_packets(['FILE_TRANSFER_PROTOCOL'])
         self.add_command('ftp', self.cmd_ftp, "file transfer",
                          ["<list|get|rm|rmdir|rename|mkdir|crc|cancel|status>",
                           "set (FTPSETTING)",
@@ -106,6 +116,7 @@ class FTPModule(mp_module.MPModule):
              ('pkt_loss_tx', int, 0),
              ('pkt_loss_rx', int, 0),
              ('max_backlog', int, 5),
+             ('max_window', int, 32),
              ('burst_read_size', int, 80),
              ('write_size', int, 80),
              ('write_qsize', int, 5),
@@ -120,12 +131,28 @@ class FTPModule(mp_module.MPModule):
         self.filename = None
         self.callback = None
         self.callback_progress = None
+        self.get_fh = None
+        # parts of get_fh already held when continuing a download
+        self.get_received = None
+        self.crc_callback = None
+        # name of the file for an outstanding CRC request
+        self.crc_name = None
+        self.crc_time = None
+        self.crc_retries = 0
         self.put_callback = None
         self.put_callback_progress = None
         self.total_size = 0
-        self.read_gaps = []
+        # missing parts of the file below the burst read position
+        self.read_gaps = IntervalSet()
+        # outstanding gap reads, offset -> (length, send time)
         self.read_gap_times = {}
-        self.last_gap_send = 0
+        # offsets of gap reads which have been resent
+        self.read_gap_resent = set()
+        self.read_window = self.ftp_settings.max_backlog
+        self.read_ssthresh = self.ftp_settings.max_window
+        self.read_srtt = None
+        self.read_rttvar = 0
+        self.last_read_loss = 0
         self.read_retries = 0
         self.read_total = 0
         self.duplicates = 0
@@ -136,7 +163,6 @@ class FTPModule(mp_module.MPModule):
         self.last_op_time = time.time()
         self.rtt = 0.5
         self.reached_eof = False
-        self.backlog = 0
         self.burst_size = self.ftp_settings.burst_read_size
         self.write_list = None
         self.write_block_size = 0
@@ -198,10 +224,19 @@ class FTPModule(mp_module.MPModule):
             print("> %s dt=%.2f" % (op, now - self.last_op_time))
         self.last_op_time = time.time()
 
+    def is_idle(self):
+        '''return True if ftp can be used without disturbing a transfer or
+        CRC request in progress. fh is only set once an open succeeds, so
+        an open in progress is seen by its callback'''
+        return (self.fh is None and self.callback is None and
+                self.write_list is None and self.crc_name is None)
+
     def terminate_session(self):
         '''terminate current session'''
         self.send(FTP_OP(self.seq, self.session, OP_TerminateSession, 0, 0, 0, 0, None))
         self.fh = None
+        self.get_fh = None
+        self.get_received = None
         self.filename = None
         self.write_list = None
         if self.callback is not None:
@@ -215,14 +250,16 @@ class FTPModule(mp_module.MPModule):
         if self.put_callback_progress is not None:
             self.put_callback_progress(None)
             self.put_callback_progress = None
-        self.read_gaps = []
+        if self.crc_name is not None:
+            self.crc_fail()
+        self.read_gaps = IntervalSet()
         self.read_total = 0
         self.read_gap_times = {}
+        self.read_gap_resent = set()
         self.last_read = None
         self.last_burst_read = None
         self.session = (self.session + 1) % 256
         self.reached_eof = False
-        self.backlog = 0
         self.duplicates = 0
         if self.ftp_settings.debug > 0:
             print("Terminated session")
@@ -275,8 +312,10 @@ class FTPModule(mp_module.MPModule):
         else:
             print('LIST: %s' % op)
 
-    def cmd_get(self, args, callback=None, callback_progress=None):
-        '''get file'''
+    def cmd_get(self, args, callback=None, callback_progress=None, fh=None, received=None):
+        '''get file. If fh is given the data is written to it rather than
+        to a new file or an in-memory buffer. received is an IntervalSet
+        of the parts of fh already held, which are not fetched again'''
         if len(args) == 0:
             print("Usage: get FILENAME <LOCALNAME>")
             return
@@ -291,9 +330,13 @@ class FTPModule(mp_module.MPModule):
         self.op_start = time.time()
         self.callback = callback
         self.callback_progress = callback_progress
+        self.get_fh = fh
+        self.get_received = received
         self.read_retries = 0
         self.duplicates = 0
         self.reached_eof = False
+        self.read_window = max(self.ftp_settings.max_backlog, 1)
+        self.read_ssthresh = max(self.ftp_settings.max_window, 1)
         self.burst_size = self.ftp_settings.burst_read_size
         if self.burst_size < 1:
             self.burst_size = 239
@@ -310,7 +353,9 @@ class FTPModule(mp_module.MPModule):
             if self.filename is None:
                 return
             try:
-                if self.callback is not None or self.filename == '-':
+                if self.get_fh is not None:
+                    self.fh = self.get_fh
+                elif self.callback is not None or self.filename == '-':
                     self.fh = SIO()
                 else:
                     self.fh = open(self.filename, 'wb')
@@ -318,7 +363,14 @@ class FTPModule(mp_module.MPModule):
                 print("Failed to open %s: %s" % (self.filename, ex))
                 self.terminate_session()
                 return
-            read = FTP_OP(self.seq, self.session, OP_BurstReadFile, self.burst_size, 0, 0, 0, None)
+            start = 0
+            if self.get_received is not None and self.get_received.count() > 0:
+                # continue after the data we hold, filling the gaps below it
+                start = self.get_received.highest()
+                self.read_gaps = IntervalSet(self.get_received.gaps(start))
+                self.read_total = self.get_received.total()
+                self.fh.seek(start)
+            read = FTP_OP(self.seq, self.session, OP_BurstReadFile, self.burst_size, 0, 0, start, None)
             self.last_burst_read = time.time()
             self.send(read)
         else:
@@ -326,9 +378,19 @@ class FTPModule(mp_module.MPModule):
                 print("ftp open failed")
             self.terminate_session()
 
+    def received_ranges(self):
+        '''return an IntervalSet of the parts of the file being read which
+        have been received, or None if no read is in progress'''
+        if self.fh is None:
+            return None
+        ranges = IntervalSet([(0, self.fh.tell())])
+        for (start, end) in self.read_gaps.ranges():
+            ranges.remove(start, end)
+        return ranges
+
     def check_read_finished(self):
         '''check if download has completed'''
-        if self.reached_eof and len(self.read_gaps) == 0:
+        if self.reached_eof and self.read_gaps.count() == 0:
             ofs = self.fh.tell()
             dt = time.time() - self.op_start
             rate = (ofs / dt) / 1024.0
@@ -381,12 +443,11 @@ class FTPModule(mp_module.MPModule):
             ofs = self.fh.tell()
             if op.offset < ofs:
                 # writing an earlier portion, possibly remove a gap
-                gap = (op.offset, len(op.payload))
-                if gap in self.read_gaps:
-                    self.read_gaps.remove(gap)
-                    self.read_gap_times.pop(gap)
+                end = op.offset + len(op.payload)
+                if self.read_gaps.overlaps(op.offset, end):
+                    self.read_gaps.remove(op.offset, end)
                     if self.ftp_settings.debug > 0:
-                        print("FTP: removed gap", gap, self.reached_eof, len(self.read_gaps))
+                        print("FTP: removed gap", (op.offset, end), self.reached_eof, self.read_gaps.count())
                 else:
                     if self.ftp_settings.debug > 0:
                         print("FTP: dup read reply at %u of len %u ofs=%u" % (op.offset, op.size, self.fh.tell()))
@@ -398,17 +459,7 @@ class FTPModule(mp_module.MPModule):
                     return
             elif op.offset > ofs:
                 # we have a gap
-                gap = (ofs, op.offset-ofs)
-                max_read = self.burst_size
-                while True:
-                    if gap[1] <= max_read:
-                        self.read_gaps.append(gap)
-                        self.read_gap_times[gap] = 0
-                        break
-                    g = (gap[0], max_read)
-                    self.read_gaps.append(g)
-                    self.read_gap_times[g] = 0
-                    gap = (gap[0] + max_read, gap[1] - max_read)
+                self.read_gaps.add(ofs, op.offset)
                 self.write_payload(op)
             else:
                 self.write_payload(op)
@@ -417,7 +468,7 @@ class FTPModule(mp_module.MPModule):
                     # a burst complete with non-zero size and less than burst packet size
                     # means EOF
                     if not self.reached_eof and self.ftp_settings.debug > 0:
-                        print("EOF at %u with %u gaps t=%.2f" % (self.fh.tell(), len(self.read_gaps), time.time() - self.op_start))
+                        print("EOF at %u with %u gaps t=%.2f" % (self.fh.tell(), self.read_gaps.count(), time.time() - self.op_start))
                     self.reached_eof = True
                     if self.check_read_finished():
                         return
@@ -439,7 +490,7 @@ class FTPModule(mp_module.MPModule):
                         print("burst lost EOF %u %u" % (self.fh.tell(), op.offset))
                     return
                 if not self.reached_eof and self.ftp_settings.debug > 0:
-                    print("EOF at %u with %u gaps t=%.2f" % (self.fh.tell(), len(self.read_gaps), time.time() - self.op_start))
+                    print("EOF at %u with %u gaps t=%.2f" % (self.fh.tell(), self.read_gaps.count(), time.time() - self.op_start))
                 self.reached_eof = True
                 if self.check_read_finished():
                     return
@@ -456,32 +507,70 @@ class FTPModule(mp_module.MPModule):
                 print("FTP Unexpected read reply")
                 print(op)
             return
-        if self.backlog > 0:
-            self.backlog -= 1
         if op.opcode == OP_Ack and self.fh is not None:
-            gap = (op.offset, op.size)
-            if gap in self.read_gaps:
-                self.read_gaps.remove(gap)
-                self.read_gap_times.pop(gap)
+            req = self.read_gap_times.pop(op.offset, None)
+            if req is not None:
+                self.read_gap_acked(op.offset, req[1])
+            end = op.offset + op.size
+            if self.read_gaps.overlaps(op.offset, end):
+                self.read_gaps.remove(op.offset, end)
                 ofs = self.fh.tell()
                 self.write_payload(op)
                 self.fh.seek(ofs)
                 if self.ftp_settings.debug > 0:
-                    print("FTP: removed gap", gap, self.reached_eof, len(self.read_gaps))
+                    print("FTP: removed gap", (op.offset, end), self.reached_eof, self.read_gaps.count())
                 if self.check_read_finished():
                     return
-            elif op.size < self.burst_size:
-                print("FTP: file size changed to %u" % op.offset+op.size)
-                self.terminate_session()
-            else:
+            elif req is None or op.size >= req[0]:
                 self.duplicates += 1
                 if self.ftp_settings.debug > 0:
-                    print("FTP: no gap read", gap, len(self.read_gaps))
+                    print("FTP: no gap read", (op.offset, end), self.read_gaps.count())
+            if req is not None and op.size < req[0]:
+                print("FTP: file size changed to %u" % end)
+                self.terminate_session()
+                return
         elif op.opcode == OP_Nack:
-            print("Read failed with %u gaps" % len(self.read_gaps), str(op))
+            print("Read failed with %u gaps" % self.read_gaps.count(), str(op))
             self.terminate_session()
+            return
         self.check_read_send()
-            
+
+    def read_gap_acked(self, offset, tsend):
+        '''update round trip time and window for an answered gap read'''
+        if offset in self.read_gap_resent:
+            # the reply may be to either send, so don't use it for timing
+            self.read_gap_resent.discard(offset)
+        else:
+            rtt = time.time() - tsend
+            if self.read_srtt is None:
+                self.read_srtt = rtt
+                self.read_rttvar = rtt / 2
+            else:
+                self.read_rttvar = 0.75 * self.read_rttvar + 0.25 * abs(self.read_srtt - rtt)
+                self.read_srtt = 0.875 * self.read_srtt + 0.125 * rtt
+        if self.read_window < self.read_ssthresh:
+            self.read_window += 1
+        else:
+            self.read_window += 1.0 / self.read_window
+        self.read_window = min(self.read_window, max(self.ftp_settings.max_window, 1))
+
+    def read_gap_lost(self, offset, tsend):
+        '''handle a gap read which got no reply'''
+        self.read_gap_resent.add(offset)
+        self.read_retries += 1
+        if tsend > self.last_read_loss:
+            # halve the window once for each round of losses
+            self.read_ssthresh = max(self.read_window / 2, 1)
+            self.read_window = self.read_ssthresh
+            self.last_read_loss = time.time()
+
+    def read_rto(self):
+        '''retransmit timeout for reads, from the measured round trip time'''
+        if self.read_srtt is None:
+            return self.ftp_settings.retry_time
+        rto = self.read_srtt + 4 * self.read_rttvar
+        return min(max(rto, 2 * self.rtt, MIN_RTO), MAX_RTO)
+
     def cmd_put(self, args, fh=None, callback=None, progress_callback=None):
         '''put file'''
         if len(args) == 0:
@@ -671,25 +760,64 @@ class FTPModule(mp_module.MPModule):
         if op.opcode != OP_Ack:
             print("Create directory failed %s" % op)
 
-    def cmd_crc(self, args):
-        '''get crc'''
+    def cmd_crc(self, args, callback=None):
+        '''get crc. If callback is given it is called with the crc, or None
+        on failure'''
         if len(args) < 1:
             print("Usage: crc NAME")
             return
         name = args[0]
+        if self.crc_name is not None:
+            # a new request replaces the outstanding one
+            self.crc_fail()
         self.filename = name
         self.op_start = time.time()
-        print("Getting CRC for %s" % name)
-        enc_name = bytearray(name, 'ascii')
+        self.crc_callback = callback
+        self.crc_name = name
+        self.crc_retries = 0
+        if callback is None:
+            print("Getting CRC for %s" % name)
+        self.send_crc()
+
+    def send_crc(self):
+        '''send the request for the outstanding CRC'''
+        enc_name = bytearray(self.crc_name, 'ascii')
         op = FTP_OP(self.seq, self.session, OP_CalcFileCRC32, len(enc_name), 0, 0, 0, bytearray(enc_name))
+        self.crc_time = time.time()
         self.send(op)
 
+    def crc_cancel(self):
+        '''forget the outstanding CRC request, returning its callback'''
+        callback = self.crc_callback
+        self.crc_callback = None
+        self.crc_name = None
+        return callback
+
+    def crc_fail(self):
+        '''give up on the outstanding CRC request'''
+        name = self.crc_name
+        callback = self.crc_cancel()
+        if callback is not None:
+            callback(None)
+        else:
+            print("crc failed %s" % name)
+
     def handle_crc_reply(self, op, m):
         '''handle crc reply'''
+        if self.crc_name is None:
+            # reply to a request we have given up on or already answered
+            return
+        name = self.crc_name
+        callback = self.crc_cancel()
         if op.opcode == OP_Ack and op.size == 4:
             crc, = struct.unpack("<I", op.payload)
             now = time.time()
-            print("crc: %s 0x%08x in %.1fs" % (self.filename, crc, now - self.op_start))
+            if callback is not None:
+                callback(crc)
+            else:
+                print("crc: %s 0x%08x in %.1fs" % (name, crc, now - self.op_start))
+        elif callback is not None:
+            callback(None)
         else:
             print("crc failed %s" % op)
 
@@ -705,7 +833,9 @@ class FTPModule(mp_module.MPModule):
             ofs = self.fh.tell()
             dt = time.time() - self.op_start
             rate = (ofs / dt) / 1024.0
-            print("Transfer at offset %u with %u gaps %u retries %.1f kByte/sec" % (ofs, len(self.read_gaps), self.read_retries, rate))
+            print("Transfer at offset %u with %u gaps %u retries %.1f kByte/sec window %.1f rtt %.3f" % (
+                ofs, self.read_gaps.count(), self.read_retries, rate, self.read_window,
+                self.read_srtt if self.read_srtt is not None else self.rtt))
 
     def op_parse(self, m):
         '''parse a FILE_TRANSFER_PROTOCOL msg'''
@@ -764,47 +894,46 @@ class FTPModule(mp_module.MPModule):
             else:
                 print('FTP Unknown %s' % str(op))
 
-    def send_gap_read(self, g):
-        '''send a read for a gap'''
-        (offset, length) = g
+    def send_gap_read(self, offset, length):
+        '''send a read for part of a gap'''
         if self.ftp_settings.debug > 0:
-            print("Gap read of %u at %u rem=%u blog=%u" % (length, offset, len(self.read_gaps), self.backlog))
+            print("Gap read of %u at %u rem=%u outstanding=%u window=%.1f" % (
+                length, offset, self.read_gaps.count(), len(self.read_gap_times), self.read_window))
         read = FTP_OP(self.seq, self.session, OP_ReadFile, length, 0, 0, offset, None)
         self.send(read)
-        self.read_gaps.remove(g)
-        self.read_gaps.append(g)
-        self.last_gap_send = time.time()
-        self.read_gap_times[g] = self.last_gap_send
-        self.backlog += 1
+        self.read_gap_times[offset] = (length, time.time())
 
     def check_read_send(self):
-        '''see if we should send another gap read'''
-        if len(self.read_gaps) == 0:
+        '''expire lost gap reads and send more while the window allows'''
+        if self.read_gaps.count() == 0 and len(self.read_gap_times) == 0:
             return
-        g = self.read_gaps[0]
         now = time.time()
-        dt = now - self.read_gap_times[g]
-        if not self.reached_eof:
-            # send gap reads once
-            for g in self.read_gap_times.keys():
-                if self.read_gap_times[g] == 0:
-                    self.send_gap_read(g)
+        rto = self.read_rto()
+        for (offset, (length, tsend)) in list(self.read_gap_times.items()):
+            if not self.read_gaps.overlaps(offset, offset + length):
+                # the burst has filled this range, so the read is not
+                # needed and must not count as a loss
+                self.read_gap_times.pop(offset)
+                continue
+            if now - tsend > rto:
+                self.read_gap_times.pop(offset)
+                self.read_gap_lost(offset, tsend)
+        window = max(int(self.read_window), 1)
+        if len(self.read_gap_times) >= window:
             return
-        if self.read_gap_times[g] > 0 and dt > self.ftp_settings.retry_time:
-            if self.backlog > 0:
-                self.backlog -= 1
-            self.read_gap_times[g] = 0
-
-        if self.read_gap_times[g] != 0:
-            # still pending
-            return
-        if not self.reached_eof and self.backlog >= self.ftp_settings.max_backlog:
-            # don't fill queue too far until we have got past the burst
-            return
-        if now - self.last_gap_send < 0.05:
-            # don't send too fast
-            return
-        self.send_gap_read(g)
+        # the missing data with no read outstanding. An outstanding read
+        # may start before a gap which the burst has partly filled
+        wanted = IntervalSet(self.read_gaps.ranges())
+        for (offset, (length, tsend)) in self.read_gap_times.items():
+            wanted.remove(offset, offset + length)
+        for (start, end) in wanted.ranges():
+            ofs = start
+            while ofs < end:
+                length = min(end - ofs, self.burst_size)
+                self.send_gap_read(ofs, length)
+                if len(self.read_gap_times) >= window:
+                    return
+                ofs += length
 
     def idle_task(self):
         '''check for file gaps and lost requests'''
@@ -827,14 +956,24 @@ class FTPModule(mp_module.MPModule):
             send_op.session = self.session
             self.send(send_op)
 
-        if len(self.read_gaps) == 0 and self.last_burst_read is None and self.write_list is None:
+        # see if we lost a CRC reply
+        if self.crc_name is not None and now - self.crc_time > CRC_TIMEOUT:
+            self.crc_retries += 1
+            if self.crc_retries > CRC_RETRIES:
+                self.crc_fail()
+            else:
+                if self.ftp_settings.debug > 0:
+                    print("FTP: retry crc")
+                self.send_crc()
+
+        if self.read_gaps.count() == 0 and self.last_burst_read is None and self.write_list is None:
             return
 
         if self.fh is None:
             return
 
         # see if burst read has stalled
-        if not self.reached_eof and self.last_burst_read is not None and now - self.last_burst_read > self.ftp_settings.retry_time:
+        if not self.reached_eof and self.last_burst_read is not None and now - self.last_burst_read > self.read_rto():
             dt = now - self.last_burst_read
             self.last_burst_read = now
             if self.ftp_settings.debug > 0:
@@ -4,12 +4,12 @@
   uses lib/live_graph.py for display
 """
 
-from pymavlink import mavutil
 import re, os, sys
 
 from MAVProxy.modules.lib import live_graph
 
 from MAVProxy.modules.lib import mp_module
+from MAVProxy.modules.lib import mp_expression
 
 class GraphModule(mp_module.MPModule):
     def __init__(self, mpstate):
@@ -127,6 +127,7 @@ class Graph():
 
         self.fields = fields[:]
         self.values = [None] * len(self.fields)
+        self.expressions = [mp_expression.compile_expression(f) for f in self.fields]
         self.livegraph = live_graph.LiveGraph(fields,
                                               timespan=state.timespan,
                                               tickresolution=state.tickresolution,
@@ -159,8 +160,7 @@ class Graph():
         for i in range(len(self.fields)):
             if mtype not in self.field_types[i]:
                 continue
-            f = self.fields[i]
-            self.values[i] = mavutil.evaluate_expression(f, self.state.master.messages)
+            self.values[i] = self.expressions[i].evaluate(self.state.master.messages)
             if self.values[i] is not None:
                 have_value = True
         if have_value and self.livegraph is not None:
@@ -16,7 +16,6 @@ import fnmatch
 import json
 import math
 import os
-import struct
 import sys
 import time
 import traceback
@@ -90,6 +89,9 @@ class LinkModule(mp_module.MPModule):
         self.add_command('ping', self.cmd_ping, "ping mavlink nodes")
         self.no_fwd_types = set()
         self.no_fwd_types.add("BAD_DATA")
+        # cached mtype -> [modules] table for mavlink_packet dispatch
+        self.packet_dispatch = {}
+        self.packet_dispatch_generation = -1
         self.add_completion_function('(SERIALPORT)', self.complete_serial_ports)
         self.add_completion_function('(LINKS)', self.complete_links)
         self.add_completion_function('(LINK)', self.complete_links)
@@ -448,6 +450,7 @@ class LinkModule(mp_module.MPModule):
         self.status.counters['MasterIn'].append(0)
         self.status.bytecounters['MasterIn'].append(self.status.ByteCounter())
         self.mpstate.vehicle_link_map[conn.linknum] = set(())
+        self.mpstate.fd_registry.invalidate()
         try:
             mp_util.child_fd_list_add(conn.port.fileno())
         except Exception:
@@ -519,6 +522,7 @@ class LinkModule(mp_module.MPModule):
             print(msg)
             pass
         self.mpstate.mav_master.pop(i)
+        self.mpstate.fd_registry.invalidate()
         self.status.counters['MasterIn'].pop(i)
         self.status.bytecounters['MasterIn'].pop(i)
         del self.mpstate.vehicle_link_map[conn.linknum]
@@ -565,7 +569,7 @@ class LinkModule(mp_module.MPModule):
         if mtype != 'BAD_DATA' and self.mpstate.logqueue:
             usec = self.get_usec()
             usec = (usec & ~3) | 3 # linknum 3
-            self.mpstate.logqueue.put(bytearray(struct.pack('>Q', usec) + m.get_msgbuf()))
+            self.mpstate.logqueue.put_msg(usec, m.get_msgbuf())
 
     def handle_msec_timestamp(self, m, master):
         '''special handling for MAVLink packets with a time_boot_ms field'''
@@ -987,6 +991,20 @@ class LinkModule(mp_module.MPModule):
         '''handle an incoming mavlink packet'''
         pass
 
+    def packet_handlers(self, mtype):
+        '''return list of modules which want messages of type mtype. The
+        table is built lazily per type and discarded when modules are
+        loaded, unloaded or change their subscriptions'''
+        if self.packet_dispatch_generation != self.mpstate.module_generation:
+            self.packet_dispatch = {}
+            self.packet_dispatch_generation = self.mpstate.module_generation
+        handlers = self.packet_dispatch.get(mtype, None)
+        if handlers is None:
+            handlers = [mod for (mod, pm) in self.mpstate.modules
+                        if hasattr(mod, 'mavlink_packet') and mod.wants_mavlink_packet(mtype)]
+            self.packet_dispatch[mtype] = handlers
+        return handlers
+
     def master_callback(self, m, master):
         '''process mavlink message m on master, sending any messages to recipients'''
         sysid = m.get_srcSystem()
@@ -1002,7 +1020,7 @@ class LinkModule(mp_module.MPModule):
 
         # see if it is handled by a specialised sysid connection
         if sysid in self.mpstate.sysid_outputs:
-            self.mpstate.sysid_outputs[sysid].write(m.get_msgbuf())
+            self.mpstate.output_batch.write(self.mpstate.sysid_outputs[sysid], m.get_msgbuf())
             if mtype == "GLOBAL_POSITION_INT":
                 for modname in 'map', 'asterix', 'NMEA', 'NMEA2':
                     mod = self.module(modname)
@@ -1017,7 +1035,7 @@ class LinkModule(mp_module.MPModule):
         if mtype == 'GLOBAL_POSITION_INT':
             # send GLOBAL_POSITION_INT to 2nd GCS for 2nd vehicle display
             for sysid in self.mpstate.sysid_outputs:
-                self.mpstate.sysid_outputs[sysid].write(m.get_msgbuf())
+                self.mpstate.output_batch.write(self.mpstate.sysid_outputs[sysid], m.get_msgbuf())
 
             if self.mpstate.settings.fwdpos:
                 for link in self.mpstate.mav_master:
@@ -1030,7 +1048,7 @@ class LinkModule(mp_module.MPModule):
             # delay in saved logs
             usec = self.get_usec()
             usec = (usec & ~3) | master.linknum
-            self.mpstate.logqueue.put(bytearray(struct.pack('>Q', usec) + m.get_msgbuf()))
+            self.mpstate.logqueue.put_msg(usec, m.get_msgbuf())
 
         # keep the last message of each type around
         self.status.msgs[mtype] = m
@@ -1073,20 +1091,23 @@ class LinkModule(mp_module.MPModule):
             # GCS
             if self.mpstate.settings.mavfwd_rate or mtype != 'REQUEST_DATA_STREAM':
                 if mtype not in self.no_fwd_types:
+                    tnow = time.time()
+                    srcSystem = m.get_srcSystem()
                     for r in self.mpstate.mav_outputs:
+                        policy = getattr(r, 'out_policy', None)
+                        if policy is not None and not policy.check(mtype, tnow, srcSystem):
+                            continue
                         if hasattr(r, 'ws') and r.ws is not None:
                             from wsproto.connection import ConnectionState
                             if r.ws.state != ConnectionState.OPEN:  # Ensure Websocket handshake is done
                                 continue
-                        r.write(m.get_msgbuf())
+                        self.mpstate.output_batch.write(r, m.get_msgbuf())
 
             sysid = m.get_srcSystem()
             target_sysid = self.target_system
 
             # pass to modules
-            for (mod, pm) in self.mpstate.modules:
-                if not hasattr(mod, 'mavlink_packet'):
-                    continue
+            for mod in self.packet_handlers(mtype):
                 # Do not send other-system-or-component heartbeat packets to non-multi-vehicle modules
                 if not self.message_is_from_primary_vehicle(m) and not mod.multi_vehicle and mtype == 'HEARTBEAT':
                     continue
@@ -4,29 +4,121 @@ log command handling
 AP_FLAKE8_CLEAN
 '''
 
+import json
 import os
 import time
 
 from MAVProxy.modules.lib import mp_module
+from MAVProxy.modules.lib import mp_settings
+from MAVProxy.modules.lib.interval_set import IntervalSet
+
+# bytes in each LOG_DATA message
+LOG_DATA_LEN = 90
+# limits of the adaptive amount of missing data requested on each retry
+MIN_REQUEST_WINDOW = LOG_DATA_LEN * 4
+MAX_REQUEST_WINDOW = 1024 * 1024
+# pending downloads, saved in the log directory so they can be
+# continued after a restart
+QUEUE_FILENAME = "logqueue%u.json"
+
+
+class LogTransfer(object):
+    '''progress of one log download'''
+    def __init__(self, lognum, filename, size, transport, received=0):
+        self.lognum = lognum
+        self.filename = filename
+        self.size = size
+        self.transport = transport
+        self.start = time.time()
+        self.received = received
+        self.last_update = self.start
+        self.last_received = received
+        self.rate = 0
+        self.retries = 0
+        self.finished = None
+
+    def update(self, received, retries):
+        '''update the received byte count, averaging the rate over at least 0.5s'''
+        now = time.time()
+        self.received = received
+        self.retries = retries
+        dt = now - self.last_update
+        if dt < 0.5:
+            return
+        rate_now = (received - self.last_received) / dt
+        if self.rate == 0:
+            self.rate = rate_now
+        else:
+            self.rate = 0.7 * self.rate + 0.3 * rate_now
+        self.last_update = now
+        self.last_received = received
+
+    def eta(self):
+        '''estimated seconds to completion, or None if unknown'''
+        if not self.size or self.rate <= 0:
+            return None
+        return max(self.size - self.received, 0) / self.rate
+
+    def status(self):
+        '''return a one line status string'''
+        if self.finished is not None:
+            dt = max(self.finished - self.start, 0.001)
+            return ("%s: done %u bytes in %.1fs %.1f kbyte/s via %s %u retries" %
+                    (self.filename, self.received, dt, self.received / (1000.0 * dt),
+                     self.transport, self.retries))
+        if self.size:
+            pct = "%.1f%%" % (100.0 * self.received / self.size)
+        else:
+            pct = "?%"
+        eta = self.eta()
+        if eta is None:
+            eta = "?"
+        else:
+            eta = "%us" % eta
+        return ("%s: %u/%u bytes %s %.1f kbyte/s ETA %s via %s %u retries" %
+                (self.filename, self.received, self.size or 0, pct, self.rate / 1000.0,
+                 eta, self.transport, self.retries))
 
 
 class LogModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(LogModule, self).__init__(mpstate, "log", "log transfer")
-        self.add_command('log', self.cmd_log, "log file handling", ['<download|status|erase|resume|cancel|list>'])
+        self.subscribe_mavlink_packets(['LOG_ENTRY', 'LOG_DATA'])
+        self.add_command('log', self.cmd_log, "log file handling",
+                         ['<download|status|erase|resume|cancel|list|queue>',
+                          'set (LOGSETTING)'])
+        self.log_settings = mp_settings.MPSettings(
+            [('transport', str, 'auto'),
+             ('parallel', bool, False),
+             ('ftp_dir', str, '/APM/LOGS')])
+        self.add_completion_function('(LOGSETTING)',
+                                     self.log_settings.completion)
         self.reset()
+        queue = self.load_queue()
+        if len(queue) > 0:
+            print("log: %u downloads pending, use 'log queue resume' to continue" % len(queue))
 
     def reset(self):
-        self.download_set = set()
+        self.download_ranges = IntervalSet()
         self.download_file = None
         self.download_lognum = None
         self.download_filename = None
         self.download_start = None
         self.download_last_timestamp = None
         self.download_ofs = 0
+        self.download_end = None
         self.retries = 0
+        self.request_window = MAX_REQUEST_WINDOW // 16
+        self.requested = 0
+        self.received_at_request = 0
+        self.last_ranges_save = time.time()
         self.entries = {}
         self.download_queue = []
+        self.transfers = {}
+        self.ftp_lognum = None
+        self.ftp_file = None
+        self.ftp_failed = False
+        self.last_ftp_ranges_save = time.time()
         self.last_status = time.time()
 
     def mavlink_packet(self, m):
@@ -63,12 +155,16 @@ class LogModule(mp_module.MPModule):
         if m.count != 0:
             s = bytearray(m.data[:m.count])
             self.download_file.write(s)
-            self.download_set.add(m.ofs // 90)
+            self.download_ranges.add(m.ofs, m.ofs + m.count)
             self.download_ofs += m.count
         self.download_last_timestamp = time.time()
-        if m.count == 0 or (m.count < 90 and len(self.download_set) == 1 + (m.ofs // 90)):
+        if m.count < LOG_DATA_LEN:
+            # a short block marks the end of the log
+            self.download_end = m.ofs + m.count
+        if m.count == 0 or (self.download_end is not None and self.download_ranges.contains(0, self.download_end)):
             dt = time.time() - self.download_start
             self.download_file.close()
+            self.remove_ranges_file()
             size = os.path.getsize(self.download_filename)
             speed = size / (1000.0 * dt)
             status = (
@@ -79,96 +175,222 @@ class LogModule(mp_module.MPModule):
             )
             self.console.set_status('LogDownload', status, row=4)
             print(status)
+            self.transfer_finished(self.download_lognum, size, self.retries)
             self.download_file = None
             self.download_filename = None
-            self.download_set = set()
+            self.download_lognum = None
+            self.download_ranges = IntervalSet()
             self.master.mav.log_request_end_send(
                 self.target_system,
                 self.target_component
             )
-            if len(self.download_queue):
-                self.log_download_next()
+            self.log_download_next()
         self.update_status()
 
     def handle_log_data_missing(self):
         '''handling missing incoming log data'''
-        if len(self.download_set) == 0:
+        if self.download_ranges.count() == 0:
             return
-        highest = max(self.download_set)
-        diff = set(range(highest)).difference(self.download_set)
-        if len(diff) == 0:
+        # grow the amount requested while requests are being answered,
+        # and back off when they are not
+        received = self.download_ranges.total()
+        if self.requested > 0:
+            if received - self.received_at_request >= self.requested // 2:
+                self.request_window = min(self.request_window * 2, MAX_REQUEST_WINDOW)
+            else:
+                self.request_window = max(self.request_window // 2, MIN_REQUEST_WINDOW)
+        self.received_at_request = received
+        self.requested = 0
+        highest = self.download_ranges.highest()
+        gaps = self.download_ranges.gaps(highest)
+        if len(gaps) == 0:
             self.master.mav.log_request_data_send(
                 self.target_system,
                 self.target_component,
                 self.download_lognum,
-                (1 + highest) * 90,
+                highest,
                 0xffffffff
             )
             self.retries += 1
-        else:
-            num_requests = 0
-            while num_requests < 20:
-                start = min(diff)
-                diff.remove(start)
-                end = start
-                while end + 1 in diff:
-                    end += 1
-                    diff.remove(end)
-                self.master.mav.log_request_data_send(
-                    self.target_system,
-                    self.target_component,
-                    self.download_lognum,
-                    start * 90,
-                    (end + 1 - start) * 90
-                )
-                num_requests += 1
-                self.retries += 1
-                if len(diff) == 0:
-                    break
+            return
+        for (start, end) in gaps:
+            count = min(end - start, self.request_window - self.requested)
+            self.master.mav.log_request_data_send(
+                self.target_system,
+                self.target_component,
+                self.download_lognum,
+                start,
+                count
+            )
+            self.requested += count
+            self.retries += 1
+            if self.requested >= self.request_window:
+                break
 
-    def log_status(self, console=False):
-        '''show download status'''
+    def ranges_filename(self, filename):
+        '''sidecar file recording the received ranges of a partial download'''
+        return filename + ".ranges"
+
+    def save_ranges(self):
+        '''save received ranges so an interrupted download can be resumed'''
         if self.download_filename is None:
-            print("No download")
             return
-        dt = time.time() - self.download_start
-        speed = os.path.getsize(self.download_filename) / (1000.0 * dt)
+        self.download_file.flush()
         m = self.entries.get(self.download_lognum, None)
-        file_size = os.path.getsize(self.download_filename)
-        if m is None:
-            size = 0
-            pct = 0
-        elif m.size == 0:
-            size = 0
-            pct = 100
-        else:
-            size = m.size
-            pct = (100.0*file_size)/size
-        highest = 0
-        if len(self.download_set):
-            highest = max(self.download_set)
-        diff = set(range(highest)).difference(self.download_set)
-        status = (
-            f"Downloading {self.download_filename} - " +
-            f"{os.path.getsize(self.download_filename)}/{size} bytes " +
-            f"{pct:.1f}% {speed:.1f} kbyte/s " +
-            f"({self.retries} retries {len(diff)} missing)"
-        )
+        self.download_ranges.save(self.ranges_filename(self.download_filename),
+                                  {'lognum': self.download_lognum,
+                                   'size': m.size if m is not None else None})
+        self.last_ranges_save = time.time()
+
+    def save_ftp_ranges(self):
+        '''save received ranges of an FTP download'''
+        ftp = self.module('ftp')
+        if self.ftp_lognum is None or ftp is None or ftp.fh is not self.ftp_file:
+            return
+        ranges = ftp.received_ranges()
+        if ranges is None:
+            return
+        self.ftp_file.flush()
+        ranges.save(self.ranges_filename(self.ftp_file.name),
+                    {'lognum': self.ftp_lognum,
+                     'size': self.log_size(self.ftp_lognum)})
+        self.last_ftp_ranges_save = time.time()
+
+    def remove_ranges_file(self, filename=None):
+        '''remove the sidecar of a completed download'''
+        if filename is None:
+            filename = self.download_filename
+        try:
+            os.unlink(self.ranges_filename(filename))
+        except OSError:
+            pass
+
+    def load_ranges(self, log_num, filename):
+        '''return the received ranges of a partial download of log_num, or None'''
+        if not os.path.isfile(filename):
+            return None
+        (ranges, extra) = IntervalSet.load(self.ranges_filename(filename))
+        if ranges is None or extra.get('lognum', None) != log_num:
+            return None
+        m = self.entries.get(log_num, None)
+        if m is not None and extra.get('size', None) not in [None, m.size]:
+            # a different log with the same number
+            return None
+        if os.path.getsize(filename) < ranges.highest():
+            return None
+        return ranges
+
+    def log_status(self, console=False):
+        '''show download status'''
+        active = [t for t in self.transfers.values() if t.finished is None]
+        if len(active) == 0:
+            if not console:
+                print("No download")
+            return
+        if self.download_filename is not None:
+            t = self.transfers.get(self.download_lognum, None)
+            if t is not None:
+                t.update(self.download_ranges.total(), self.retries)
+        lines = []
+        for t in active:
+            s = t.status()
+            if t.lognum == self.download_lognum:
+                s += " %u bytes missing" % self.download_ranges.missing()
+            lines.append(s)
+        if len(self.download_queue) > 0:
+            lines.append("%u queued" % len(self.download_queue))
         if console:
-            self.console.set_status('LogDownload', status, row=4)
+            self.console.set_status('LogDownload', ' | '.join(lines), row=4)
         else:
-            print(status)
+            for line in lines:
+                print(line)
+
+    def log_queue_status(self):
+        '''show all downloads'''
+        for lognum in sorted(self.transfers.keys()):
+            print(self.transfers[lognum].status())
+        print("queued: %s" % ' '.join([str(n) for n in reversed(self.download_queue)]))
+
+    def queue_filename(self):
+        '''file holding the pending downloads of the current vehicle'''
+        filename = QUEUE_FILENAME % self.target_system
+        if self.logdir is not None:
+            filename = os.path.join(self.logdir, filename)
+        return filename
+
+    def save_queue(self):
+        '''save the queue of pending downloads so it survives a restart'''
+        queue = list(self.download_queue)
+        for lognum in [self.download_lognum, self.ftp_lognum]:
+            if lognum is not None:
+                queue.append(lognum)
+        filename = self.queue_filename()
+        try:
+            if len(queue) == 0:
+                if os.path.exists(filename):
+                    os.unlink(filename)
+                return
+            with open(filename, 'w') as f:
+                json.dump({'queue': queue}, f)
+        except OSError as ex:
+            print("log: failed to save queue: %s" % ex)
+
+    def load_queue(self):
+        '''load the queue saved by save_queue'''
+        try:
+            with open(self.queue_filename(), 'r') as f:
+                return [int(n) for n in json.load(f)['queue']]
+        except (OSError, ValueError, KeyError, TypeError):
+            return []
+
+    def log_size(self, log_num):
+        '''size of a log from the log list, or None if unknown'''
+        m = self.entries.get(log_num, None)
+        if m is None:
+            return None
+        return m.size
+
+    def already_downloaded(self, log_num, filename):
+        '''return True if a complete copy of a log exists'''
+        size = self.log_size(log_num)
+        return (size is not None and
+                os.path.isfile(filename) and
+                not os.path.exists(self.ranges_filename(filename)) and
+                os.path.getsize(filename) == size)
+
+    def ftp_module(self):
+        '''return the ftp module if it can be used for a log download'''
+        if self.log_settings.transport not in ['auto', 'ftp'] or self.ftp_failed:
+            return None
+        if self.ftp_lognum is not None:
+            return None
+        ftp = self.module('ftp')
+        if ftp is None or not ftp.is_idle():
+            return None
+        return ftp
 
     def log_download_next(self):
-        if len(self.download_queue) == 0:
-            return
-        latest = self.download_queue.pop()
-        filename = self.default_log_filename(latest)
-        if os.path.isfile(filename) and os.path.getsize(filename) == self.entries.get(latest).to_dict()["size"]:
-            print("Skipping existing %s" % (filename))
-            self.log_download_next()
-        else:
-            self.log_download(latest, filename)
+        '''start queued downloads on any idle transport'''
+        while len(self.download_queue) > 0:
+            busy = self.download_file is not None or self.ftp_lognum is not None
+            if busy and not self.log_settings.parallel:
+                break
+            latest = self.download_queue[-1]
+            filename = self.default_log_filename(latest)
+            if self.already_downloaded(latest, filename):
+                print("Skipping existing %s" % (filename))
+                self.download_queue.pop()
+                continue
+            ftp = self.ftp_module()
+            if ftp is not None:
+                self.download_queue.pop()
+                self.log_download_ftp(ftp, latest, filename)
+            elif self.download_file is None and self.log_settings.transport != 'ftp':
+                self.download_queue.pop()
+                self.log_download(latest, filename)
+            else:
+                break
+        self.save_queue()
 
     def log_download_all(self):
         if len(self.entries.keys()) == 0:
@@ -177,6 +399,17 @@ class LogModule(mp_module.MPModule):
         self.download_queue = sorted(self.entries, key=lambda id: self.entries[id].time_utc)
         self.log_download_next()
 
+    def log_download_resume(self):
+        '''continue downloads saved from an earlier session'''
+        queue = self.load_queue()
+        if len(queue) == 0:
+            print("No saved downloads")
+            return
+        for lognum in queue:
+            if lognum not in self.download_queue and lognum not in [self.download_lognum, self.ftp_lognum]:
+                self.download_queue.insert(0, lognum)
+        self.log_download_next()
+
     def log_download_range(self, first, last):
         self.download_queue = sorted(list(range(first, last+1)), reverse=True)
         print(self.download_queue)
@@ -192,38 +425,124 @@ class LogModule(mp_module.MPModule):
 
     def log_download(self, log_num, filename):
         '''download a log file'''
-        print("Downloading log %u as %s" % (log_num, filename))
+        ranges = self.load_ranges(log_num, filename)
         self.download_lognum = log_num
-        self.download_file = open(filename, "wb")
-        self.master.mav.log_request_data_send(
-            self.target_system,
-            self.target_component,
-            log_num,
-            0,
-            0xFFFFFFFF
-        )
+        if ranges is not None:
+            print("Resuming log %u as %s (%u bytes already received)" % (log_num, filename, ranges.total()))
+            self.download_file = open(filename, "r+b")
+            self.download_ranges = ranges
+        else:
+            print("Downloading log %u as %s" % (log_num, filename))
+            self.download_file = open(filename, "wb")
+            self.download_ranges = IntervalSet()
         self.download_filename = filename
-        self.download_set = set()
+        self.transfers[log_num] = LogTransfer(log_num, filename, self.log_size(log_num), 'logdata',
+                                              self.download_ranges.total())
         self.download_start = time.time()
         self.download_last_timestamp = time.time()
         self.download_ofs = 0
+        self.download_end = None
         self.retries = 0
+        self.requested = 0
+        self.received_at_request = self.download_ranges.total()
+        self.request_window = MAX_REQUEST_WINDOW // 16
+        if self.download_ranges.count() > 0:
+            # fetch what is missing, then the rest of the log
+            self.handle_log_data_missing()
+        else:
+            self.master.mav.log_request_data_send(
+                self.target_system,
+                self.target_component,
+                log_num,
+                0,
+                0xFFFFFFFF
+            )
+
+    def log_download_ftp(self, ftp, log_num, filename):
+        '''download a log file with MAVLink FTP'''
+        remote = "%s/%08u.BIN" % (self.log_settings.ftp_dir.rstrip('/'), log_num)
+        ranges = self.load_ranges(log_num, filename)
+        try:
+            if ranges is not None:
+                print("Resuming log %u as %s with FTP from %s (%u bytes already received)" %
+                      (log_num, filename, remote, ranges.total()))
+                self.ftp_file = open(filename, "r+b")
+            else:
+                print("Downloading log %u as %s with FTP from %s" % (log_num, filename, remote))
+                self.ftp_file = open(filename, "wb")
+        except OSError as ex:
+            print("Failed to open %s: %s" % (filename, ex))
+            return
+        self.ftp_lognum = log_num
+        received = ranges.total() if ranges is not None else 0
+        self.transfers[log_num] = LogTransfer(log_num, filename, self.log_size(log_num), 'ftp', received)
+        self.last_ftp_ranges_save = time.time()
+        ftp.cmd_get([remote, filename],
+                    callback=self.ftp_download_done,
+                    callback_progress=self.ftp_download_progress,
+                    fh=self.ftp_file,
+                    received=ranges)
+
+    def ftp_download_progress(self, fh, received):
+        '''progress of an FTP log download'''
+        t = self.transfers.get(self.ftp_lognum, None)
+        ftp = self.module('ftp')
+        if t is not None and ftp is not None:
+            t.update(received, ftp.read_retries)
+
+    def ftp_download_done(self, fh):
+        '''completion of an FTP log download, fh is None on failure'''
+        log_num = self.ftp_lognum
+        if log_num is None:
+            return
+        filename = self.ftp_file.name
+        self.ftp_file.close()
+        self.ftp_file = None
+        self.ftp_lognum = None
+        if fh is None:
+            # fall back to LOG_DATA for this and later logs
+            print("FTP download of log %u failed, using LOG_DATA" % log_num)
+            self.ftp_failed = True
+            self.transfers.pop(log_num, None)
+            self.download_queue.append(log_num)
+        else:
+            self.remove_ranges_file(filename)
+            ftp = self.module('ftp')
+            retries = ftp.read_retries if ftp is not None else 0
+            size = os.path.getsize(filename)
+            self.transfer_finished(log_num, size, retries)
+            print(self.transfers[log_num].status())
+        self.log_download_next()
+
+    def transfer_finished(self, log_num, size, retries):
+        '''record the completion of a download'''
+        t = self.transfers.get(log_num, None)
+        if t is not None:
+            t.received = size
+            t.retries = retries
+            t.finished = time.time()
 
     def default_log_filename(self, log_num):
         return "log%u.bin" % log_num
 
     def cmd_log(self, args):
         '''log commands'''
-        usage = "usage: log <list|download|erase|resume|status|cancel>"
+        usage = "usage: log <list|download|erase|resume|status|cancel|queue|set>"
         if len(args) < 1:
             print(usage)
             return
 
         if args[0] == "status":
             self.log_status()
+        elif args[0] == "queue":
+            if len(args) > 1 and args[1] == "resume":
+                self.log_download_resume()
+            else:
+                self.log_queue_status()
+        elif args[0] == "set":
+            self.log_settings.command(args[1:])
         elif args[0] == "list":
             print("Requesting log list")
-            self.download_set = set()
             self.master.mav.log_request_list_send(
                 self.target_system,
                 self.target_component,
@@ -245,8 +564,19 @@ class LogModule(mp_module.MPModule):
 
         elif args[0] == "cancel":
             if self.download_file is not None:
+                # keep the partial file so the download can be resumed
+                self.save_ranges()
                 self.download_file.close()
+            if self.ftp_lognum is not None:
+                self.save_ftp_ranges()
+                self.ftp_lognum = None
+                ftp = self.module('ftp')
+                if ftp is not None:
+                    ftp.callback = None
+                    ftp.cmd_cancel()
+                self.ftp_file.close()
             self.reset()
+            self.save_queue()
 
         elif args[0] == "download":
             if len(args) < 2:
@@ -284,9 +614,13 @@ class LogModule(mp_module.MPModule):
     def update_status(self):
         '''update log download status in console'''
         now = time.time()
-        if self.download_file is not None and now - self.last_status > 0.5:
+        if (self.download_file is not None or self.ftp_lognum is not None) and now - self.last_status > 0.5:
             self.last_status = now
             self.log_status(True)
+        if self.download_file is not None and now - self.last_ranges_save > 5:
+            self.save_ranges()
+        if self.ftp_lognum is not None and now - self.last_ftp_ranges_save > 5:
+            self.save_ftp_ranges()
 
     def idle_task(self):
         '''handle missing log data'''
@@ -18,6 +18,10 @@ from pymavlink import mavutil
 from PIL import ImageColor
 
 
+# most stored tiles checked by each prefetch update
+PREFETCH_CHECK_MAX = 200
+
+
 class MapModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(MapModule, self).__init__(mpstate, "map", "map display", public=True, multi_instance=True, multi_vehicle=True)
@@ -72,11 +76,19 @@ class MapModule(mp_module.MPModule):
             ('contour_levels', int, 20),
             ('contour_grid_spacing', float, 30.0),
             ('contour_grid_extent', float, 20000.0),
+            ('trail_length', float, 12.0),
+            ('download_workers', int, 4),
         ])
 
         service = 'MicrosoftHyb'
         if 'MAP_SERVICE' in os.environ:
             service = os.environ['MAP_SERVICE']
+        # tile store type and size cap in MB, see tile_store.py
+        self.tile_store = os.environ.get('MAP_TILE_STORE', 'file')
+        self.tile_store_size = int(os.environ.get('MAP_TILE_CACHE_MB', 0)) * 1024 * 1024
+        self.service = service
+        self.prefetch_tiles = None
+        self.prefetch_mt = None
         from MAVProxy.modules.mavproxy_map import mp_slipmap
         title = "Map"
         if self.instance > 1:
@@ -85,7 +97,9 @@ class MapModule(mp_module.MPModule):
         terrain_module = self.module('terrain')
         if terrain_module is not None:
             elevation = terrain_module.ElevationModel.database
-        self.map = mp_slipmap.MPSlipMap(service=service, elevation=elevation, title=title)
+        self.map = mp_slipmap.MPSlipMap(service=service, elevation=elevation, title=title,
+                                        tile_store=self.tile_store, tile_store_size=self.tile_store_size,
+                                        download_workers=self.map_settings.download_workers)
         if self.instance == 1:
             self.mpstate.map = self.map
             mpstate.map_functions = {'draw_lines' : self.draw_lines}
@@ -99,6 +113,7 @@ class MapModule(mp_module.MPModule):
                                                                 'follow',
                                                                 'menu',
                                                                 'marker',
+                                                                'prefetch <bbox|polygon|status|cancel>',
                                                                 'clear'])
         self.add_completion_function('(MAPSETTING)', self.map_settings.completion)
 
@@ -333,6 +348,7 @@ class MapModule(mp_module.MPModule):
         elif args[0] == "set":
             self.map_settings.command(args[1:])
             self.map.add_object(mp_slipmap.SlipBrightness(self.map_settings.brightness))
+            self.map.add_object(mp_slipmap.SlipDownloadWorkers(self.map_settings.download_workers))
         elif args[0] == "sethome":
             self.cmd_set_home(args)
         elif args[0] == "sethomepos":
@@ -353,6 +369,8 @@ class MapModule(mp_module.MPModule):
             self.cmd_set_roi(args)
         elif args[0] == "setposition":
             self.cmd_set_position(args)
+        elif args[0] == "prefetch":
+            self.cmd_prefetch(args[1:])
         else:
             print("usage: map <icon|set>")
 
@@ -933,6 +951,8 @@ Usage: map circle <radius> <colour>
         # check for any events from the map
         self.map.check_events()
 
+        self.prefetch_update()
+
     def create_vehicle_icon(self, name, colour, follow=False, vehicle_type=None):
         '''add a vehicle to the map'''
         from MAVProxy.modules.mavproxy_map import mp_slipmap
@@ -942,6 +962,8 @@ Usage: map circle <radius> <colour>
             return
         self.have_vehicle[name] = vehicle_type
         icon = self.map.icon(colour + vehicle_type + '.png')
+        # trail_length is in seconds, with a trail point every 0.2 seconds
+        trail = mp_slipmap.SlipTrail(timestep=0.2, count=max(1, int(self.map_settings.trail_length / 0.2)))
         self.map.add_object(mp_slipmap.SlipIcon(
             name,
             (0, 0),
@@ -949,7 +971,7 @@ Usage: map circle <radius> <colour>
             layer=3,
             rotation=0,
             follow=follow,
-            trail=mp_slipmap.SlipTrail(),
+            trail=trail,
         ))
 
     def remove_vehicle_icon(self, name, vehicle_type=None):
@@ -1105,6 +1127,104 @@ Usage: map circle <radius> <colour>
         lon = float(args[2])
         self.map.set_center(lat, lon)
 
+    def cmd_prefetch(self, args):
+        '''download the tiles of an area for offline use'''
+        usage = '''Usage: map prefetch bbox LAT1 LON1 LAT2 LON2 ZOOM1-ZOOM2
+Usage: map prefetch polygon FILENAME ZOOM1-ZOOM2
+Usage: map prefetch <status|cancel>'''
+        if len(args) == 1 and args[0] == "status":
+            self.prefetch_status()
+            return
+        if len(args) == 1 and args[0] == "cancel":
+            if self.prefetch_tiles is not None:
+                self.prefetch_tiles = None
+                print("Prefetch cancelled")
+            return
+        polygon = None
+        try:
+            if len(args) == 6 and args[0] == "bbox":
+                (lat1, lon1, lat2, lon2) = [float(a) for a in args[1:5]]
+            elif len(args) == 3 and args[0] == "polygon":
+                polygon = mp_util.polygon_load(args[1])
+                (lat1, lon1, dlat, dlon) = mp_util.polygon_bounds(polygon)
+                (lat2, lon2) = (lat1+dlat, lon1+dlon)
+            else:
+                print(usage)
+                return
+            zooms = args[-1].split('-')
+            zoom1 = int(zooms[0])
+            zoom2 = int(zooms[-1])
+        except (OSError, ValueError, RuntimeError) as ex:
+            print("map prefetch: %s" % ex)
+            print(usage)
+            return
+        from MAVProxy.modules.mavproxy_map import tile_download
+        if self.service in tile_download.NO_BULK_DOWNLOAD:
+            print("map prefetch: the %s usage policy does not allow bulk downloads" % self.service)
+            return
+        if self.prefetch_mt is None:
+            from MAVProxy.modules.mavproxy_map import mp_tile
+            # share the display's rate limits so the two don't add up
+            self.prefetch_mt = mp_tile.MPTile(service=self.service, store=self.tile_store,
+                                              store_size=self.tile_store_size,
+                                              shared_rate_limits=self.map.rate_limits)
+        mt = self.prefetch_mt
+        zoom1 = max(zoom1, mt.min_zoom)
+        zoom2 = min(zoom2, mt.max_zoom)
+        count = 0
+        for zoom in range(zoom1, zoom2+1):
+            t1 = mt.coord_to_tile(max(lat1, lat2), min(lon1, lon2), zoom)
+            t2 = mt.coord_to_tile(min(lat1, lat2), max(lon1, lon2), zoom)
+            count += (t2.x - t1.x + 1) * (t2.y - t1.y + 1)
+        print("Prefetching up to %u %s tiles at zoom %u to %u" % (count, self.service, zoom1, zoom2))
+        self.prefetch_tiles = self.prefetch_generator(mt, lat1, lon1, lat2, lon2, zoom1, zoom2, polygon)
+        self.prefetch_counts = {'requested': 0, 'stored': 0, 'total': count}
+
+    def prefetch_generator(self, mt, lat1, lon1, lat2, lon2, zoom1, zoom2, polygon):
+        '''generate the tiles to prefetch, skipping tiles already stored.
+        None is generated after every PREFETCH_CHECK_MAX stored tiles, so
+        a mostly stored area doesn't hold up the main loop'''
+        skipped = 0
+        for zoom in range(zoom1, zoom2+1):
+            for tile in mt.area_tiles(lat1, lon1, lat2, lon2, zoom, polygon):
+                if mt.tile_stored(tile):
+                    self.prefetch_counts['stored'] += 1
+                    skipped += 1
+                    if skipped >= PREFETCH_CHECK_MAX:
+                        skipped = 0
+                        yield None
+                    continue
+                yield tile
+
+    def prefetch_status(self):
+        '''show prefetch progress'''
+        if self.prefetch_tiles is None:
+            print("No prefetch running")
+            return
+        c = self.prefetch_counts
+        print("Prefetch: %u requested, %u already stored, %u pending, at most %u tiles" % (
+            c['requested'], c['stored'], self.prefetch_mt.tiles_pending(), c['total']))
+
+    def prefetch_update(self):
+        '''keep the prefetch downloader busy without queueing the whole
+        area at once'''
+        mt = self.prefetch_mt
+        if self.prefetch_tiles is None:
+            return
+        while mt.tiles_pending() < 32:
+            tile = next(self.prefetch_tiles, False)
+            if tile is None:
+                # carry on checking for stored tiles next time
+                return
+            if tile is False:
+                if mt.tiles_pending() == 0:
+                    self.prefetch_status()
+                    print("Prefetch complete")
+                    self.prefetch_tiles = None
+                return
+            mt.request_download(tile)
+            self.prefetch_counts['requested'] += 1
+
     def cmd_follow(self, args):
         '''control following of vehicle'''
         if len(args) < 2:
@@ -1463,14 +1583,17 @@ Usage: map circle <radius> <colour>
             Calculate terrain altitudes for the NED offsets (x, y)
             centred on (lat, lon).
             """
-            alt = []
-            for east in y:
-                alt_y = []
-                for north in x:
-                    (lat2, lon2) = mp_util.gps_offset(lat, lon, east, north)
-                    alt_y.append(elevation_model.GetElevation(lat2, lon2))
-                alt.append(alt_y)
-            return alt
+            # mp_util.gps_offset(lat, lon, y, x) over the grid, moving
+            # along rhumb lines
+            (north, east) = np.meshgrid(x, y)
+            lat1 = mp_util.constrain(math.radians(lat), -math.pi/2+1.0e-15, math.pi/2-1.0e-15)
+            lat2 = np.clip(lat1 + north / mp_util.radius_of_earth, -math.pi/2+1.0e-15, math.pi/2-1.0e-15)
+            dphi = np.log(np.tan(lat2/2+math.pi/4) / math.tan(lat1/2+math.pi/4))
+            q = np.full(lat2.shape, math.cos(lat1))
+            moved = np.abs(lat2 - lat1) >= 1.0e-15
+            q[moved] = (lat2[moved] - lat1) / dphi[moved]
+            lon2 = np.fmod(math.radians(lon) + east / mp_util.radius_of_earth / q + math.pi, 2*math.pi) - math.pi
+            return elevation_model.GetElevationArray(np.degrees(lat2), np.degrees(lon2))
 
         def ned_to_latlon(contours, lat, lon):
             """
@@ -1491,7 +1614,7 @@ Usage: map circle <radius> <colour>
             return contours_latlon
 
         # generate surface and contours
-        z_grid = np.array(terrain_surface(lat, lon, x, y))
+        z_grid = terrain_surface(lat, lon, x, y)
         _, (ax1) = plt.subplots(1, 1, figsize=(10, 10))
         cs = ax1.contour(x_grid, y_grid, z_grid, levels=levels)
         contours = ned_to_latlon(cs.allsegs, lat, lon)
@@ -6,10 +6,12 @@ Andrew Tridgell
 June 2012
 '''
 
+import collections
 import time
 import cv2
 
 from MAVProxy.modules.mavproxy_map import mp_tile
+from MAVProxy.modules.mavproxy_map import tile_download
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import win_layout
 from MAVProxy.modules.lib import multiproc
@@ -35,7 +37,11 @@ class MPSlipMap():
                  elevation=None,
                  download=True,
                  show_flightmode_legend=True,
-                 timelim_pipe=None):
+                 timelim_pipe=None,
+                 tile_store='file',
+                 tile_store_size=0,
+                 download_workers=4,
+                 position_interval=1.0/30):
 
         self.lat = lat
         self.lon = lon
@@ -52,6 +58,17 @@ class MPSlipMap():
         self.brightness = brightness
         self.legend = show_flightmode_legend
         self.timelim_pipe = timelim_pipe
+        self.tile_store = tile_store
+        self.tile_store_size = tile_store_size
+        self.download_workers = download_workers
+        # shared with other tile downloaders, such as a prefetch
+        self.rate_limits = tile_download.SharedRateLimits(mp_tile.TILE_SERVICES.keys())
+
+        # position updates are held and sent in batches, keeping only
+        # the latest for each object
+        self.position_interval = position_interval
+        self._positions = collections.OrderedDict()
+        self._positions_sent = 0
 
         self.drag_step = 10
 
@@ -83,7 +100,11 @@ class MPSlipMap():
                                  service=self.service,
                                  tile_delay=self.tile_delay,
                                  debug=self.debug,
-                                 max_zoom=self.max_zoom)
+                                 max_zoom=self.max_zoom,
+                                 store=self.tile_store,
+                                 store_size=self.tile_store_size,
+                                 download_workers=self.download_workers,
+                                 shared_rate_limits=self.rate_limits)
         state.layers = {}
         state.info = {}
         state.need_redraw = True
@@ -114,10 +135,14 @@ class MPSlipMap():
 
     def add_object(self, obj):
         '''add or update an object on the map'''
+        if isinstance(obj, SlipObject):
+            # a held position for the old object is out of date
+            self._positions.pop(obj.key, None)
         self.object_queue.put(obj)
 
     def remove_object(self, key):
         '''remove an object on the map by key'''
+        self._positions.pop(key, None)
         self.object_queue.put(SlipRemoveObject(key))
 
     def set_zoom(self, ground_width):
@@ -142,10 +167,24 @@ class MPSlipMap():
 
     def set_position(self, key, latlon, layer='', rotation=0, label=None, colour=None):
         '''move an object on the map'''
-        self.object_queue.put(SlipPosition(key, latlon, layer, rotation, label, colour))
+        self._positions[key] = SlipPosition(key, latlon, layer, rotation, label, colour)
+        self.flush_positions()
+
+    def flush_positions(self, force=False):
+        '''send held position updates if the batch interval has passed'''
+        if len(self._positions) == 0:
+            return
+        now = time.time()
+        if not force and now - self._positions_sent < self.position_interval:
+            return
+        self._positions_sent = now
+        self.object_queue.put(SlipPositions(list(self._positions.values())))
+        self._positions.clear()
 
     def event_queue_empty(self):
-        '''return True if there are no events waiting to be processed'''
+        '''return True if there are no events waiting to be processed.
+        This is polled regularly, so also sends held position updates'''
+        self.flush_positions()
         return self.event_queue.empty()
 
     def set_layout(self, layout):
@@ -208,6 +247,8 @@ if __name__ == "__main__":
     parser.add_argument("--offline", action='store_true', default=False, help="no download")
     parser.add_argument("--delay", type=float, default=0.3, help="tile download delay")
     parser.add_argument("--max-zoom", type=int, default=19, help="maximum tile zoom")
+    parser.add_argument("--tile-store", default='file', choices=['file', 'sqlite'], help="tile store type")
+    parser.add_argument("--workers", type=int, default=4, help="tile download workers")
     parser.add_argument("--debug", action='store_true', default=False, help="show debug info")
     parser.add_argument("--boundary", default=None, help="show boundary")
     parser.add_argument("--mission", default=[], action='append', help="show mission")
@@ -226,7 +267,9 @@ if __name__ == "__main__":
                    debug=args.debug,
                    max_zoom=args.max_zoom,
                    elevation=args.elevation,
-                   tile_delay=args.delay)
+                   tile_delay=args.delay,
+                   tile_store=args.tile_store,
+                   download_workers=args.workers)
 
     if args.boundary:
         boundary = mp_util.polygon_load(args.boundary)
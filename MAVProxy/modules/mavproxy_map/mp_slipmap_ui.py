@@ -9,6 +9,7 @@ import numpy as np
 import os
 import time
 import copy
+import cv2
 
 from ..lib.wx_loader import wx
 
@@ -16,17 +17,20 @@ from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipBrightness
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipCenter
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipClearLayer
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipDefaultPopup
+from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipDownloadWorkers
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipFlightModeLegend
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipGrid
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipHideObject
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipIcon
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipInformation
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipKeyEvent
+from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipLayer
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipMenuEvent
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipMouseEvent
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipObject
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipObjectSelection
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipPosition
+from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipPositions
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipRemoveObject
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipThumbnail
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipZoom
@@ -214,7 +218,7 @@ class MPSlipMapFrame(wx.Frame):
         state = self.state
         if obj.layer not in state.layers:
             # its a new layer
-            state.layers[obj.layer] = {}
+            state.layers[obj.layer] = SlipLayer()
         state.layers[obj.layer][obj.key] = obj
         state.need_redraw = True
         if (not self.legend_checkbox_menuitem_added and
@@ -230,6 +234,30 @@ class MPSlipMapFrame(wx.Frame):
             state.layers[layer].pop(key, None)
         state.need_redraw = True
 
+    def move_object(self, pos):
+        '''apply a SlipPosition to an object'''
+        state = self.state
+        if pos.layer is None or pos.layer == '':
+            layers = list(state.layers.keys())
+        elif pos.layer in state.layers:
+            layers = [pos.layer]
+        else:
+            return
+        for layer in layers:
+            object = state.layers[layer].get(pos.key, None)
+            if object is None:
+                continue
+            object.update_position(pos)
+            if getattr(object, 'follow', False):
+                self.follow(object)
+            if pos.label is not None:
+                object.label = pos.label
+            if pos.colour is not None:
+                object.colour = pos.colour
+            state.layers[layer].changed(pos.key)
+            state.need_redraw = True
+            return
+
     def on_idle(self, event):
         '''prevent the main loop spinning too fast'''
         state = self.state
@@ -255,17 +283,11 @@ class MPSlipMapFrame(wx.Frame):
                 self.add_object(obj)
 
             if isinstance(obj, SlipPosition):
-                # move an object
-                object = self.find_object(obj.key, obj.layer)
-                if object is not None:
-                    object.update_position(obj)
-                    if getattr(object, 'follow', False):
-                        self.follow(object)
-                    if obj.label is not None:
-                        object.label = obj.label
-                    if obj.colour is not None:
-                        object.colour = obj.colour
-                    state.need_redraw = True
+                self.move_object(obj)
+
+            if isinstance(obj, SlipPositions):
+                for pos in obj.positions:
+                    self.move_object(pos)
 
             if isinstance(obj, SlipDefaultPopup):
                 state.default_popup = obj
@@ -307,6 +329,9 @@ class MPSlipMapFrame(wx.Frame):
                 state.brightness = obj.brightness
                 state.need_redraw = True
 
+            if isinstance(obj, SlipDownloadWorkers):
+                state.mt.set_download_workers(obj.workers)
+
             if isinstance(obj, SlipClearLayer):
                 # remove all objects from a layer
                 if obj.layer in state.layers:
@@ -325,6 +350,7 @@ class MPSlipMapFrame(wx.Frame):
                 for layer in state.layers:
                     if obj.key in state.layers[layer]:
                         state.layers[layer][obj.key].set_hidden(obj.hide)
+                        state.layers[layer].changed(obj.key)
                 state.need_redraw = True
 
         if state.timelim_pipe is not None:
@@ -337,6 +363,7 @@ class MPSlipMapFrame(wx.Frame):
                 for layer in state.layers:
                     for key in state.layers[layer].keys():
                         state.layers[layer][key].set_time_range(obj)
+                    state.layers[layer].changed()
                 state.need_redraw = True
 
         if obj is None:
@@ -353,10 +380,17 @@ class MPSlipMapPanel(wx.Panel):
         self.state = state
         self.img = None
         self.map_img = None
+        # cached drawings of unchanging layers, see draw_layers
+        self.overlays = {}
+        self.overlay_candidates = {}
+        # pixel offsets of cached layers, see draw_layers
+        self.layer_offsets = {}
         self.redraw_timer = wx.Timer(self)
         self.Bind(wx.EVT_TIMER, self.on_redraw_timer, self.redraw_timer)
         self.Bind(wx.EVT_SET_FOCUS, self.on_focus)
-        self.redraw_timer.Start(200)
+        # redraw_map returns early when nothing has changed, so a
+        # fast timer keeps a followed vehicle smooth at little cost
+        self.redraw_timer.Start(33)
         self.mouse_pos = None
         self.mouse_down = None
         self.click_pos = None
@@ -561,25 +595,154 @@ class MPSlipMapPanel(wx.Panel):
 
     def pixel_coords(self, latlon, reverse=False):
         '''return pixel coordinates in the map image for a (lat,lon)
-        if reverse is set, then return lat/lon for a pixel coordinate
+        if reverse is set, then return lat/lon for a pixel coordinate.
+        An Nx2 array of positions gives an Nx2 array of pixels
         '''
         state = self.state
         if reverse:
             (x, y) = latlon
             return self.coordinates(x, y)
+        if isinstance(latlon, np.ndarray):
+            return state.mt.coords_to_pixels(state.lat, state.lon, state.width, state.ground_width,
+                                             latlon[:, 0], latlon[:, 1])
         (lat, lon) = (latlon[0], latlon[1])
         return state.mt.coord_to_pixel(state.lat, state.lon, state.width, state.ground_width, lat, lon)
 
-    def draw_objects(self, objects, bounds, img):
+    def draw_objects(self, objects, bounds, img, pixmapper=None):
         '''draw objects on the image'''
-        keys = sorted(objects.keys())
-        for k in keys:
+        if pixmapper is None:
+            pixmapper = self.pixmapper
+        for k in objects.visible(bounds):
             obj = objects[k]
             if not self.state.legend and isinstance(obj, SlipFlightModeLegend):
                 continue
-            bounds2 = obj.bounds()
-            if bounds2 is None or mp_util.bounds_overlap(bounds, bounds2):
-                obj.draw(img, self.pixmapper, bounds)
+            obj.draw(img, pixmapper, bounds)
+
+    def offset_pixmapper(self, dx, dy):
+        '''return a pixmapper for an image whose top left is at pixel
+        (-dx,-dy) of the view'''
+        def pixmapper(latlon):
+            pix = self.pixmapper(latlon)
+            if isinstance(pix, np.ndarray):
+                return pix + np.array([dx, dy], dtype=pix.dtype)
+            return (pix[0] + dx, pix[1] + dy)
+        return pixmapper
+
+    def draw_overlay(self, names):
+        '''draw layers over twice the view width and height, centred on
+        the view, once onto black and once onto white. Pixels which match
+        in both were painted over. Pixels which differ from the background
+        in only one were partly covered, such as the edges of text, and
+        white-black gives the share of the map that shows'''
+        state = self.state
+        (dx, dy) = (state.width // 2, state.height // 2)
+        (width, height) = (state.width + 2 * dx, state.height + 2 * dy)
+        (lat, lon) = self.coordinates(-dx, -dy)
+        (lat2, lon2) = self.coordinates(width - dx - 1, height - dy - 1)
+        bounds = (lat2, lon, lat - lat2, mp_util.wrap_180(lon2 - lon))
+        pixmapper = self.offset_pixmapper(dx, dy)
+        black = np.zeros((height, width, 3), dtype=np.uint8)
+        white = np.full_like(black, 255)
+        for name in names:
+            self.draw_objects(state.layers[name], bounds, black, pixmapper)
+            self.draw_objects(state.layers[name], bounds, white, pixmapper)
+        opaque = np.all(black == white, axis=2)
+        partial = (np.any(black != 0, axis=2) | np.any(white != 255, axis=2)) & ~opaque
+        (oy, ox) = np.nonzero(opaque)
+        (py, px) = np.nonzero(partial)
+        pixels = None
+        if len(oy) > 0 or len(py) > 0:
+            pblack = black[py, px].astype(np.uint16)
+            pshare = white[py, px].astype(np.uint16) - pblack
+            pixels = ((oy, ox, black[oy, ox]), (py, px, pblack, pshare))
+        # the view corner is kept rather than the image corner, which is
+        # not an exact pixel, to find the pan since it was drawn
+        return ((state.lat, state.lon), (dx, dy), self.pixel_width_equator(), (width, height), pixels)
+
+    def pixel_width_equator(self):
+        '''the scale of the view in metres per pixel at the equator'''
+        state = self.state
+        return (state.ground_width / float(state.width)) / math.cos(math.radians(state.lat))
+
+    def overlay_offset(self, overlay):
+        '''return the pixel offset of a cached overlay in the view, or None
+        if it no longer covers the view at the same scale'''
+        state = self.state
+        (origin, margin, scale, (width, height), pixels) = overlay
+        if abs(self.pixel_width_equator() / scale - 1) * max(width, height) > 0.5:
+            # panned far enough north or south for the scale to change
+            return None
+        (x, y) = self.pixel_coords(origin)
+        (dx, dy) = (x - margin[0], y - margin[1])
+        if dx > 0 or dy > 0 or dx + width < state.width or dy + height < state.height:
+            return None
+        return (dx, dy)
+
+    def blit_overlay(self, pixels, offset, img):
+        '''copy a cached overlay onto the image at a pixel offset'''
+        ((oy, ox, opixels), (py, px, pblack, pshare)) = pixels
+        (dx, dy) = offset
+        (height, width) = img.shape[:2]
+        oy = oy + dy
+        ox = ox + dx
+        inside = (oy >= 0) & (oy < height) & (ox >= 0) & (ox < width)
+        img[oy[inside], ox[inside]] = opixels[inside]
+        if len(py) > 0:
+            py = py + dy
+            px = px + dx
+            inside = (py >= 0) & (py < height) & (px >= 0) & (px < width)
+            (py, px) = (py[inside], px[inside])
+            under = img[py, px].astype(np.uint16)
+            img[py, px] = pblack[inside] + (under * pshare[inside] + 127) // 255
+
+    def draw_layers(self, bounds, img):
+        '''draw all layers in order. A run of layers holding only
+        cacheable objects which is unchanged since the last redraw, at
+        the same zoom, is drawn once over an area larger than the view
+        and then copied from a cache, moved by the pan since it was drawn'''
+        state = self.state
+        # (cacheable, names) for each run of layers
+        runs = []
+        for name in sorted(list(state.layers.keys())):
+            cacheable = state.layers[name].cacheable()
+            if cacheable and len(runs) > 0 and runs[-1][0]:
+                runs[-1][1].append(name)
+            else:
+                runs.append((cacheable, [name]))
+
+        overlays = {}
+        candidates = {}
+        self.layer_offsets = {}
+        for (cacheable, names) in runs:
+            if not cacheable:
+                self.draw_objects(state.layers[names[0]], bounds, img)
+                continue
+            names = tuple(names)
+            signature = (state.ground_width, tuple(state.layers[n].version for n in names))
+            overlay = self.overlays.get(names, None)
+            offset = None
+            if overlay is not None and overlay[0] == signature:
+                offset = self.overlay_offset(overlay[1])
+            if offset is None:
+                overlay = None
+                if self.overlay_candidates.get(names, None) == signature:
+                    # unchanged since the last redraw, worth caching
+                    overlay = (signature, self.draw_overlay(names))
+                    offset = (-(state.width // 2), -(state.height // 2))
+            if overlay is None:
+                candidates[names] = signature
+                for name in names:
+                    self.draw_objects(state.layers[name], bounds, img)
+                continue
+            overlays[names] = overlay
+            for name in names:
+                # objects remember where they were drawn for clicks
+                self.layer_offsets[name] = offset
+            pixels = overlay[1][4]
+            if pixels is not None:
+                self.blit_overlay(pixels, offset, img)
+        self.overlays = overlays
+        self.overlay_candidates = candidates
 
     def redraw_map(self):
         '''redraw the map with current settings'''
@@ -590,15 +753,15 @@ class MPSlipMapPanel(wx.Panel):
         if view_same and not state.need_redraw:
             return
 
-        # get the new map
+        # get the new map, only the parts not in the last view are drawn
         self.map_img = state.mt.area_to_image(state.lat, state.lon,
                                               state.width, state.height, state.ground_width)
         if state.brightness != 0: # valid state.brightness range is [-255, 255]
-            brightness = np.uint8(np.abs(state.brightness))
+            brightness = float(abs(state.brightness))
             if state.brightness > 0:
-                self.map_img = np.where((255 - self.map_img) < brightness, 255, self.map_img + brightness)
+                self.map_img = cv2.add(self.map_img, (brightness, brightness, brightness, 0))
             else:
-                self.map_img = np.where((255 + self.map_img) < brightness, 0, self.map_img - brightness)
+                self.map_img = cv2.subtract(self.map_img, (brightness, brightness, brightness, 0))
 
         # find display bounding box
         (lat2, lon2) = self.coordinates(state.width-1, state.height-1)
@@ -614,10 +777,7 @@ class MPSlipMapPanel(wx.Panel):
             self.grid_spacing = None
 
         # draw layer objects
-        keys = state.layers.keys()
-        keys = sorted(list(keys))
-        for k in keys:
-            self.draw_objects(state.layers[k], bounds, img)
+        self.draw_layers(bounds, img)
 
         # draw information objects
         for key in state.info:
@@ -667,9 +827,10 @@ class MPSlipMapPanel(wx.Panel):
         selected = []
         (px, py) = pos
         for layer in state.layers:
+            (dx, dy) = self.layer_offsets.get(layer, (0, 0))
             for key in state.layers[layer]:
                 obj = state.layers[layer][key]
-                distance = obj.clicked(px, py)
+                distance = obj.clicked(px - dx, py - dy)
                 if distance is not None:
                     selected.append(SlipObjectSelection(key, distance, layer, extra_info=obj.selection_info()))
         selected.sort(key=lambda c: c.distance)
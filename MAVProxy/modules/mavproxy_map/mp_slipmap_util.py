@@ -19,6 +19,13 @@ from MAVProxy.modules.lib import mp_util
 
 font = cv2.FONT_HERSHEY_DUPLEX
 
+# trails start with room for this many points and grow as needed
+TRAIL_INITIAL_SIZE = 256
+
+# consecutive trail points in the same square of this many pixels are
+# drawn as one
+TRAIL_CELL_PIXELS = 2
+
 
 def image_shape(img):
     '''handle different image formats, returning (width,height) tuple'''
@@ -29,6 +36,10 @@ def image_shape(img):
 
 class SlipObject:
     '''an object to display on the map'''
+    # True if drawing depends only on the object and the view, so a
+    # layer of these objects can be drawn once and cached
+    cacheable = False
+
     def __init__(self, key, layer, popup_menu=None):
         self.key = key
         self.layer = str(layer)
@@ -95,6 +106,8 @@ class SlipObject:
 
 class SlipLabel(SlipObject):
     '''a text label to display on the map'''
+    cacheable = True
+
     def __init__(self, key, point, label, layer, colour, size=0.5):
         SlipObject.__init__(self, key, layer)
         self.point = point
@@ -147,6 +160,8 @@ class SlipArrow(SlipObject):
 
 
 class SlipCircle(SlipObject):
+    cacheable = True
+
     '''a circle to display on the map'''
     def __init__(self, key, layer, latlon, radius, color, linewidth, arrow=False, popup_menu=None, start_angle=None, end_angle=None, rotation=None, add_radii=False):  # noqa:E501
         SlipObject.__init__(self, key, layer, popup_menu=popup_menu)
@@ -221,6 +236,8 @@ class SlipCircle(SlipObject):
 
 class SlipPolygon(SlipObject):
     '''a polygon to display on the map'''
+    cacheable = True
+
     def __init__(self, key, points, layer, colour, linewidth, arrow=False, popup_menu=None, showlines=True, showcircles=True):  # noqa:E501
         SlipObject.__init__(self, key, layer, popup_menu=popup_menu)
         self.points = points
@@ -534,30 +551,82 @@ class SlipThumbnail(SlipObject):
 
 
 class SlipTrail:
-    '''trail information for a moving icon'''
-    def __init__(self, timestep=0.2, colour=(255, 255, 0), count=60, points=[]):
+    '''trail information for a moving icon
+
+    the points and their times are held in arrays with room for twice
+    the trail length. New points go after the last one, and once the
+    arrays are full the trail is moved back to the front, so the trail
+    is always one slice which can be projected and drawn in a few calls'''
+    def __init__(self, timestep=0.2, colour=(255, 255, 0), count=60, points=None):
         self.timestep = timestep
         self.colour = colour
         self.count = count
-        self.points = points
         self.last_time = time.time()
+        self._timestamp_range = None
+        size = 2 * max(1, min(count, TRAIL_INITIAL_SIZE))
+        self._latlon = np.zeros((size, 2))
+        self._time = np.zeros(size)
+        self._start = 0
+        self._end = 0
+        if points is not None:
+            for p in points:
+                self.add_point(p, self.last_time)
+
+    @property
+    def points(self):
+        '''the trail as a list of (lat,lon), oldest first'''
+        return [tuple(p) for p in self._latlon[self._start:self._end].tolist()]
+
+    def add_point(self, latlon, timestamp):
+        '''add a point to the end of the trail'''
+        if self._end == len(self._time):
+            n = self._end - self._start
+            size = len(self._time)
+            if 2 * n >= size and size < 2 * self.count:
+                # grow towards twice the trail length
+                size = min(2 * size, 2 * self.count)
+            points = np.zeros((size, 2))
+            times = np.zeros(size)
+            points[:n] = self._latlon[self._start:self._end]
+            times[:n] = self._time[self._start:self._end]
+            (self._latlon, self._time) = (points, times)
+            (self._start, self._end) = (0, n)
+        self._latlon[self._end] = latlon[:2]
+        self._time[self._end] = timestamp
+        self._end += 1
+        self._start = max(self._start, self._end - self.count)
 
     def update_position(self, newpos):
         '''update trail'''
         tnow = time.time()
         if tnow >= self.last_time + self.timestep:
-            self.points.append(newpos.latlon)
+            self.add_point(newpos.latlon, tnow)
             self.last_time = tnow
-            while len(self.points) > self.count:
-                self.points.pop(0)
+
+    def set_time_range(self, trange):
+        '''set timestamp range for display'''
+        self._timestamp_range = trange
 
     def draw(self, img, pixmapper, bounds):
         '''draw the trail'''
-        for p in self.points:
-            (px, py) = pixmapper(p)
-            (width, height) = image_shape(img)
-            if px >= 0 and py >= 0 and px < width and py < height:
-                cv2.circle(img, (px, py), 1, self.colour)
+        (start, end) = (self._start, self._end)
+        if self._timestamp_range is not None:
+            times = self._time[start:end]
+            end = start + np.searchsorted(times, self._timestamp_range[1], side='right')
+            start += np.searchsorted(times, self._timestamp_range[0], side='left')
+        if end <= start:
+            return
+        pix = pixmapper(self._latlon[start:end])
+        # only keep points which move into a new cell of the pixel
+        # grid, so the points drawn depend on the zoom, not the length
+        cells = np.ascontiguousarray(pix // TRAIL_CELL_PIXELS)
+        # compare each (x,y) pair of int32 as a single int64
+        cells = cells.view(np.int64).ravel()
+        keep = np.ones(len(pix), dtype=bool)
+        keep[1:] = cells[1:] != cells[:-1]
+        keep[-1] = True
+        pix = pix[keep]
+        cv2.polylines(img, [pix.reshape(-1, 1, 2)], False, self.colour)
 
 
 class SlipIcon(SlipThumbnail):
@@ -571,6 +640,12 @@ class SlipIcon(SlipThumbnail):
         self.label = label
         self.colour = colour # label colour
 
+    def set_time_range(self, trange):
+        '''set timestamp range for display'''
+        SlipObject.set_time_range(self, trange)
+        if self.trail is not None:
+            self.trail.set_time_range(trange)
+
     def img(self):
         '''return a cv image for the icon'''
         SlipThumbnail.img(self)
@@ -623,6 +698,135 @@ class SlipPosition:
         self.colour = colour
 
 
+class SlipPositions:
+    '''a batch of position updates, at most one per object'''
+    def __init__(self, positions):
+        self.positions = positions
+
+
+class SlipLayer(dict):
+    '''the objects of one map layer, by key
+
+    the bounding boxes of the objects are kept in an array so the
+    objects in view can be found without visiting every object. A change
+    to an object which alters its position or appearance must be noted
+    with changed() so the index and any cached drawing of the layer are
+    updated'''
+    def __init__(self):
+        dict.__init__(self)
+        self.version = 0
+        self._cacheable = None
+        self._dirty = set()
+        self._unbounded = set()
+        self._row = {}
+        self._keys = []
+        self._free = []
+        self._bounds = np.zeros((0, 4))
+        self._valid = np.zeros(0, dtype=bool)
+
+    def __setitem__(self, key, obj):
+        dict.__setitem__(self, key, obj)
+        self.changed(key)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.changed(key)
+
+    def pop(self, key, *default):
+        ret = dict.pop(self, key, *default)
+        self.changed(key)
+        return ret
+
+    def changed(self, key=None):
+        '''note a change to one object, or to all objects if key is None'''
+        self.version += 1
+        self._cacheable = None
+        if key is None:
+            self._dirty.update(self.keys())
+        else:
+            self._dirty.add(key)
+
+    def cacheable(self):
+        '''return True if the layer only holds cacheable objects'''
+        if self._cacheable is None:
+            self._cacheable = len(self) > 0 and all(obj.cacheable for obj in self.values())
+        return self._cacheable
+
+    def _rebuild(self):
+        '''rebuild the index from scratch'''
+        self._row = {}
+        self._keys = []
+        self._unbounded = set()
+        rows = []
+        for (key, obj) in self.items():
+            b = obj.bounds()
+            if b is None:
+                self._unbounded.add(key)
+                continue
+            self._row[key] = len(rows)
+            self._keys.append(key)
+            rows.append(b)
+        size = max(16, 2 * len(rows))
+        self._bounds = np.zeros((size, 4))
+        self._valid = np.zeros(size, dtype=bool)
+        if len(rows) > 0:
+            self._bounds[:len(rows)] = rows
+            self._valid[:len(rows)] = True
+        self._free = list(range(size-1, len(rows)-1, -1))
+        self._keys.extend([None] * (size - len(rows)))
+        self._dirty = set()
+
+    def _update_index(self):
+        '''update the index for changed objects'''
+        if len(self._dirty) == 0:
+            return
+        if len(self._dirty) > len(self._row) // 4:
+            self._rebuild()
+            return
+        for key in self._dirty:
+            obj = dict.get(self, key, None)
+            b = None
+            if obj is not None:
+                b = obj.bounds()
+            row = self._row.get(key, None)
+            if b is None:
+                if row is not None:
+                    self._valid[row] = False
+                    self._keys[row] = None
+                    self._free.append(row)
+                    del self._row[key]
+                if obj is None:
+                    self._unbounded.discard(key)
+                else:
+                    self._unbounded.add(key)
+                continue
+            self._unbounded.discard(key)
+            if row is None:
+                if len(self._free) == 0:
+                    self._rebuild()
+                    return
+                row = self._free.pop()
+                self._row[key] = row
+                self._keys[row] = key
+            self._bounds[row] = b
+            self._valid[row] = True
+        self._dirty = set()
+
+    def visible(self, bounds):
+        '''return the sorted keys of the objects which may be in view,
+        bounds being (lat, lon, dlat, dlon) as for mp_util.bounds_overlap'''
+        self._update_index()
+        (x2, y2, w2, h2) = bounds
+        b = self._bounds
+        v = self._valid & (b[:, 0] + b[:, 2] >= x2) & (x2 + w2 >= b[:, 0])
+        dlon1 = np.mod(b[:, 1] + b[:, 3] - y2, 360)
+        dlon2 = np.mod(y2 + h2 - b[:, 1], 360)
+        v &= (dlon1 <= 180) & (dlon2 <= 180)
+        keys = [self._keys[i] for i in np.flatnonzero(v)]
+        keys.extend(self._unbounded)
+        return sorted(keys)
+
+
 class SlipClickLocation(SlipObject):
     '''current click location tuple'''
     def __init__(self, location, layer='', timeout=-1):
@@ -684,6 +888,12 @@ class SlipBrightness:
         self.brightness = brightness
 
 
+class SlipDownloadWorkers:
+    '''an object to change the number of tile download workers'''
+    def __init__(self, workers):
+        self.workers = workers
+
+
 class SlipClearLayer:
     '''remove all objects in a layer'''
     def __init__(self, layer):
@@ -19,11 +19,7 @@ AP_FLAKE8_CLEAN
 '''
 
 import collections
-import hashlib
-import sys
-import threading
 import os
-import pathlib
 import string
 import time
 import cv2
@@ -31,18 +27,9 @@ import numpy as np
 
 from math import log, tan, radians, degrees, sin, cos, exp, pi, asin, atan
 
-if sys.version_info.major < 3:
-    from urllib2 import Request as url_request
-    from urllib2 import urlopen as url_open
-    from urllib2 import URLError as url_error
-else:
-    from urllib.request import Request as url_request
-    from urllib.request import urlopen as url_open
-    from urllib.error import URLError as actual_url_error
-    from http.client import RemoteDisconnected
-    url_error = (RemoteDisconnected, actual_url_error)
-
 from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.mavproxy_map.tile_download import TileDownloader
+from MAVProxy.modules.mavproxy_map import tile_store
 
 
 class TileException(Exception):
@@ -83,6 +70,56 @@ BLANK_TILES = set([
 TILES_WIDTH = 256
 TILES_HEIGHT = 256
 
+# tile cache entry for a tile which failed to download
+TILE_UNAVAILABLE = object()
+
+# finished downloads waiting to be applied to the tile caches
+MAX_TILE_UPDATES = 1000
+
+
+class LRUCache(object):
+    '''a dictionary holding at most size entries, dropping the least
+    recently used'''
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        '''return an entry, marking it as recently used'''
+        value = self.entries.get(key, None)
+        if value is None:
+            return default
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        '''add or replace an entry'''
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def pop(self, key):
+        '''remove an entry if present'''
+        self.entries.pop(key, None)
+
+
+class ComposedView(object):
+    '''the last image built by area_to_image. When the map is panned the
+    overlapping part is re-used and only the tiles which were not in
+    view, or were not yet loaded, are drawn'''
+    def __init__(self, view, origin, img, final):
+        self.view = view
+        self.origin = origin
+        self.img = img
+        self.final = final
+
 
 class TileServiceInfo:
     '''a lookup object for the URL templates'''
@@ -178,11 +215,39 @@ class TileInfoScaled(TileInfo):
         (self.dstx, self.dsty) = dst
 
 
+def point_in_polygon(lat, lon, polygon):
+    '''return True if a point is inside a polygon of (lat,lon) points'''
+    inside = False
+    j = len(polygon) - 1
+    for i in range(len(polygon)):
+        (lat1, lon1) = polygon[i]
+        (lat2, lon2) = polygon[j]
+        if (lon1 > lon) != (lon2 > lon):
+            if lat < lat1 + (lat2 - lat1) * (lon - lon1) / (lon2 - lon1):
+                inside = not inside
+        j = i
+    return inside
+
+
+def tile_in_polygon(tile, polygon):
+    '''return True if a tile overlaps a polygon of (lat,lon) points'''
+    (lat1, lon1) = tile.coord((0, 0))
+    (lat2, lon2) = tile.coord((TILES_WIDTH, TILES_HEIGHT))
+    for (lat, lon) in polygon:
+        if lat2 <= lat <= lat1 and lon1 <= lon <= lon2:
+            return True
+    for (lat, lon) in [(lat1, lon1), (lat1, lon2), (lat2, lon1), (lat2, lon2), ((lat1+lat2)/2, (lon1+lon2)/2)]:
+        if point_in_polygon(lat, lon, polygon):
+            return True
+    return False
+
+
 class MPTile:
     '''map tile object'''
     def __init__(self, cache_path=None, download=True, cache_size=500,
                  service="MicrosoftSat", tile_delay=0.3, debug=False,
-                 max_zoom=19, refresh_age=30*24*60*60):
+                 max_zoom=19, refresh_age=30*24*60*60, download_workers=4,
+                 store='file', store_size=0, scaled_cache_size=200, shared_rate_limits=None):
 
         if cache_path is None:
             try:
@@ -206,16 +271,31 @@ class MPTile:
         self.service = service
         self.debug = debug
         self.refresh_age = refresh_age
+        self._store = tile_store.open_store(store, cache_path, max_size=store_size)
 
         if service not in TILE_SERVICES:
             raise TileException('unknown tile service %s' % service)
 
-        # _download_pending is a dictionary of TileInfo objects
-        self._download_pending = {}
-        self._download_thread = None
+        self._downloader = TileDownloader(self.download_done,
+                                          workers=download_workers,
+                                          tile_delay=tile_delay,
+                                          blank_tiles=BLANK_TILES,
+                                          debug=debug,
+                                          shared_rate_limits=shared_rate_limits)
+        # centre of the last area drawn, used to prioritise downloads
+        self._view_centre = None
         self._loading = mp_icon('loading.jpg')
         self._unavailable = mp_icon('unavailable.jpg')
-        self._tile_cache = collections.OrderedDict()
+        self._tile_cache = LRUCache(cache_size)
+        # scaled copies of loaded tiles, as (width, height, img)
+        self._scaled_cache = LRUCache(scaled_cache_size)
+        # (key, status) of finished downloads, applied by the drawing thread
+        self._tile_updates = collections.deque(maxlen=MAX_TILE_UPDATES)
+        self._composed = None
+
+    def set_download_workers(self, workers):
+        '''set the number of tile download workers'''
+        self._downloader.set_workers(workers)
 
     def set_service(self, service):
         '''set tile service'''
@@ -249,7 +329,22 @@ class MPTile:
 
     def tile_to_path(self, tile):
         '''return full path to a tile'''
-        return os.path.join(self.cache_path, self.service, tile.path())
+        return os.path.join(self.cache_path, tile.service, tile.path())
+
+    def tile_stored(self, tile):
+        '''return True if a tile is in the tile store'''
+        return self._store.has(tile)
+
+    def read_tile(self, tile):
+        '''read a tile from the tile store, returning (img, mtime) or None'''
+        entry = self._store.get(tile)
+        if entry is None:
+            return None
+        (data, mtime) = entry
+        img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            return None
+        return (img, mtime)
 
     def coord_to_tilepath(self, lat, lon, zoom):
         '''return the tile ID that covers a latitude/longitude at
@@ -258,101 +353,58 @@ class MPTile:
         tile = self.coord_to_tile(lat, lon, zoom)
         return self.tile_to_path(tile)
 
+    def area_tiles(self, lat1, lon1, lat2, lon2, zoom, polygon=None):
+        '''generate the tiles covering a lat/lon box at a zoom level. If
+        a polygon is given only the tiles overlapping it are included'''
+        tile_min = self.coord_to_tile(max(lat1, lat2), min(lon1, lon2), zoom)
+        tile_max = self.coord_to_tile(min(lat1, lat2), max(lon1, lon2), zoom)
+        for y in range(tile_min.y, tile_max.y+1):
+            for x in range(tile_min.x, tile_max.x+1):
+                tile = TileInfo((x, y), zoom, self.service)
+                if polygon is None or tile_in_polygon(tile, polygon):
+                    yield tile
+
     def tiles_pending(self):
         '''return number of tiles pending download'''
-        return len(self._download_pending)
-
-    def downloader(self):
-        '''the download thread'''
-        while self.tiles_pending() > 0:
-            time.sleep(self.tile_delay)
-
-            keys = sorted(self._download_pending.keys())
-
-            # work out which one to download next, choosing by request_time
-            tile_info = self._download_pending[keys[0]]
-            for key in keys:
-                if self._download_pending[key].request_time > tile_info.request_time:
-                    tile_info = self._download_pending[key]
-
-            url = tile_info.url(self.service)
-            path = self.tile_to_path(tile_info)
-            key = tile_info.key()
-
-            try:
-                if self.debug:
-                    print("Downloading %s [%u left]" % (url, len(keys)))
-                req = url_request(url)
-                req.add_header('User-Agent', 'MAVProxy')
-
-                # try to re-use our cached data:
-                try:
-                    mtime = os.path.getmtime(path)
-                    req.add_header('If-Modified-Since', time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(mtime)))
-                except Exception:
-                    pass
-
-                if url.find('google') != -1:
-                    req.add_header('Referer', 'https://maps.google.com/')
-                resp = url_open(req)
-                headers = resp.info()
-            except url_error as e:
-                try:
-                    if e.getcode() == 304:
-                        # cache hit; touch the file to reset its refresh time
-                        pathlib.Path(path).touch()
-                        self._download_pending.pop(key)
-                        continue
-                except Exception:
-                    pass
-
-                # print('Error loading %s' % url)
-                if key not in self._tile_cache:
-                    self._tile_cache[key] = self._unavailable
-                self._download_pending.pop(key)
-                if self.debug:
-                    print("Failed %s: %s" % (url, str(e)))
-                continue
-            if 'content-type' not in headers or headers['content-type'].find('image') == -1:
-                if key not in self._tile_cache:
-                    self._tile_cache[key] = self._unavailable
-                self._download_pending.pop(key)
-                if self.debug:
-                    print("non-image response %s" % url)
-                continue
-            else:
-                img = resp.read()
-
-            # see if its a blank/unavailable tile
-            md5 = hashlib.md5(img).hexdigest()
-            if md5 in BLANK_TILES:
-                if self.debug:
-                    print("blank tile %s" % url)
-                    if key not in self._tile_cache:
-                        self._tile_cache[key] = self._unavailable
-                self._download_pending.pop(key)
-                continue
-
-            mp_util.mkdir_p(os.path.dirname(path))
-            h = open(path+'.tmp', 'wb')
-            h.write(img)
-            h.close()
-            try:
-                os.unlink(path)
-            except Exception:
-                pass
-            os.rename(path+'.tmp', path)
-            self._download_pending.pop(key)
-        self._download_thread = None
-
-    def start_download_thread(self):
-        '''start the downloader'''
-        if self._download_thread:
+        return self._downloader.pending_count()
+
+    def request_download(self, tile, mtime=None):
+        '''queue a tile for download. mtime is the modification time of
+        the cached copy when refreshing an old tile'''
+        distance = 0
+        if self._view_centre is not None:
+            distance = tile.distance(self._view_centre[0], self._view_centre[1])
+        self._downloader.request(tile.key(), tile, tile.url(tile.service), mtime=mtime, distance=distance)
+
+    def download_done(self, tile, status, data):
+        '''called from a download worker when a tile has been fetched'''
+        key = tile.key()
+        if status == 'notmodified':
+            # cache hit; reset its refresh time
+            self._store.touch(tile)
             return
-        t = threading.Thread(target=self.downloader)
-        t.daemon = True
-        self._download_thread = t
-        t.start()
+        if status != 'ok':
+            if key not in self._tile_cache:
+                self._tile_updates.append((key, status))
+            return
+        self._store.put(tile, data)
+        if key in self._tile_cache:
+            # a refreshed tile, drop the old image
+            self._tile_updates.append((key, status))
+
+    def apply_tile_updates(self):
+        '''apply finished downloads to the tile caches, returning the
+        keys of tiles with new images'''
+        changed = set()
+        while len(self._tile_updates) > 0:
+            (key, status) = self._tile_updates.popleft()
+            if status == 'ok':
+                self._tile_cache.pop(key)
+                self._scaled_cache.pop(key)
+                changed.add(key)
+            elif key not in self._tile_cache:
+                self._tile_cache.put(key, TILE_UNAVAILABLE)
+        return changed
 
     def load_tile_lowres(self, tile):
         '''load a lower resolution tile from cache to fill in a
@@ -377,22 +429,17 @@ class MPTile:
 
             # see if its in the tile cache
             key = tile_info.key()
-            if key in self._tile_cache:
-                img = self._tile_cache[key]
-                if np.array_equal(img, np.array(self._unavailable)):
-                    continue
-            else:
-                path = self.tile_to_path(tile_info)
-                if not os.path.exists(path):
-                    continue
-                img = cv2.imread(path)
-                if img is None:
+            img = self._tile_cache.get(key)
+            if img is TILE_UNAVAILABLE:
+                continue
+            if img is None:
+                entry = self.read_tile(tile_info)
+                if entry is None:
                     continue
+                img = entry[0]
                 # cv2.rectangle(img, (0,0), (TILES_WIDTH-1,TILES_WIDTH-1), (255,0,0), 1)
                 # add it to the tile cache
-                self._tile_cache[key] = img
-                while len(self._tile_cache) > self.cache_size:
-                    self._tile_cache.popitem(0)
+                self._tile_cache.put(key, img)
 
             # copy out the quadrant we want
             availx = min(TILES_WIDTH - tile_info.offsetx, width2)
@@ -412,62 +459,69 @@ class MPTile:
 
     def load_tile(self, tile):
         '''load a tile from cache or tile server'''
+        return self.load_tile_final(tile)[0]
+
+    def load_tile_final(self, tile):
+        '''load a tile from cache or tile server, returning (img, final)
+        where final is False if img is a stand-in for a tile which is
+        loading or unavailable'''
 
         # see if its in the tile cache
         key = tile.key()
-        if key in self._tile_cache:
-            img = self._tile_cache[key]
-            if np.array_equal(img, self._unavailable):
-                img = self.load_tile_lowres(tile)
-                if img is None:
-                    img = self._unavailable
-            return img
+        img = self._tile_cache.get(key)
+        if img is TILE_UNAVAILABLE:
+            img = self.load_tile_lowres(tile)
+            if img is None:
+                img = self._unavailable
+            return (img, False)
+        if img is not None:
+            return (img, True)
 
-        path = self.tile_to_path(tile)
-        if not os.path.exists(path):
-            ret = None
-        else:
-            ret = cv2.imread(path)
-        if ret is not None:
+        entry = self.read_tile(tile)
+        if entry is not None:
+            (ret, mtime) = entry
             # cv2.rectangle(ret, (0,0), (TILES_WIDTH-1,TILES_WIDTH-1), (255,0,0), 1)
             # if it is an old tile, then try to refresh
-            if os.path.getmtime(path) + self.refresh_age < time.time():
-                try:
-                    self._download_pending[key].refresh_time()
-                except Exception:
-                    self._download_pending[key] = tile
-                self.start_download_thread()
+            if mtime + self.refresh_age < time.time():
+                self.request_download(tile, mtime)
 
             # add it to the tile cache
-            self._tile_cache[key] = ret
-            while len(self._tile_cache) > self.cache_size:
-                self._tile_cache.popitem(0)
-            return ret
+            self._tile_cache.put(key, ret)
+            return (ret, True)
 
         if not self.download:
             img = self.load_tile_lowres(tile)
             if img is None:
                 img = self._unavailable
-            return img
+            return (img, False)
 
-        try:
-            self._download_pending[key].refresh_time()
-        except Exception:
-            self._download_pending[key] = tile
-        self.start_download_thread()
+        self.request_download(tile)
 
         img = self.load_tile_lowres(tile)
         if img is None:
             img = self._loading
-        return img
+        return (img, False)
 
     def scaled_tile(self, tile):
         '''return a scaled tile'''
+        return self.scaled_tile_final(tile)[0]
+
+    def scaled_tile_final(self, tile):
+        '''return (img, final) for a scaled tile, see load_tile_final'''
         width = int(TILES_WIDTH / tile.scale)
         height = int(TILES_HEIGHT / tile.scale)
-        full_tile = self.load_tile(tile)
-        scaled_tile = cv2.resize(full_tile, (height, width))
-        return scaled_tile
+        key = tile.key()
+        entry = self._scaled_cache.get(key)
+        if entry is not None and entry[0] == width and entry[1] == height:
+            return (entry[2], True)
+        (full_tile, final) = self.load_tile_final(tile)
+        if width == TILES_WIDTH and height == TILES_HEIGHT:
+            scaled_tile = full_tile
+        else:
+            scaled_tile = cv2.resize(full_tile, (height, width))
+        if final:
+            self._scaled_cache.put(key, (width, height, scaled_tile))
+        return (scaled_tile, final)
 
     def coord_from_area(self, x, y, lat, lon, width, ground_width):
         '''return (lat,lon) for a pixel in an area image
@@ -508,12 +562,27 @@ class MPTile:
         y = C * (log(abs(1.0/cos(latr) + tan(latr))) - log(abs(1.0/cos(lat2r) + tan(lat2r))))
         y = int(y+0.5)
 
-        dx = mp_util.gps_distance(lat2, lon, lat2, lon2)
-        if mp_util.gps_bearing(lat2, lon, lat2, lon2) > 180:
-            dx = -dx
-        x = int(0.5 + dx / (pixel_width_equator * cos(radians(lat2))))
+        # the rhumb distance R*dlon*cos(lat2) over the pixel width at
+        # lat2, as in coords_to_pixels
+        x = int(0.5 + C * radians(lon2 - lon))
         return (x, y)
 
+    def coords_to_pixels(self, lat, lon, width, ground_width, lat2, lon2):
+        '''return an Nx2 int32 array of pixel coordinates for arrays of
+        positions lat2,lon2, using the same formula as coord_to_pixel'''
+        pixel_width_equator = (ground_width / float(width)) / cos(radians(lat))
+        latr = radians(lat)
+        lat2r = np.radians(lat2)
+
+        C = mp_util.radius_of_earth / pixel_width_equator
+        y = C * (log(abs(1.0/cos(latr) + tan(latr))) - np.log(np.abs(1.0/np.cos(lat2r) + np.tan(lat2r))))
+        # the rhumb distance R*dlon*cos(lat2) over the pixel width at lat2
+        x = C * np.radians(np.asarray(lon2) - lon)
+        ret = np.empty((len(y), 2), dtype=np.int32)
+        ret[:, 0] = np.clip(np.trunc(x + 0.5), -2**30, 2**30)
+        ret[:, 1] = np.clip(np.trunc(y + 0.5), -2**30, 2**30)
+        return ret
+
     def area_to_tile_list(self, lat, lon, width, height, ground_width, zoom=None):
         '''return a list of TileInfoScaled objects needed for
         an area of land, with ground_width in meters, and
@@ -557,14 +626,16 @@ class MPTile:
 
         ret = []
 
-        # place the tiles
-        for y in range(tile_min.y, tile_max.y+1):
+        # place the tiles. The bottom right tile is found from a ground
+        # distance so may fall one short, allow an extra row and column
+        # and rely on the pixel limits to drop any that are not needed
+        world_tiles = 1 << zoom
+        count_x = min((tile_max.x - tile_min.x) % world_tiles + 2, world_tiles)
+        for y in range(tile_min.y, min(tile_max.y+2, world_tiles)):
             srcx = ofsx
             dstx = 0
-            world_tiles = 1 << zoom
-            lim_x = (tile_max.x+1) % world_tiles
             x = tile_min.x
-            while x != lim_x:
+            for i in range(count_x):
                 if dstx < width and dsty < height:
                     ret.append(TileInfoScaled((x, y), zoom, scale,
                                               (srcx, srcy), (dstx, dsty), self.service))
@@ -582,30 +653,72 @@ class MPTile:
         lat/lon is the top left corner. The zoom is automatically
         chosen to avoid having to grow the tiles'''
 
+        tlist = self.area_to_tile_list(lat, lon, width, height, ground_width, zoom)
+
+        # downloads for this view are fetched before those for earlier
+        # views, closest to the middle first
+        (midlat, midlon) = self.coord_from_area(width/2, height/2, lat, lon, width, ground_width)
+        self._view_centre = (midlat, midlon)
+        self._downloader.new_view()
+
+        changed = self.apply_tile_updates()
         img = np.zeros((height, width, 3), np.uint8)
+        if len(tlist) == 0:
+            self._composed = None
+            return img
 
-        tlist = self.area_to_tile_list(lat, lon, width, height, ground_width, zoom)
+        # the first tile is the top left one. Its position in the scaled
+        # tile grid gives the offset from the last image when panning
+        first = tlist[0]
+        tile_width = int(TILES_WIDTH / first.scale)
+        tile_height = int(TILES_HEIGHT / first.scale)
+        view = (first.zoom, first.service, tile_width, tile_height, width, height)
+        origin = (first.x * tile_width + first.srcx, first.y * tile_height + first.srcy)
+
+        # copy the part of the last image which is still in view
+        last = self._composed
+        copied = None
+        if last is not None and last.view == view:
+            dx = origin[0] - last.origin[0]
+            dy = origin[1] - last.origin[1]
+            if abs(dx) < width and abs(dy) < height:
+                copied = (max(0, -dx), max(0, -dy), min(width, width-dx), min(height, height-dy))
+                (x1, y1, x2, y2) = copied
+                img[y1:y2, x1:x2] = last.img[y1+dy:y2+dy, x1+dx:x2+dx]
+
+        final = set()
+        draw = []
+        for t in tlist:
+            key = t.key()
+            w = min(width - t.dstx, tile_width - t.srcx)
+            h = min(height - t.dsty, tile_height - t.srcy)
+            if w <= 0 or h <= 0:
+                continue
+            if (copied is not None and key in last.final and key not in changed and
+                    t.dstx >= copied[0] and t.dsty >= copied[1] and
+                    t.dstx + w <= copied[2] and t.dsty + h <= copied[3]):
+                # already drawn in the copied area
+                final.add(key)
+                continue
+            draw.append(t)
 
-        # order the display by distance from the middle, so the download happens
-        # close to the middle of the image first
+        # order the display by distance from the middle
         if ordered:
-            (midlat, midlon) = self.coord_from_area(width/2, height/2, lat, lon, width, ground_width)
-            tlist.sort(key=lambda d: d.distance(midlat, midlon), reverse=True)
+            draw.sort(key=lambda d: d.distance(midlat, midlon), reverse=True)
 
-        for t in tlist:
-            scaled_tile = self.scaled_tile(t)
+        for t in draw:
+            (scaled_tile, tile_final) = self.scaled_tile_final(t)
+            scaled_tile_roi = scaled_tile[t.srcy:t.srcy+height-t.dsty, t.srcx:t.srcx+width-t.dstx]
+            h = scaled_tile_roi.shape[0]
+            w = scaled_tile_roi.shape[1]
+            img[t.dsty:t.dsty+h, t.dstx:t.dstx+w] = scaled_tile_roi
+            if tile_final:
+                final.add(t.key())
 
-            w = width - t.dstx
-            h = height - t.dsty
-            if w > 0 and h > 0:
-                scaled_tile_roi = scaled_tile[t.srcy:t.srcy+h, t.srcx:t.srcx+w]
-                h = scaled_tile_roi.shape[0]
-                w = scaled_tile_roi.shape[1]
-                img[t.dsty:t.dsty+h, t.dstx:t.dstx+w] = scaled_tile_roi.copy()
+        self._composed = ComposedView(view, origin, img, final)
 
         # return as an RGB image
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        return img
+        return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
 
 
 def mp_icon(filename):
@@ -649,6 +762,7 @@ if __name__ == "__main__":
     parser.add_option("--max-zoom", type='int', default=19, help="maximum tile zoom")
     parser.add_option("--delay", type='float', default=1.0, help="tile download delay")
     parser.add_option("--boundary", default=None, help="region boundary")
+    parser.add_option("--store", default='file', choices=tile_store.STORE_TYPES, help="tile store type")
     parser.add_option("--debug", action='store_true', default=False, help="show debug info")
     (opts, args) = parser.parse_args()
 
@@ -670,6 +784,7 @@ if __name__ == "__main__":
         service=opts.service,
         tile_delay=opts.delay,
         max_zoom=opts.max_zoom,
+        store=opts.store,
     )
     if opts.zoom is None:
         zooms = range(mt.min_zoom, mt.max_zoom+1)
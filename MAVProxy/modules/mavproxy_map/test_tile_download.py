@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+'''
+tests for tile_download, fetching tiles from a local http server
+
+AP_FLAKE8_CLEAN
+'''
+
+import hashlib
+import http.server
+import threading
+import time
+import unittest
+from unittest import mock
+
+from MAVProxy.modules.mavproxy_map import tile_download
+
+BLANK = b'blank tile'
+
+
+class Tile(object):
+    def __init__(self, service, name):
+        self.service = service
+        self.name = name
+
+
+class TileHandler(http.server.BaseHTTPRequestHandler):
+    '''serves the path as an image. /gate waits until the test opens the
+    gate, /blank is a blank tile, /text is not an image, /close closes
+    the connection, /drop closes it without telling the client and
+    /redirect redirects to a tile'''
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, self.client_address[1], time.time()))
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        if self.path.startswith('/gate'):
+            server.gate_reached.set()
+            server.gate.wait(10)
+        with server.lock:
+            server.active -= 1
+        headers = {}
+        status = 200
+        body = self.path.encode('ascii')
+        content_type = 'image/png'
+        if self.path == '/blank':
+            body = BLANK
+        elif self.path == '/text':
+            content_type = 'text/html'
+        elif self.path == '/missing':
+            status = 404
+        elif self.path == '/redirect':
+            status = 302
+            headers['Location'] = '/tile/redirected'
+        elif self.path == '/close':
+            headers['Connection'] = 'close'
+        elif self.path == '/drop':
+            self.close_connection = True
+        if self.headers.get('If-Modified-Since', None) is not None:
+            status = 304
+            body = b''
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for (k, v) in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class TileServerTest(unittest.TestCase):
+
+    def setUp(self):
+        # connect directly whatever the proxy environment
+        patcher = mock.patch.object(tile_download, 'getproxies', return_value={})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), TileHandler)
+        self.server.daemon_threads = True
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.active = 0
+        self.server.max_active = 0
+        self.server.gate = threading.Event()
+        self.server.gate_reached = threading.Event()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.base = 'http://127.0.0.1:%u' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.gate.set()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def request_times(self, prefix):
+        with self.server.lock:
+            return [r[2] for r in self.server.requests if r[0].startswith(prefix)]
+
+    def client_ports(self):
+        with self.server.lock:
+            return set([r[1] for r in self.server.requests])
+
+
+class ConnectionPoolTest(TileServerTest):
+
+    def test_keep_alive(self):
+        '''consecutive tiles use one connection'''
+        pool = tile_download.ConnectionPool()
+        for i in range(5):
+            (status, content_type, body) = pool.fetch(self.base + '/tile/%u' % i, {})
+            self.assertEqual((status, content_type, body), (200, 'image/png', b'/tile/%u' % i))
+        self.assertEqual(len(self.client_ports()), 1)
+        pool.close()
+
+    def test_reconnect(self):
+        '''a connection closed by the server is replaced'''
+        pool = tile_download.ConnectionPool()
+        pool.fetch(self.base + '/close', {})
+        pool.fetch(self.base + '/tile/1', {})
+        self.assertEqual(len(self.client_ports()), 2)
+        # closed without a Connection header, so the next request fails
+        # on the old connection and is retried on a new one
+        pool.fetch(self.base + '/drop', {})
+        (status, content_type, body) = pool.fetch(self.base + '/tile/2', {})
+        self.assertEqual((status, body), (200, b'/tile/2'))
+        self.assertEqual(len(self.client_ports()), 3)
+        pool.close()
+
+    def test_redirect(self):
+        pool = tile_download.ConnectionPool()
+        (status, content_type, body) = pool.fetch(self.base + '/redirect', {})
+        self.assertEqual((status, body), (200, b'/tile/redirected'))
+        self.assertEqual(len(self.client_ports()), 1)
+        pool.close()
+
+
+class RateLimitTest(unittest.TestCase):
+
+    def test_rate(self):
+        r = tile_download.RateLimit(10.0)
+        now = r.last
+        self.assertEqual(r.delay(now), 0)
+        self.assertAlmostEqual(r.delay(now), 0.1)
+        self.assertAlmostEqual(r.delay(now), 0.2)
+        # tokens refill over time
+        self.assertAlmostEqual(r.delay(now + 1.0), 0)
+
+    def test_shared(self):
+        with mock.patch.dict(tile_download.SERVICE_RATE_LIMITS, {'slow': 5.0}):
+            limits = tile_download.SharedRateLimits(['slow', 'fast'])
+            now = time.time()
+            self.assertEqual(limits.delay('slow', now), 0)
+            self.assertAlmostEqual(limits.delay('slow', now), 0.2, places=3)
+            self.assertEqual(limits.delay('fast', now), 0)
+            self.assertIsNone(limits.delay('other', now))
+
+
+class TileDownloaderTest(TileServerTest):
+
+    def setUp(self):
+        super(TileDownloaderTest, self).setUp()
+        self.lock = threading.Lock()
+        self.results = []
+
+    def callback(self, tile, status, data):
+        with self.lock:
+            self.results.append((tile.name, status, data))
+
+    def downloader(self, **kwargs):
+        return tile_download.TileDownloader(self.callback, **kwargs)
+
+    def request(self, d, service, name, path=None, mtime=None, distance=0):
+        if path is None:
+            path = '/tile/' + name
+        d.request(name, Tile(service, name), self.base + path, mtime=mtime, distance=distance)
+
+    def test_status(self):
+        d = self.downloader(blank_tiles=set([hashlib.md5(BLANK).hexdigest()]))
+        self.request(d, 'test', 'ok')
+        self.request(d, 'test', 'blank', path='/blank')
+        self.request(d, 'test', 'text', path='/text')
+        self.request(d, 'test', 'missing', path='/missing')
+        self.request(d, 'test', 'cached', mtime=time.time())
+        self.assertTrue(wait_for(lambda: len(self.results) == 5))
+        self.assertEqual(sorted(self.results), [
+            ('blank', 'blank', None),
+            ('cached', 'notmodified', None),
+            ('missing', 'error', None),
+            ('ok', 'ok', b'/tile/ok'),
+            ('text', 'error', None)])
+        self.assertEqual(d.pending_count(), 0)
+
+    def test_priority(self):
+        '''the newest view is fetched first, closest to the centre first'''
+        d = self.downloader(workers=1)
+        self.request(d, 'test', 'gate', path='/gate')
+        self.assertTrue(self.server.gate_reached.wait(10))
+        self.request(d, 'test', 'a', distance=3)
+        self.request(d, 'test', 'b', distance=1)
+        d.new_view()
+        self.request(d, 'test', 'c', distance=2)
+        self.request(d, 'test', 'd', distance=0)
+        # still wanted in the new view
+        self.request(d, 'test', 'a', distance=5)
+        # already being downloaded
+        self.request(d, 'test', 'gate', path='/gate')
+        self.assertEqual(d.pending_count(), 5)
+        self.server.gate.set()
+        self.assertTrue(wait_for(lambda: d.pending_count() == 0))
+        self.assertEqual([r[0] for r in self.results], ['gate', 'd', 'c', 'a', 'b'])
+        # one worker reuses one connection
+        self.assertEqual(len(self.client_ports()), 1)
+
+    def test_rate_limit(self):
+        '''each service is limited to its own rate'''
+        with mock.patch.dict(tile_download.SERVICE_RATE_LIMITS, {'slow': 5.0}):
+            d = self.downloader(workers=4)
+            for i in range(4):
+                self.request(d, 'fast', 'fast%u' % i, distance=0)
+            for i in range(4):
+                self.request(d, 'slow', 'slow%u' % i, distance=1)
+            self.assertTrue(wait_for(lambda: len(self.results) == 8))
+        slow = sorted(self.request_times('/tile/slow'))
+        fast = sorted(self.request_times('/tile/fast'))
+        for (t1, t2) in zip(slow, slow[1:]):
+            self.assertGreater(t2 - t1, 0.15)
+        self.assertLess(fast[-1] - fast[0], 0.4)
+
+    def test_set_workers(self):
+        '''the number of parallel downloads follows set_workers'''
+        d = self.downloader(workers=1)
+        for i in range(3):
+            self.request(d, 'test', 'one%u' % i, path='/gate/one%u' % i)
+        self.assertTrue(self.server.gate_reached.wait(10))
+        time.sleep(0.2)
+        self.assertEqual(self.server.max_active, 1)
+        d.set_workers(3)
+        for i in range(3):
+            self.request(d, 'test', 'three%u' % i, path='/gate/three%u' % i)
+        self.assertTrue(wait_for(lambda: self.server.active == 3))
+        d.set_workers(1)
+        self.server.gate.set()
+        self.assertTrue(wait_for(lambda: len(self.results) == 6))
+        # extra workers exit once their download is done
+        self.assertTrue(wait_for(lambda: d.workers == 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+'''
+parallel map tile downloader
+
+tiles are fetched by a small pool of worker threads. Each worker keeps
+a keep-alive HTTP connection per server so consecutive tiles from a
+service do not pay for a new TCP and TLS handshake. Requests sit in a
+heap ordered by view generation and then by distance from the view
+centre, so the tiles the user is looking at now are fetched first and
+the tiles of an area panned away from wait. Each service has its own
+rate limit
+
+AP_FLAKE8_CLEAN
+'''
+
+import base64
+import hashlib
+import heapq
+import http.client
+import threading
+import time
+
+from urllib.parse import unquote, urljoin, urlsplit
+from urllib.request import getproxies, proxy_bypass
+
+from MAVProxy.modules.lib import multiproc
+
+# default requests per second to one tile service
+DEFAULT_RATE_LIMIT = 20.0
+
+# per-service rate limits, for services with a stricter usage policy
+SERVICE_RATE_LIMITS = {
+    "OpenStreetMap": 2.0,
+}
+
+# services whose usage policy forbids bulk downloading, such as an
+# offline prefetch
+NO_BULK_DOWNLOAD = frozenset([
+    "OpenStreetMap",
+])
+
+# seconds before a connection attempt or read is abandoned
+HTTP_TIMEOUT = 20
+
+# seconds a worker waits for more work before exiting
+WORKER_IDLE_TIME = 5
+
+MAX_REDIRECTS = 3
+
+
+class TileRequest(object):
+    '''a tile waiting to be downloaded'''
+    def __init__(self, tile, url, mtime, generation, distance):
+        self.tile = tile
+        self.url = url
+        self.mtime = mtime
+        self.generation = generation
+        self.distance = distance
+        self.seq = 0
+
+    def priority(self):
+        '''heap ordering, newest view first then closest to the centre'''
+        return (-self.generation, self.distance, self.seq)
+
+
+class RateLimit(object):
+    '''token bucket limiting the request rate to one service'''
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = 1.0
+        self.last = time.time()
+
+    def delay(self, now):
+        '''take a token, returning how long to wait before using it'''
+        self.tokens = min(self.tokens + (now - self.last) * self.rate, max(self.rate, 1.0))
+        self.last = now
+        self.tokens -= 1.0
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+
+class SharedRateLimits(object):
+    '''per-service token buckets in shared memory, so that downloaders
+    in several processes, such as the map display and a prefetch, share
+    each service's rate limit. Must be created before the processes are
+    started'''
+    def __init__(self, services):
+        self.index = dict([(s, i) for (i, s) in enumerate(sorted(services))])
+        # tokens then time of last use for each service
+        self.state = multiproc.Array('d', 2 * len(self.index))
+        now = time.time()
+        for i in range(len(self.index)):
+            self.state[2*i] = 1.0
+            self.state[2*i+1] = now
+
+    def delay(self, service, now):
+        '''take a token for a service, returning how long to wait before
+        using it, or None for an unknown service'''
+        i = self.index.get(service, None)
+        if i is None:
+            return None
+        rate = SERVICE_RATE_LIMITS.get(service, DEFAULT_RATE_LIMIT)
+        with self.state.get_lock():
+            tokens = min(self.state[2*i] + (now - self.state[2*i+1]) * rate, max(rate, 1.0))
+            self.state[2*i] = tokens - 1.0
+            self.state[2*i+1] = now
+        if tokens >= 1.0:
+            return 0
+        return (1.0 - tokens) / rate
+
+
+class ConnectionPool(object):
+    '''keep-alive HTTP connections of one worker, one per server.
+
+    the http_proxy, https_proxy and no_proxy environment variables are
+    honoured as urlopen does: http requests are sent to the proxy with
+    the absolute URL and https requests are tunnelled with CONNECT'''
+    def __init__(self):
+        self.connections = {}
+        self.proxies = getproxies()
+
+    def proxy(self, scheme, netloc):
+        '''return (host, port, headers) of the proxy for a server, or None'''
+        proxy = self.proxies.get(scheme, None)
+        if proxy is None:
+            return None
+        if proxy_bypass(urlsplit('//' + netloc).hostname or netloc):
+            return None
+        if proxy.find('://') == -1:
+            proxy = 'http://' + proxy
+        u = urlsplit(proxy)
+        headers = {}
+        if u.username is not None:
+            auth = '%s:%s' % (unquote(u.username), unquote(u.password or ''))
+            headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(auth.encode('utf-8')).decode('ascii')
+        return (u.hostname, u.port or 80, headers)
+
+    def get(self, scheme, netloc):
+        '''return (connection, proxy_headers). proxy_headers is None
+        unless requests must carry the absolute URL for a proxy'''
+        key = (scheme, netloc)
+        entry = self.connections.get(key, None)
+        if entry is None:
+            proxy = self.proxy(scheme, netloc)
+            proxy_headers = None
+            if proxy is None:
+                if scheme == 'https':
+                    conn = http.client.HTTPSConnection(netloc, timeout=HTTP_TIMEOUT)
+                else:
+                    conn = http.client.HTTPConnection(netloc, timeout=HTTP_TIMEOUT)
+            else:
+                (host, port, headers) = proxy
+                if scheme == 'https':
+                    conn = http.client.HTTPSConnection(host, port, timeout=HTTP_TIMEOUT)
+                    conn.set_tunnel(netloc, headers=headers)
+                else:
+                    conn = http.client.HTTPConnection(host, port, timeout=HTTP_TIMEOUT)
+                    proxy_headers = headers
+            entry = (conn, proxy_headers)
+            self.connections[key] = entry
+        return entry
+
+    def discard(self, scheme, netloc):
+        entry = self.connections.pop((scheme, netloc), None)
+        if entry is not None:
+            entry[0].close()
+
+    def close(self):
+        for (conn, proxy_headers) in self.connections.values():
+            conn.close()
+        self.connections = {}
+
+    def fetch(self, url, headers):
+        '''fetch a URL, following redirects. Returns (status, content_type,
+        body). Raises OSError or HTTPException on failure'''
+        for i in range(MAX_REDIRECTS+1):
+            u = urlsplit(url)
+            path = u.path or '/'
+            if u.query:
+                path += '?' + u.query
+            # a kept-alive connection may have been closed by the
+            # server, so retry once on a fresh connection
+            for attempt in range(2):
+                (conn, proxy_headers) = self.get(u.scheme, u.netloc)
+                req_path = path
+                req_headers = headers
+                if proxy_headers is not None:
+                    req_path = '%s://%s%s' % (u.scheme, u.netloc, path)
+                    req_headers = dict(headers)
+                    req_headers.update(proxy_headers)
+                try:
+                    conn.request('GET', req_path, headers=req_headers)
+                    resp = conn.getresponse()
+                    body = resp.read()
+                    break
+                except (http.client.HTTPException, OSError):
+                    self.discard(u.scheme, u.netloc)
+                    if attempt == 1:
+                        raise
+            if resp.will_close:
+                self.discard(u.scheme, u.netloc)
+            location = resp.getheader('location', None)
+            if resp.status in (301, 302, 303, 307, 308) and location is not None:
+                url = urljoin(url, location)
+                continue
+            return (resp.status, resp.getheader('content-type', ''), body)
+        raise http.client.HTTPException("too many redirects")
+
+
+class TileDownloader(object):
+    '''download tiles with a pool of workers
+
+    the callback is called from a worker thread as
+    callback(tile, status, data), where status is one of 'ok',
+    'notmodified', 'blank' or 'error' and data is the image for 'ok'
+    '''
+    def __init__(self, callback, workers=4, tile_delay=0, blank_tiles=None, debug=False,
+                 shared_rate_limits=None):
+        self.callback = callback
+        self.max_workers = max(workers, 1)
+        self.tile_delay = tile_delay
+        self.blank_tiles = blank_tiles or set()
+        self.debug = debug
+        self.lock = threading.Condition()
+        self.heap = []
+        self.pending = {}
+        self.active = set()
+        self.workers = 0
+        self.generation = 0
+        self.seq = 0
+        self.rate_limits = {}
+        self.shared_rate_limits = shared_rate_limits
+
+    def set_workers(self, workers):
+        '''set the maximum number of workers. Extra workers exit once
+        they are idle'''
+        with self.lock:
+            self.max_workers = max(workers, 1)
+
+    def new_view(self):
+        '''start a new view generation. Requests made after this are
+        fetched before older ones'''
+        with self.lock:
+            self.generation += 1
+
+    def pending_count(self):
+        '''number of tiles waiting or being downloaded'''
+        with self.lock:
+            return len(self.pending) + len(self.active)
+
+    def request(self, key, tile, url, mtime=None, distance=0):
+        '''queue a tile for download, or raise the priority of a queued
+        tile. mtime is the time of the cached copy, if any'''
+        with self.lock:
+            if key in self.active:
+                return
+            req = self.pending.get(key, None)
+            if req is None:
+                req = TileRequest(tile, url, mtime, self.generation, distance)
+                self.pending[key] = req
+            elif req.generation == self.generation and req.distance == distance:
+                return
+            else:
+                req.generation = self.generation
+                req.distance = distance
+            # older heap entries for this key are skipped when popped
+            self.seq += 1
+            req.seq = self.seq
+            heapq.heappush(self.heap, (req.priority(), key))
+            if len(self.heap) > 4 * len(self.pending) + 64:
+                # the view is redrawn often, drop the stale entries
+                self.heap = [(r.priority(), k) for (k, r) in self.pending.items()]
+                heapq.heapify(self.heap)
+            if self.workers < min(self.max_workers, len(self.pending)):
+                self.workers += 1
+                t = threading.Thread(target=self.worker)
+                t.daemon = True
+                t.start()
+            self.lock.notify()
+
+    def next_request(self):
+        '''pop the highest priority request, waiting for one if needed'''
+        with self.lock:
+            deadline = time.time() + WORKER_IDLE_TIME
+            while True:
+                if self.workers > self.max_workers:
+                    # the number of workers has been reduced
+                    self.workers -= 1
+                    return (None, None)
+                while len(self.heap) > 0:
+                    (priority, key) = heapq.heappop(self.heap)
+                    req = self.pending.get(key, None)
+                    if req is None or req.priority() != priority:
+                        # stale entry
+                        continue
+                    self.pending.pop(key)
+                    self.active.add(key)
+                    return (key, req)
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.workers -= 1
+                    return (None, None)
+                self.lock.wait(remaining)
+
+    def rate_delay(self, service):
+        '''return the delay needed to respect the service rate limit'''
+        if self.shared_rate_limits is not None:
+            delay = self.shared_rate_limits.delay(service, time.time())
+            if delay is not None:
+                return delay
+        with self.lock:
+            if service not in self.rate_limits:
+                rate = SERVICE_RATE_LIMITS.get(service, DEFAULT_RATE_LIMIT)
+                self.rate_limits[service] = RateLimit(rate)
+            return self.rate_limits[service].delay(time.time())
+
+    def worker(self):
+        '''worker thread'''
+        pool = ConnectionPool()
+        last_start = 0
+        while True:
+            (key, req) = self.next_request()
+            if key is None:
+                break
+            delay = max(self.rate_delay(req.tile.service),
+                        last_start + self.tile_delay - time.time())
+            if delay > 0:
+                time.sleep(delay)
+            last_start = time.time()
+            try:
+                (status, data) = self.download(pool, req)
+            except Exception as ex:
+                if self.debug:
+                    print("Failed %s: %s" % (req.url, str(ex)))
+                (status, data) = ('error', None)
+            # the tile stays pending until the callback has stored it,
+            # so a redraw when the count drops sees the new tile
+            try:
+                self.callback(req.tile, status, data)
+            finally:
+                with self.lock:
+                    self.active.discard(key)
+        pool.close()
+
+    def download(self, pool, req):
+        '''download one tile, returning (status, data)'''
+        headers = {'User-Agent': 'MAVProxy'}
+        if req.mtime is not None:
+            # try to re-use our cached data
+            headers['If-Modified-Since'] = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(req.mtime))
+        if req.url.find('google') != -1:
+            headers['Referer'] = 'https://maps.google.com/'
+        if self.debug:
+            print("Downloading %s [%u left]" % (req.url, self.pending_count()))
+        (status, content_type, body) = pool.fetch(req.url, headers)
+        if status == 304:
+            return ('notmodified', None)
+        if status != 200:
+            if self.debug:
+                print("Failed %s: HTTP %u" % (req.url, status))
+            return ('error', None)
+        if content_type.find('image') == -1:
+            if self.debug:
+                print("non-image response %s" % req.url)
+            return ('error', None)
+        if hashlib.md5(body).hexdigest() in self.blank_tiles:
+            if self.debug:
+                print("blank tile %s" % req.url)
+            return ('blank', None)
+        return ('ok', body)
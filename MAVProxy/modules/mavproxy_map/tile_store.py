@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+'''
+on-disk storage of map tiles
+
+two stores are available. The file store keeps the original layout of
+one image file per tile under <cache>/<service>/<zoom>/<y>/<x>.img. The
+sqlite store keeps all tiles of a service in a single MBTiles file,
+<cache>/<service>.mbtiles, indexed on (zoom, x, y). This avoids a
+stat() and open() per tile and keeps a large offline cache in one file
+which is quick to copy to a field laptop. The sqlite store can be given
+a size cap, with the least recently used tiles removed first
+
+both stores take TileInfo objects and hold the raw downloaded image data
+
+AP_FLAKE8_CLEAN
+'''
+
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+
+from MAVProxy.modules.lib import mp_util
+
+# access times are only updated when older than this, so that reading
+# tiles rarely needs a write
+ATIME_RESOLUTION = 3600
+
+# when over the size cap, tiles are removed down to this fraction of
+# it. The size is checked again once this much space has been used
+EVICT_TARGET = 0.9
+
+STORE_TYPES = ['file', 'sqlite']
+
+
+class FileTileStore(object):
+    '''one image file per tile'''
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+
+    def path(self, tile):
+        '''return full path to a tile'''
+        return os.path.join(self.cache_path, tile.service, tile.path())
+
+    def get(self, tile):
+        '''return (data, mtime) for a tile, or None if not stored'''
+        try:
+            with open(self.path(tile), 'rb') as f:
+                mtime = os.fstat(f.fileno()).st_mtime
+                return (f.read(), mtime)
+        except OSError:
+            return None
+
+    def has(self, tile):
+        '''return True if a tile is stored'''
+        return os.path.exists(self.path(tile))
+
+    def put(self, tile, data, mtime=None):
+        '''store the image data for a tile'''
+        path = self.path(tile)
+        mp_util.mkdir_p(os.path.dirname(path))
+        with open(path+'.tmp', 'wb') as h:
+            h.write(data)
+        os.replace(path+'.tmp', path)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def touch(self, tile):
+        '''mark a stored tile as up to date'''
+        try:
+            pathlib.Path(self.path(tile)).touch()
+        except OSError:
+            pass
+
+    def close(self):
+        pass
+
+
+class SQLiteTileStore(object):
+    '''one MBTiles file per service. max_size is the cap in bytes of the
+    tile data in each file, or 0 for no cap'''
+    def __init__(self, cache_path, max_size=0):
+        self.cache_path = cache_path
+        self.max_size = max_size
+        # connections can't be shared between threads
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # bytes added to each service since its size was last checked
+        self.added = {}
+
+    def filename(self, service):
+        '''return the MBTiles file for a service'''
+        return os.path.join(self.cache_path, service + '.mbtiles')
+
+    def connection(self, service):
+        '''return this thread's connection to the store for a service'''
+        conns = getattr(self.local, 'connections', None)
+        if conns is None:
+            conns = {}
+            self.local.connections = conns
+        conn = conns.get(service, None)
+        if conn is None:
+            mp_util.mkdir_p(self.cache_path)
+            conn = sqlite3.connect(self.filename(service), timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)')
+            conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS metadata_index ON metadata (name)')
+            conn.execute('CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, '
+                         'tile_row INTEGER, tile_data BLOB, mtime REAL, atime REAL)')
+            conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row)')
+            conn.execute('CREATE INDEX IF NOT EXISTS tile_atime ON tiles (atime)')
+            conn.executemany('INSERT OR IGNORE INTO metadata (name, value) VALUES (?, ?)',
+                             [('name', service), ('type', 'baselayer'), ('version', '1.0'),
+                              ('description', 'MAVProxy tile cache')])
+            conns[service] = conn
+        return conn
+
+    def row(self, tile):
+        '''MBTiles uses TMS row numbering, counting up from the south'''
+        return (1 << tile.zoom) - 1 - tile.y
+
+    def get(self, tile):
+        '''return (data, mtime) for a tile, or None if not stored'''
+        conn = self.connection(tile.service)
+        r = conn.execute('SELECT tile_data, mtime, atime FROM tiles '
+                         'WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                         (tile.zoom, tile.x, self.row(tile))).fetchone()
+        if r is None:
+            return None
+        (data, mtime, atime) = r
+        now = time.time()
+        if self.max_size > 0 and (atime is None or atime + ATIME_RESOLUTION < now):
+            try:
+                conn.execute('UPDATE tiles SET atime=? WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                             (now, tile.zoom, tile.x, self.row(tile)))
+            except sqlite3.OperationalError:
+                # the store is busy, the access time is only a hint
+                pass
+        if mtime is None:
+            mtime = now
+        return (bytes(data), mtime)
+
+    def has(self, tile):
+        '''return True if a tile is stored'''
+        r = self.connection(tile.service).execute(
+            'SELECT 1 FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+            (tile.zoom, tile.x, self.row(tile))).fetchone()
+        return r is not None
+
+    def put(self, tile, data, mtime=None):
+        '''store the image data for a tile'''
+        now = time.time()
+        if mtime is None:
+            mtime = now
+        conn = self.connection(tile.service)
+        conn.execute('INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data, mtime, atime) '
+                     'VALUES (?, ?, ?, ?, ?, ?)',
+                     (tile.zoom, tile.x, self.row(tile), sqlite3.Binary(data), mtime, now))
+        if data[:4] == b'\x89PNG':
+            fmt = 'png'
+        else:
+            fmt = 'jpg'
+        conn.execute("INSERT OR IGNORE INTO metadata (name, value) VALUES ('format', ?)", (fmt,))
+        if self.max_size <= 0:
+            return
+        check_size = self.max_size * (1.0 - EVICT_TARGET)
+        with self.lock:
+            # check on the first put, the store may already be over the cap
+            added = self.added.get(tile.service, check_size) + len(data)
+            if added >= check_size:
+                added = 0
+            self.added[tile.service] = added
+        if added == 0:
+            self.evict(tile.service)
+
+    def touch(self, tile):
+        '''mark a stored tile as up to date'''
+        now = time.time()
+        self.connection(tile.service).execute(
+            'UPDATE tiles SET mtime=?, atime=? WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+            (now, now, tile.zoom, tile.x, self.row(tile)))
+
+    def size(self, service):
+        '''return the total size of the tile data for a service'''
+        r = self.connection(service).execute('SELECT SUM(LENGTH(tile_data)) FROM tiles').fetchone()
+        return r[0] or 0
+
+    def evict(self, service):
+        '''remove the least recently used tiles of a service until it is
+        under the size cap'''
+        conn = self.connection(service)
+        excess = self.size(service) - self.max_size
+        if excess <= 0:
+            return
+        excess += self.max_size * (1.0 - EVICT_TARGET)
+        removed = 0
+        rowids = []
+        for (rowid, length) in conn.execute('SELECT rowid, LENGTH(tile_data) FROM tiles ORDER BY atime'):
+            if removed >= excess:
+                break
+            rowids.append((rowid,))
+            removed += length
+        conn.execute('BEGIN')
+        conn.executemany('DELETE FROM tiles WHERE rowid=?', rowids)
+        conn.execute('COMMIT')
+
+    def close(self):
+        '''close this thread's connections'''
+        conns = getattr(self.local, 'connections', {})
+        for conn in conns.values():
+            conn.close()
+        self.local.connections = {}
+
+
+def open_store(store_type, cache_path, max_size=0):
+    '''return a tile store of the given type'''
+    if store_type == 'sqlite':
+        return SQLiteTileStore(cache_path, max_size=max_size)
+    if store_type == 'file':
+        return FileTileStore(cache_path)
+    raise ValueError('unknown tile store %s' % store_type)
@@ -2,11 +2,12 @@
 send NTRIP data to flight controller
 """
 
-import random
 import time
 
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import ntrip
+from MAVProxy.modules.lib import rtcm3
+from MAVProxy.modules.lib import rtcm_inject
 from MAVProxy.modules.lib import mp_settings
 
 
@@ -22,6 +23,7 @@ class NtripModule(mp_module.MPModule):
              ('mountpoint', str, None),
              ('logfile', str, None),
              ('sendalllinks', bool, False),
+             ('links', str, None),
              ('frag_drop_pct', float, 0),
              ('sendmul', int, 1),
              ('sendgga', bool, True)])
@@ -64,10 +66,11 @@ class NtripModule(mp_module.MPModule):
         '''called on idle'''
         if self.start_pending and self.ntrip is None and self.pos is not None:
             self.cmd_start()
+        rtcm_inject.injector(self.mpstate).update()
         if self.ntrip is None:
             return
-        data = self.ntrip.read()
-        if data is None:
+        frames = self.ntrip.read_frames()
+        if len(frames) == 0:
             now = time.time()
             if (self.last_pkt is not None and
                 now - self.last_pkt > 15 and
@@ -80,47 +83,43 @@ class NtripModule(mp_module.MPModule):
         if time.time() - self.ntrip.dt_last_gga_sent > 2:
             self.ntrip.setPosition(self.pos[0], self.pos[1])
             self.ntrip.send_gga()
-        self.log_rtcm(data)
-
-        rtcm_id = self.ntrip.get_ID()
-        if not rtcm_id in self.id_counts:
-            self.id_counts[rtcm_id] = 0
-            self.last_by_id[rtcm_id] = data[:]
-        self.id_counts[rtcm_id] += 1
-
-        blen = len(data)
-        if blen > 4*180:
-            # can't send this with GPS_RTCM_DATA
-            return
-        total_len = blen
-        self.rate_total += blen * self.ntrip_settings.sendmul
-
-        if blen > 180:
-            flags = 1 # fragmented
-        else:
-            flags = 0
-        # add in the sequence number
-        flags |= (self.pkt_count & 0x1F) << 3
-
-        fragment = 0
-        while blen > 0:
-            send_data = bytearray(data[:180])
-            frag_len = len(send_data)
-            data = data[frag_len:]
-            if frag_len < 180:
-                send_data.extend(bytearray([0]*(180-frag_len)))
-            if self.ntrip_settings.sendalllinks:
-                links = self.mpstate.mav_master
-            else:
-                links = [self.master]
-            for link in links:
-                for d in range(self.ntrip_settings.sendmul):
-                    if random.random() * 100 < self.ntrip_settings.frag_drop_pct:
-                        continue
-                    link.mav.gps_rtcm_data_send(flags | (fragment<<1), frag_len, send_data)
-            fragment += 1
-            blen -= frag_len
-        self.pkt_count += 1
+        self.send_rtcm(frames)
+
+    def inject_links(self):
+        '''get the links to send corrections on'''
+        if self.ntrip_settings.links:
+            links = []
+            for s in self.ntrip_settings.links.split(','):
+                try:
+                    i = int(s)
+                except ValueError:
+                    continue
+                if i >= 0 and i < len(self.mpstate.mav_master):
+                    links.append(self.mpstate.mav_master[i])
+            if len(links) > 0:
+                return links
+        if self.ntrip_settings.sendalllinks:
+            return self.mpstate.mav_master
+        return [self.master]
+
+    def send_rtcm(self, frames):
+        '''send the RTCM3 frames from one read to the vehicle'''
+        for data in frames:
+            self.log_rtcm(data)
+            rtcm_id = rtcm3.packet_ID(data)
+            if not rtcm_id in self.id_counts:
+                self.id_counts[rtcm_id] = 0
+                self.last_by_id[rtcm_id] = data[:]
+            self.id_counts[rtcm_id] += 1
+            self.rate_total += len(data) * self.ntrip_settings.sendmul
+            self.pkt_count += 1
+
+        # frames read together are normally one epoch, and are packed
+        # together into as few GPS_RTCM_DATA messages as possible
+        rtcm_inject.injector(self.mpstate).inject(frames,
+                                                  links=self.inject_links(),
+                                                  sendmul=self.ntrip_settings.sendmul,
+                                                  drop_pct=self.ntrip_settings.frag_drop_pct)
 
         now = time.time()
         if now - self.last_rate > 1:
@@ -160,6 +159,7 @@ class NtripModule(mp_module.MPModule):
             print(" %4u: %u (len %u)" % (id, self.id_counts[id], len(self.last_by_id[id])))
             frame_size += len(self.last_by_id[id])
         print("ntrip: %u packets, %.1f bytes/sec last %.1fs ago framesize %u" % (self.pkt_count, self.rate, now - self.last_pkt, frame_size))
+        print(rtcm_inject.injector(self.mpstate).status_string())
 
     def cmd_start(self):
         '''start ntrip link'''
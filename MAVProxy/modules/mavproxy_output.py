@@ -2,6 +2,8 @@
 '''enable run-time addition and removal of UDP clients , just like --out on the cnd line'''
 ''' TO USE:
     output add 10.11.12.13:14550
+    output add 10.11.12.13:14551 rate=ATTITUDE:5,GPS_RAW_INT:1 deny=RAW_IMU decimate=2
+    output policy 1 allow=HEARTBEAT,GLOBAL_POSITION_INT,SYS_STATUS
     output list
     output remove 3      # to remove 3rd output
 '''
@@ -11,20 +13,21 @@ from pymavlink import mavutil
 
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib.output_policy import OutputPolicy
 
 class OutputModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(OutputModule, self).__init__(mpstate, "output", "output control", public=True)
         self.add_command('output', self.cmd_output, "output control",
-                         ["<list|add|remove|sysid>"])
+                         ["<list|add|remove|sysid|policy>"])
 
     def cmd_output(self, args):
         '''handle output commands'''
         if len(args) < 1 or args[0] == "list":
             self.cmd_output_list()
         elif args[0] == "add":
-            if len(args) != 2:
-                print("Usage: output add OUTPUT")
+            if len(args) < 2:
+                print("Usage: output add OUTPUT [rate=TYPE:HZ,...] [allow=TYPE,...] [deny=TYPE,...] [decimate=N]")
                 return
             self.cmd_output_add(args[1:])
         elif args[0] == "remove":
@@ -37,24 +40,35 @@ class OutputModule(mp_module.MPModule):
                 print("Usage: output sysid SYSID OUTPUT")
                 return
             self.cmd_output_sysid(args[1:])
+        elif args[0] == "policy":
+            if len(args) < 2:
+                print("Usage: output policy OUTPUT [rate=TYPE:HZ,...] [allow=TYPE,...] [deny=TYPE,...] [decimate=N]")
+                return
+            self.cmd_output_policy(args[1:])
         else:
-            print("usage: output <list|add|remove|sysid>")
+            print("usage: output <list|add|remove|sysid|policy>")
 
     def cmd_output_list(self):
         '''list outputs'''
         print("%u outputs" % len(self.mpstate.mav_outputs))
         for i in range(len(self.mpstate.mav_outputs)):
             conn = self.mpstate.mav_outputs[i]
-            print("%u: %s" % (i, conn.address))
+            print("%u: %s %s" % (i, conn.address, self.mpstate.output_batch.stats_string(conn)))
+            policy = getattr(conn, 'out_policy', None)
+            if policy is not None:
+                print("   %s" % policy)
         if len(self.mpstate.sysid_outputs) > 0:
             print("%u sysid outputs" % len(self.mpstate.sysid_outputs))
             for sysid in self.mpstate.sysid_outputs:
                 conn = self.mpstate.sysid_outputs[sysid]
-                print("%u: %s" % (sysid, conn.address))
+                print("%u: %s %s" % (sysid, conn.address, self.mpstate.output_batch.stats_string(conn)))
 
     def cmd_output_add(self, args):
         '''add new output'''
         device = args[0]
+        policy = self.parse_policy(args[1:])
+        if policy is False:
+            return
         print("Adding output %s" % device)
         try:
             conn = mavutil.mavlink_connection(device, input=False, source_system=self.settings.source_system, autoreconnect=True)
@@ -62,7 +76,9 @@ class OutputModule(mp_module.MPModule):
         except Exception:
             print("Failed to connect to %s" % device)
             return
+        conn.out_policy = policy
         self.mpstate.mav_outputs.append(conn)
+        self.mpstate.fd_registry.invalidate()
         try:
             mp_util.child_fd_list_add(conn.port.fileno())
         except Exception:
@@ -84,8 +100,42 @@ class OutputModule(mp_module.MPModule):
         except Exception:
             pass
         if sysid in self.mpstate.sysid_outputs:
+            self.mpstate.output_batch.discard(self.mpstate.sysid_outputs[sysid])
             self.mpstate.sysid_outputs[sysid].close()
         self.mpstate.sysid_outputs[sysid] = conn
+        self.mpstate.fd_registry.invalidate()
+
+    def parse_policy(self, args):
+        '''parse output policy arguments, returning None for no policy
+        and False on error'''
+        if len(args) == 0:
+            return None
+        policy = OutputPolicy()
+        try:
+            policy.parse(args)
+        except ValueError as e:
+            print("Bad output policy: %s" % e)
+            return False
+        if policy.is_default():
+            return None
+        return policy
+
+    def cmd_output_policy(self, args):
+        '''set or clear the forwarding policy on an output'''
+        device = args[0]
+        policy = self.parse_policy(args[1:])
+        if policy is False:
+            return
+        for i in range(len(self.mpstate.mav_outputs)):
+            conn = self.mpstate.mav_outputs[i]
+            if str(i) == device or conn.address == device:
+                conn.out_policy = policy
+                if policy is None:
+                    print("Cleared policy on output %s" % conn.address)
+                else:
+                    print("Set policy on output %s: %s" % (conn.address, policy))
+                return
+        print("Output %s not found" % device)
 
     def cmd_output_remove(self, args):
         '''remove an output'''
@@ -98,8 +148,10 @@ class OutputModule(mp_module.MPModule):
                     mp_util.child_fd_list_add(conn.port.fileno())
                 except Exception:
                     pass
+                self.mpstate.output_batch.discard(conn)
                 conn.close()
                 self.mpstate.mav_outputs.pop(i)
+                self.mpstate.fd_registry.invalidate()
                 return
 
     def idle_task(self):
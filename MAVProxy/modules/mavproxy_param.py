@@ -15,6 +15,7 @@ from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import param_help
 from MAVProxy.modules.lib import param_ftp
+from MAVProxy.modules.lib import param_cache
 
 if mp_util.has_wxpython:
     from MAVProxy.modules.lib.mp_menu import MPMenuItem
@@ -35,6 +36,29 @@ except ImportError:
     import Queue
     from Queue import Empty
 
+# parameters with defaults, as fetched with MAVLink FTP
+PARAM_FTP_FILE = "@PARAM/param.pck?withdefaults=1"
+
+# limits of the number of parameter requests in flight
+MIN_PARAM_WINDOW = 1
+MAX_PARAM_WINDOW = 64
+# bounds on the parameter request timeout
+MIN_PARAM_RTO = 0.1
+MAX_PARAM_RTO = 3.0
+# use FTP for param load when at least this many parameters change
+PARAM_FTP_LOAD_MIN = 20
+# shrink the window when more than this fraction of requests in a round
+# trip are lost, as radio links lose some packets even when not congested
+PARAM_LOSS_THRESHOLD = 0.5
+# attempts for each parameter of a bulk set, which can afford more
+# attempts than a single set as the timeout adapts to the link
+PARAM_BATCH_ATTEMPTS = 5
+# seconds without a PARAM_VALUE before the stream from a fetch of all
+# parameters is taken to have ended
+PARAM_FETCH_GAP = 1.0
+# rate of the check for missing parameters when not recovering them
+PARAM_CHECK_RATE = 1.0
+
 
 class ParamState:
     '''this class is separated to make it possible to use the parameter
@@ -62,6 +86,32 @@ class ParamState:
         self.param_help.vehicle_name = vehicle_name
         self.default_params = None
         self.watch_patterns = set()
+        self.autopilot_version = None
+        self.cache = param_cache.ParamCache()
+        self.cache_state = None
+        self.cache_time = None
+        self.cache_entry = None
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.fetch_start = None
+        self.ready_time = None
+        self.ready_source = None
+
+        # adaptive window and timeout for parameter requests
+        self.param_window = 10.0
+        self.param_ssthresh = MAX_PARAM_WINDOW
+        self.param_srtt = None
+        self.param_rttvar = 0
+        self.param_min_rtt = None
+        self.param_acks = 0
+        self.param_losses = 0
+        self.param_round_start = time.time()
+        # statistics for the current and last batch of parameter sets
+        self.set_batch = None
+        self.last_set_batch = None
+        # parameters sent with FTP, to be confirmed by reading them back
+        self.ftp_verify = None
+        self.ftp_upload_start = None
 
         # dictionary of ParamSet objects we are processing:
         self.parameters_to_set = {}
@@ -84,6 +134,9 @@ class ParamState:
                 self.attempts_remaining = 3
 
             self.request_sent = 0  # this is a timestamp
+            self.sends = 0
+            # send time of a request already counted as lost
+            self.lost_sent = 0
 
         def normalize_parameter_for_param_set_send(self, name, value, param_type):
             '''uses param_type to convert value into a value suitable for passing
@@ -135,16 +188,21 @@ class ParamState:
             )
             self.request_sent = time.time()
             self.attempts_remaining -= 1
+            self.sends += 1
 
-        def expired(self):
+        def expired(self, timeout=None):
             if self.attempts_remaining > 0:
                 return False
-            return time.time() - self.request_sent > self.retry_interval
+            if timeout is None:
+                timeout = self.retry_interval
+            return time.time() - self.request_sent > timeout
 
-        def due_for_retry(self):
+        def due_for_retry(self, timeout=None):
             if self.attempts_remaining <= 0:
                 return False
-            return time.time() - self.request_sent > self.retry_interval
+            if timeout is None:
+                timeout = self.retry_interval
+            return time.time() - self.request_sent > timeout
 
         def handle_PARAM_VALUE(self, m, value):
             '''handle PARAM_VALUE packet m which has already been checked for a
@@ -172,31 +230,120 @@ class ParamState:
         try:
             while True:
                 new_parameter_to_set = self.parameters_to_set_input_queue.get(block=False)
+                if new_parameter_to_set.name not in self.parameters_to_set:
+                    # a second set of a pending name replaces the first
+                    self.set_batch_add()
                 self.parameters_to_set[new_parameter_to_set.name] = new_parameter_to_set
         except Empty:
             pass
 
+        if len(self.parameters_to_set) == 0:
+            return
+
         # now send any parameter-sets which are due to be sent out,
-        # either because they are new or because we need to retry:
-        count = 0
+        # either because they are new or because we need to retry,
+        # keeping no more than the window in flight:
+        now = time.time()
+        rto = self.param_rto()
+        in_flight = 0
+        due = []
         keys_to_remove = []  # remove entries after iterating the dict
         for (key, parameter_to_set) in self.parameters_to_set.items():
-            if parameter_to_set.expired():
+            sent = parameter_to_set.request_sent
+            if sent != 0 and now - sent <= rto:
+                in_flight += 1
+                continue
+            if sent != 0 and parameter_to_set.lost_sent != sent:
+                parameter_to_set.lost_sent = sent
+                self.param_losses += 1
+            if parameter_to_set.expired(rto):
                 parameter_to_set.print_expired_message()
                 keys_to_remove.append(key)
                 continue
-            if not parameter_to_set.due_for_retry():
-                continue
-            # send parameter set:
-            parameter_to_set.send_set()
-            # rate-limit to 10 items per call:
-            count += 1
-            if count > 10:
+            if parameter_to_set.due_for_retry(rto):
+                due.append(parameter_to_set)
+
+        self.param_window_update()
+        window = max(int(self.param_window), MIN_PARAM_WINDOW)
+        for parameter_to_set in due:
+            if in_flight >= window:
                 break
+            if parameter_to_set.sends > 0 and self.set_batch is not None:
+                self.set_batch['retries'] += 1
+            parameter_to_set.send_set()
+            in_flight += 1
 
         # complete purging of expired parameter-sets:
         for key in keys_to_remove:
             del self.parameters_to_set[key]
+            self.set_batch_done(False)
+
+    def param_rto(self):
+        '''timeout for parameter requests, from the PARAM_VALUE round trip time'''
+        if self.param_srtt is None:
+            return 1.0
+        rto = self.param_srtt + 4 * self.param_rttvar
+        return min(max(rto, MIN_PARAM_RTO), MAX_PARAM_RTO)
+
+    def param_request_acked(self, rtt):
+        '''update the window and timeout for a parameter request which got a
+        reply, rtt is None if the request had been resent'''
+        if rtt is not None:
+            if self.param_srtt is None:
+                self.param_srtt = rtt
+                self.param_rttvar = rtt / 2
+            else:
+                self.param_rttvar = 0.75 * self.param_rttvar + 0.25 * abs(self.param_srtt - rtt)
+                self.param_srtt = 0.875 * self.param_srtt + 0.125 * rtt
+            if self.param_min_rtt is None or rtt < self.param_min_rtt:
+                self.param_min_rtt = rtt
+        self.param_acks += 1
+        if self.param_window < self.param_ssthresh:
+            self.param_window += 1
+        else:
+            self.param_window += 1.0 / self.param_window
+        self.param_window = min(self.param_window, MAX_PARAM_WINDOW)
+
+    def param_window_update(self):
+        '''once per round trip, shrink the window if many requests were lost
+        or replies are queueing up behind each other'''
+        now = time.time()
+        if now - self.param_round_start < max(self.param_srtt or 1.0, MIN_PARAM_RTO):
+            return
+        total = self.param_acks + self.param_losses
+        if total > 0 and self.param_losses > PARAM_LOSS_THRESHOLD * total:
+            self.param_ssthresh = max(self.param_window / 2, MIN_PARAM_WINDOW)
+            self.param_window = self.param_ssthresh
+        elif self.param_min_rtt is not None and self.param_srtt > 3 * max(self.param_min_rtt, 0.01):
+            self.param_ssthresh = max(self.param_window * 0.75, MIN_PARAM_WINDOW)
+            self.param_window = self.param_ssthresh
+        self.param_acks = 0
+        self.param_losses = 0
+        self.param_round_start = now
+
+    def set_batch_add(self):
+        '''count a parameter set, starting a new batch if idle'''
+        if self.set_batch is None:
+            self.set_batch = {'start': time.time(), 'total': 0, 'done': 0, 'failed': 0, 'retries': 0}
+        self.set_batch['total'] += 1
+
+    def set_batch_done(self, success):
+        '''count a completed parameter set, reporting when a batch finishes'''
+        b = self.set_batch
+        if b is None:
+            return
+        if success:
+            b['done'] += 1
+        else:
+            b['failed'] += 1
+        if b['done'] + b['failed'] < b['total'] or len(self.parameters_to_set) != 0:
+            return
+        dt = max(time.time() - b['start'], 0.001)
+        self.last_set_batch = ("set %u/%u params in %.1fs (%.1f/s) %u retries %u failed" %
+                               (b['done'], b['total'], dt, b['done'] / dt, b['retries'], b['failed']))
+        if b['total'] > 1:
+            print("Parameters: " + self.last_set_batch)
+        self.set_batch = None
 
     def use_ftp(self):
         '''return true if we should try ftp for download'''
@@ -251,8 +398,9 @@ class ParamState:
             # Note: the xml specifies param_index is a uint16, so -1 in that field will show as 65535
             # We accept both -1 and 65535 as 'unknown index' to future proof us against someday having that
             # xml fixed.
-            if self.fetch_set is not None:
+            if self.fetch_set is not None and m.param_index in self.fetch_set:
                 self.fetch_set.discard(m.param_index)
+                self.param_request_acked(None)
             if m.param_index != -1 and m.param_index != 65535 and m.param_index not in self.mav_param_set:
                 added_new_parameter = True
                 self.mav_param_set.add(m.param_index)
@@ -272,15 +420,23 @@ class ParamState:
                 if self.logdir is not None:
                     self.mav_param.save(os.path.join(self.logdir, self.parm_file), '*', verbose=True)
                 self.fetch_set = None
+                self.params_ready('mavlink')
+                self.cache_save(m.param_count)
             if self.fetch_set is not None and len(self.fetch_set) == 0:
                 self.fetch_check(master, force=True)
 
             # if we were setting this parameter then check it's the
             # value we want and, if so, stop setting the parameter
             try:
-                if self.parameters_to_set[param_id].handle_PARAM_VALUE(m, value):
+                parameter_to_set = self.parameters_to_set[param_id]
+                if parameter_to_set.handle_PARAM_VALUE(m, value):
                     # print(f"removing set of param_id ({self.parameters_to_set[param_id].value} vs {value})")
                     del self.parameters_to_set[param_id]
+                    rtt = None
+                    if parameter_to_set.sends == 1:
+                        rtt = time.time() - parameter_to_set.request_sent
+                    self.param_request_acked(rtt)
+                    self.set_batch_done(True)
             except KeyError:
                 pass
 
@@ -289,21 +445,49 @@ class ParamState:
                 # remember autopilot types so we can handle PX4 parameters
                 self.autopilot_type_by_sysid[m.get_srcSystem()] = m.autopilot
 
+        elif m.get_type() == 'AUTOPILOT_VERSION':
+            # identifies the board for the parameter cache
+            self.autopilot_version = m
+
     def fetch_check(self, master, force=False):
         '''check for missing parameters periodically'''
-        if self.param_period.trigger() or force:
+        # check every call while validating the cache, so that a cache
+        # hit is not delayed by the 1Hz check
+        if self.param_period.trigger() or force or self.cache_state in ['identify', 'crc']:
             if master is None:
                 return
+            self.param_period.frequency = PARAM_CHECK_RATE
             if len(self.mav_param_set) == 0 and not self.ftp_started:
+                if self.fetch_start is None:
+                    self.fetch_start = time.time()
+                if not self.cache_check(master):
+                    return
+                if len(self.mav_param_set) != 0:
+                    # loaded from the cache
+                    return
                 if not self.use_ftp():
                     master.param_fetch_all()
                 else:
                     self.ftp_start()
             elif not self.ftp_started and self.mav_param_count != 0 and len(self.mav_param_set) != self.mav_param_count:
-                if master.time_since('PARAM_VALUE') >= 1 or force:
+                if self.fetch_set is None:
+                    # the stream from a fetch of all parameters may still
+                    # be arriving
+                    timeout = PARAM_FETCH_GAP
+                else:
+                    # recover missing parameters as fast as the link allows
+                    timeout = self.param_rto()
+                    self.param_period.frequency = min(max(1.0 / timeout, PARAM_CHECK_RATE), 10)
+                if master.time_since('PARAM_VALUE') >= timeout or force:
+                    if self.fetch_set is not None:
+                        # requests from last time which were not answered
+                        self.param_losses += len(self.fetch_set)
+                    self.fetch_set = None
+                    self.param_window_update()
                     diff = set(range(self.mav_param_count)).difference(self.mav_param_set)
                     count = 0
-                    while len(diff) > 0 and count < 10:
+                    window = max(int(self.param_window), MIN_PARAM_WINDOW)
+                    while len(diff) > 0 and count < window:
                         idx = diff.pop()
                         master.param_fetch_one(idx)
                         if self.fetch_set is None:
@@ -320,6 +504,125 @@ class ParamState:
     def status(self, master, mpstate):
         return (len(self.mav_param_set), self.mav_param_count)
 
+    def cache_check(self, master):
+        '''validate the parameter cache against the vehicle before the first
+        fetch. Returns False while validation is in progress'''
+        if self.cache_state == 'done':
+            return True
+        if not self.mpstate.settings.param_cache:
+            self.cache_state = 'done'
+            return True
+        now = time.time()
+        if self.cache_state is None:
+            # ask for the board identity
+            self.cache_state = 'identify'
+            self.cache_time = now
+            master.mav.command_long_send(
+                self.sysid[0],
+                self.sysid[1],
+                mavutil.mavlink.MAV_CMD_REQUEST_MESSAGE,
+                0,
+                mavutil.mavlink.MAVLINK_MSG_ID_AUTOPILOT_VERSION, 0, 0, 0, 0, 0, 0)
+            return False
+        if self.cache_state == 'identify':
+            if self.autopilot_version is None and now - self.cache_time < 1.5:
+                return False
+            key = param_cache.vehicle_key(self.sysid, self.autopilot_version)
+            self.cache_entry = self.cache.load(key)
+            ftp = self.mpstate.module('ftp')
+            if (self.cache_entry is None or self.cache_entry.get('crc', None) is None or
+                    not self.use_ftp() or ftp is None or not ftp.is_idle()):
+                # can't be validated, so fetch everything
+                self.cache_miss()
+                return True
+            self.cache_state = 'crc'
+            self.cache_time = now
+            ftp.cmd_crc([PARAM_FTP_FILE], callback=self.cache_crc_callback)
+            return False
+        if self.cache_state == 'crc' and now - self.cache_time > 3:
+            # no CRC reply
+            ftp = self.mpstate.module('ftp')
+            if ftp is not None and ftp.crc_callback == self.cache_crc_callback:
+                ftp.crc_cancel()
+            self.cache_miss()
+            return True
+        return self.cache_state == 'done'
+
+    def cache_crc_callback(self, crc):
+        '''callback with the CRC of the vehicle parameters'''
+        if self.cache_state != 'crc':
+            return
+        if crc is None or crc != self.cache_entry['crc']:
+            self.cache_miss()
+        else:
+            self.cache_hit()
+        self.fetch_check(self.mpstate.master(), force=True)
+
+    def cache_miss(self):
+        '''parameters could not be taken from the cache'''
+        self.cache_state = 'done'
+        self.cache_entry = None
+        self.cache_misses += 1
+
+    def cache_hit(self):
+        '''load validated parameters from the cache'''
+        entry = self.cache_entry
+        self.cache_state = 'done'
+        self.cache_entry = None
+        self.cache_hits += 1
+        self.param_types = {}
+        self.fetch_one = dict()
+        self.fetch_set = None
+        self.mav_param.clear()
+        params = []
+        for (name, v) in entry['params'].items():
+            self.param_types[name] = mavutil.mavlink.MAV_PARAM_TYPE_REAL32
+            self.mav_param[name] = v
+            params.append((name.encode('utf-8'), v, None))
+        self.mav_param_count = len(params)
+        self.mav_param_set = set(range(self.mav_param_count))
+        if entry.get('defaults', None) is not None:
+            self.default_params = mavparm.MAVParmDict()
+            for (name, v) in entry['defaults'].items():
+                self.default_params[name] = v
+        self.mpstate.console.set_status('Params', 'Param %u/%u' % (self.mav_param_count, self.mav_param_count))
+        print("Loaded %u parameters from cache" % self.mav_param_count)
+        if self.logdir is not None:
+            self.mav_param.save(os.path.join(self.logdir, self.parm_file), '*', verbose=True)
+        self.log_params(params)
+        self.params_ready('cache')
+
+    def cache_save(self, count, crc=None):
+        '''save the current parameters to the cache'''
+        if not self.mpstate.settings.param_cache:
+            return
+        params = {}
+        for name in self.mav_param.keys():
+            params[str(name)] = self.mav_param[name]
+        defaults = None
+        if crc is not None and self.default_params is not None:
+            defaults = {}
+            for name in self.default_params.keys():
+                defaults[str(name)] = self.default_params[name]
+        key = param_cache.vehicle_key(self.sysid, self.autopilot_version)
+        self.cache.save(key, params, count, crc=crc, defaults=defaults)
+
+    def params_ready(self, source):
+        '''record how long it took to get the full parameter set'''
+        if self.ready_time is None and self.fetch_start is not None:
+            self.ready_time = time.time() - self.fetch_start
+            self.ready_source = source
+
+    def status_string(self):
+        '''return a parameter status summary'''
+        s = "Have %u/%u params" % (len(self.mav_param_set), self.mav_param_count)
+        if self.ready_time is not None:
+            s += ", ready in %.1fs from %s" % (self.ready_time, self.ready_source)
+        lookups = self.cache_hits + self.cache_misses
+        if lookups > 0:
+            s += ", cache %u/%u hits (%.0f%%)" % (self.cache_hits, lookups, 100.0 * self.cache_hits / lookups)
+        return s
+
     def ftp_start(self):
         '''start a ftp download of parameters'''
         ftp = self.mpstate.module('ftp')
@@ -330,7 +633,7 @@ class ParamState:
         self.ftp_started = True
         self.ftp_count = None
         ftp.cmd_get([
-            "@PARAM/param.pck?withdefaults=1",
+            PARAM_FTP_FILE,
         ],
             callback=self.ftp_callback,
             callback_progress=self.ftp_callback_progress,
@@ -358,7 +661,7 @@ class ParamState:
             mav.srcComponent = mavutil.mavlink.MAV_COMP_ID_MISSIONPLANNER
             try:
                 buf = p.pack(mav)
-                self.mpstate.logqueue.put(bytearray(struct.pack('>Q', usec) + buf))
+                self.mpstate.logqueue.put_msg(usec, buf)
                 # also give to param editor so it can update for changes
                 if editor:
                     editor.mavlink_packet(p)
@@ -433,6 +736,9 @@ class ParamState:
                 self.default_params.save(defaults_path, '*', verbose=False)
                 print("Saved %u defaults to %s" % (len(pdata.defaults), defaults_path))
 
+        self.params_ready('ftp')
+        self.cache_save(total_params, crc=param_cache.ftp_crc32(data))
+
     def fetch_all(self, master):
         '''force refetch of parameters'''
         if not self.use_ftp():
@@ -775,7 +1081,7 @@ class ParamState:
                 param_wildcard = args[2]
             else:
                 param_wildcard = "*"
-            self.mav_param.load(args[1].strip('"'), param_wildcard, master)
+            self.param_load(args[1].strip('"'), param_wildcard, master)
         elif args[0] == "preload":
             if len(args) < 2:
                 print("Usage: param preload <filename>")
@@ -789,7 +1095,7 @@ class ParamState:
                 param_wildcard = args[2]
             else:
                 param_wildcard = "*"
-            self.mav_param.load(args[1].strip('"'), param_wildcard, master, check=False)
+            self.param_load(args[1].strip('"'), param_wildcard, master, check=False)
         elif args[0] == "ftpload":
             if len(args) < 2:
                 print("Usage: param ftpload <filename> [wildcard]")
@@ -822,7 +1128,14 @@ class ParamState:
                 pattern = "*"
             self.param_show(pattern, verbose)
         elif args[0] == "status":
-            print("Have %u/%u params" % (len(self.mav_param_set), self.mav_param_count))
+            print(self.status_string())
+            print("window %.1f rtt %.3fs timeout %.2fs" % (
+                self.param_window, self.param_srtt or 0, self.param_rto()))
+            if self.set_batch is not None:
+                b = self.set_batch
+                print("setting %u/%u params %u retries" % (b['done'], b['total'], b['retries']))
+            if self.last_set_batch is not None:
+                print("last batch: " + self.last_set_batch)
         else:
             print(usage)
 
@@ -842,15 +1155,54 @@ class ParamState:
 
     def ftp_upload_callback(self, dlen):
         '''callback on ftp put completion'''
+        verify = self.ftp_verify
+        self.ftp_verify = None
         if dlen is None:
             print("Failed to send parameters")
-        else:
-            if self.ftp_send_param is not None:
-                for k in mp_util.sorted_natural(self.ftp_send_param.keys()):
-                    v = self.ftp_send_param.get(k)
-                    self.mav_param[k] = v
+            if verify is not None:
+                # fall back to setting them one at a time
                 self.ftp_send_param = None
-            print("Parameter upload done")
+                self.set_parameters(verify)
+            return
+        dt = time.time() - self.ftp_upload_start
+        if verify is not None:
+            # read all parameters back to confirm the upload
+            print("Parameter upload done in %.1fs, verifying" % dt)
+            self.ftp_send_param = None
+            ftp = self.mpstate.module('ftp')
+            ftp.cmd_get([PARAM_FTP_FILE],
+                        callback=lambda fh: self.ftp_verify_callback(fh, verify),
+                        callback_progress=self.ftp_callback_progress)
+            return
+        if self.ftp_send_param is not None:
+            for k in mp_util.sorted_natural(self.ftp_send_param.keys()):
+                v = self.ftp_send_param.get(k)
+                self.mav_param[k] = v
+            self.ftp_send_param = None
+        print("Parameter upload done in %.1fs" % dt)
+
+    def ftp_verify_callback(self, fh, sent):
+        '''check parameters read back after an ftp upload'''
+        if fh is None:
+            print("Failed to read back parameters")
+            self.set_parameters(sent)
+            return
+        self.ftp_callback(fh)
+        failed = mavparm.MAVParmDict()
+        for k in sent.keys():
+            v = self.mav_param.get(k, None)
+            if v is None or abs(v - sent.get(k)) > max(sent.mindelta, 1.0e-7 * abs(v)):
+                failed[k] = sent.get(k)
+        dt = time.time() - self.ftp_upload_start
+        print("Verified %u/%u parameters in %.1fs" % (len(sent.keys()) - len(failed.keys()), len(sent.keys()), dt))
+        if len(failed.keys()) > 0:
+            self.set_parameters(failed)
+
+    def set_parameters(self, params):
+        '''queue a MAVParmDict of parameters to be set'''
+        master = self.mpstate.master()
+        for k in mp_util.sorted_natural(params.keys()):
+            self.set_parameter(master, k, params.get(k), attempts=PARAM_BATCH_ATTEMPTS)
 
     def ftp_upload_progress(self, proportion):
         '''callback from ftp put of parameters'''
@@ -878,6 +1230,36 @@ class ParamState:
                 return i
         return c
 
+    def param_load(self, filename, param_wildcard, master, check=True):
+        '''load parameters from a file, sending those which change. Large
+        changes go by FTP when available, otherwise through the parameter
+        set queue'''
+        newparm = mavparm.MAVParmDict()
+        if not newparm.load(filename, param_wildcard, check=False):
+            return
+        changes = mavparm.MAVParmDict()
+        for k in mp_util.sorted_natural(newparm.keys()):
+            v = newparm.get(k)
+            if check:
+                if k not in self.mav_param:
+                    print("Unknown parameter %s" % k)
+                    continue
+                oldv = self.mav_param.get(k)
+                if abs(oldv - v) <= newparm.mindelta:
+                    continue
+            changes[k] = v
+        if len(changes.keys()) == 0:
+            print("No parameter changes")
+            return
+        print("Changing %u parameters" % len(changes.keys()))
+        ftp = self.mpstate.module('ftp')
+        if (check and self.use_ftp() and ftp is not None and ftp.is_idle() and
+                len(changes.keys()) >= PARAM_FTP_LOAD_MIN):
+            self.ftp_upload(changes, verify=True)
+            return
+        for k in mp_util.sorted_natural(changes.keys()):
+            self.set_parameter(master, k, changes.get(k), attempts=PARAM_BATCH_ATTEMPTS)
+
     def ftp_load(self, filename, param_wildcard, master):
         '''load parameters with ftp'''
         ftp = self.mpstate.module('ftp')
@@ -886,7 +1268,6 @@ class ParamState:
             return
         newparm = mavparm.MAVParmDict()
         newparm.load(filename, param_wildcard, check=False)
-        fh = SIO()
         for k in mp_util.sorted_natural(newparm.keys()):
             v = newparm.get(k)
             oldv = self.mav_param.get(k, None)
@@ -897,7 +1278,14 @@ class ParamState:
         if count == 0:
             print("No parameter changes")
             return
+        self.ftp_upload(newparm)
 
+    def ftp_upload(self, newparm, verify=False):
+        '''send parameters with ftp. If verify is set they are read back
+        afterwards, and any which did not take are sent with PARAM_SET'''
+        ftp = self.mpstate.module('ftp')
+        count = len(newparm.keys())
+        fh = SIO()
         fh.write(struct.pack("<HHH", 0x671b, count, count))
         last_param = ""
         for k in mp_util.sorted_natural(newparm.keys()):
@@ -924,6 +1312,9 @@ class ParamState:
         fh.write(struct.pack("<HHH", 0x671b, count, file_len))
         fh.seek(0)
         self.ftp_send_param = newparm
+        self.ftp_upload_start = time.time()
+        if verify:
+            self.ftp_verify = newparm
         print("Sending %u params" % count)
         ftp.cmd_put(["-", "@PARAM/param.pck"],
                     fh=fh, callback=self.ftp_upload_callback, progress_callback=self.ftp_upload_progress)
@@ -2,6 +2,7 @@
   MAVProxy terrain handling module
 """
 
+import math
 import time
 
 from MAVProxy.modules.lib import mp_elevation
@@ -26,10 +27,13 @@ class TerrainModule(mp_module.MPModule):
         self.terrain_settings = mp_settings.MPSettings([('debug', int, 0),
                                                         ('enable', int, 1),
                                                         ('offline', int, 0),
+                                                        ('cache_mb', int, 256),
                                                         mp_settings.MPSetting('source', str, "SRTM3", choice=mp_elevation.TERRAIN_SERVICES.keys())])
         self.add_completion_function('(TERRAINSETTING)', self.terrain_settings.completion)
 
-        self.ElevationModel = mp_elevation.ElevationModel(database=self.terrain_settings.source, offline=self.terrain_settings.offline)
+        self.ElevationModel = mp_elevation.ElevationModel(database=self.terrain_settings.source,
+                                                          offline=self.terrain_settings.offline,
+                                                          cache_mb=self.terrain_settings.cache_mb)
 
     def cmd_terrain(self, args):
         '''terrain command parser'''
@@ -44,7 +48,9 @@ class TerrainModule(mp_module.MPModule):
         elif args[0] == "set":
             self.terrain_settings.command(args[1:])
             # Re-init terrain model
-            self.ElevationModel = mp_elevation.ElevationModel(database=self.terrain_settings.source, offline=self.terrain_settings.offline)
+            self.ElevationModel = mp_elevation.ElevationModel(database=self.terrain_settings.source,
+                                                          offline=self.terrain_settings.offline,
+                                                          cache_mb=self.terrain_settings.cache_mb)
         elif args[0] == "check":
             self.cmd_terrain_check(args[1:])
         else:
@@ -88,19 +94,24 @@ class TerrainModule(mp_module.MPModule):
         (lat, lon) = mp_util.gps_offset(lat, lon,
                                         east=bit_spacing * (bit % 8),
                                         north=bit_spacing * (bit // 8))
-        data = []
+        lats = []
+        lons = []
         for i in range(4*4):
             y = i % 4
             x = i // 4
             (lat2,lon2) = mp_util.gps_offset(lat, lon,
                                              east=self.current_request.grid_spacing * y,
                                              north=self.current_request.grid_spacing * x)
-            alt = self.ElevationModel.GetElevation(lat2, lon2)
-            if alt is None:
+            lats.append(lat2)
+            lons.append(lon2)
+        alts = self.ElevationModel.GetElevationArray(lats, lons)
+        data = []
+        for i in range(4*4):
+            if math.isnan(alts[i]):
                 if self.terrain_settings.debug:
-                    print("no alt ", lat2, lon2)
+                    print("no alt ", lats[i], lons[i])
                 return
-            data.append(int(alt))
+            data.append(int(alts[i]))
         self.master.mav.terrain_data_send(self.current_request.lat,
                                           self.current_request.lon,
                                           self.current_request.grid_spacing,
@@ -22,6 +22,8 @@ from MAVProxy.modules.lib import rline
 from MAVProxy.modules.lib import wxconsole
 from MAVProxy.modules.lib import param_help
 from MAVProxy.modules.lib import param_ftp
+from MAVProxy.modules.lib import log_index
+from MAVProxy.modules.lib import mp_expression
 from MAVProxy.modules.lib.graph_ui import Graph_UI
 from pymavlink.mavextra import *
 from MAVProxy.modules.lib.mp_menu import *
@@ -114,6 +116,8 @@ class MEState(object):
               MPSetting('paramdocs', bool, True, 'show param docs'),
               MPSetting('max_rate', float, 0, 'maximum display rate of graphs in Hz'),
               MPSetting('vehicle_type', str, 'Auto', 'force vehicle type for mode handling'),
+              MPSetting('log_index', bool, True, 'keep a message index file next to each log'),
+              MPSetting('graph_procs', int, 1, 'processes used to extract graph data, 0 for one per CPU'),
               ]
             )
 
@@ -273,12 +277,7 @@ def expression_ok(expression, msgs=None):
                     f = f[:a2]
             if f.endswith(':2'):
                 f = f[:-2]
-            if f[-1] == '}':
-                # avoid passing nocondition unless needed to allow us to work witih older
-                # pymavlink versions
-                res = mavutil.evaluate_expression(f, msgs, nocondition=True)
-            else:
-                res = mavutil.evaluate_expression(f, msgs)
+            res = mp_expression.evaluate_expression(f, msgs, nocondition=True)
             if res is None:
                 expression_ok = False
         except Exception:
@@ -596,6 +595,10 @@ def cmd_dump(args):
                     types_inst.extend([t])
                     types_inst_no_id.extend([t2])
 
+    if xlimits.xlim_low is not None and hasattr(mlog, 'seek_time'):
+        # use the log index to skip messages before the zoomed range
+        mlog.seek_time(types_filt_inst_id, xlimits.xlim_low)
+
     #begin first dump msg on new line
     print("")
     ext = False
@@ -1427,9 +1430,12 @@ def loadfile(args):
     '''load a log file (path given by arg)'''
     mestate.console.write("Loading %s...\n" % args)
     t0 = time.time()
-    mlog = mavutil.mavlink_connection(args, notimestamps=False,
-                                      zero_time_base=False,
-                                      progress_callback=progress_bar)
+    if mestate.settings.log_index:
+        mlog = log_index.open_log(args, progress_callback=progress_bar)
+    else:
+        mlog = mavutil.mavlink_connection(args, notimestamps=False,
+                                          zero_time_base=False,
+                                          progress_callback=progress_bar)
     mestate.filename = args
     mestate.mlog = mlog
     # note that this is a shallow copy of the messages.
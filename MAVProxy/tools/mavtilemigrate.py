@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+'''
+copy a map tile cache of one file per tile into the sqlite tile store
+
+AP_FLAKE8_CLEAN
+'''
+
+import os
+import sys
+
+from MAVProxy.modules.mavproxy_map import mp_tile, tile_store
+
+# tiles added per transaction
+BATCH_SIZE = 1000
+
+
+def remove_files(paths, delete):
+    '''remove copied tile files if requested, emptying the list'''
+    if delete:
+        for path in paths:
+            os.unlink(path)
+    del paths[:]
+
+
+def migrate_service(cache_path, service, store, delete=False):
+    '''copy the tiles of one service, returning the number copied'''
+    service_dir = os.path.join(cache_path, service)
+    conn = store.connection(service)
+    count = 0
+    # files are only removed once their tiles are committed
+    copied = []
+    conn.execute('BEGIN')
+    for (dirpath, dirnames, filenames) in os.walk(service_dir):
+        rel = os.path.relpath(dirpath, service_dir).split(os.sep)
+        if len(rel) != 2:
+            continue
+        try:
+            (zoom, y) = (int(rel[0]), int(rel[1]))
+        except ValueError:
+            continue
+        for f in filenames:
+            if not f.endswith('.img'):
+                continue
+            try:
+                x = int(f[:-4])
+            except ValueError:
+                continue
+            path = os.path.join(dirpath, f)
+            with open(path, 'rb') as h:
+                data = h.read()
+            if len(data) == 0:
+                continue
+            tile = mp_tile.TileInfo((x, y), zoom, service)
+            store.put(tile, data, mtime=os.path.getmtime(path))
+            count += 1
+            copied.append(path)
+            if count % BATCH_SIZE == 0:
+                conn.execute('COMMIT')
+                remove_files(copied, delete)
+                conn.execute('BEGIN')
+                print("%s: %u tiles" % (service, count))
+    conn.execute('COMMIT')
+    remove_files(copied, delete)
+    return count
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    parser = ArgumentParser("mavtilemigrate.py [options]")
+    parser.add_argument("--cache", default=os.path.join(os.path.expanduser('~'), '.tilecache'), help="tile cache directory")
+    parser.add_argument("--service", default=[], action='append', help="tile service to copy, default all")
+    parser.add_argument("--max-size", type=int, default=0, help="size cap in MB for each service")
+    parser.add_argument("--delete", action='store_true', default=False, help="remove tile files once copied")
+    args = parser.parse_args()
+
+    services = args.service
+    if len(services) == 0:
+        services = [s for s in sorted(os.listdir(args.cache))
+                    if s in mp_tile.TILE_SERVICES and os.path.isdir(os.path.join(args.cache, s))]
+    if len(services) == 0:
+        print("No tile services found in %s" % args.cache)
+        sys.exit(1)
+
+    # the size cap is applied once all tiles are copied
+    store = tile_store.SQLiteTileStore(args.cache)
+    for service in services:
+        count = migrate_service(args.cache, service, store, delete=args.delete)
+        if args.max_size > 0:
+            store.max_size = args.max_size * 1024 * 1024
+            store.evict(service)
+            store.max_size = 0
+        print("%s: copied %u tiles to %s" % (service, count, store.filename(service)))
+    store.close()